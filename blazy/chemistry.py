@@ -3,6 +3,7 @@ Functions for dealing with molecule names.
 """
 
 import re
+import functools
 import numpy as np
 from .helpers import issubset
 
@@ -27,49 +28,103 @@ def is_valid_element(tocheck):
 def is_valid_molecule(tocheck):
     return issubset(get_elements(tocheck), valid_elements)
 
+# compiled patterns for parsing formulae
+_element_pattern = re.compile(r'[A-Z][a-z]{0,2}')
+_long_charge_pattern = re.compile(r'[+-]+$')
+_short_charge_pattern = re.compile(r'[+-][0-9]+$')
+_parens_pattern = re.compile(r'\(((?:[^()]|\([^()]*\))+)\)([0-9]+)?')  # balanced groups, one level of nesting
+_stoich_pattern = re.compile(r'([A-Z][a-z]?)([0-9]+)?')
+_valence_pattern = re.compile(r'.*([+-][0-9]{1})')
+
+# maximum number of formulae remembered by each cached function
+CACHE_SIZE = 8192
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _get_elements(molecule):
+    return frozenset(_element_pattern.findall(molecule))
+
 def get_elements(molecule):
-    els = re.compile('[A-Z][a-z]{0,2}')
-    
-    return set(els.findall(molecule))
+    return set(_get_elements(molecule))
 
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def valence_long2short(ion):
     """
     Converts, e.g., Ca++ to Ca+2
     """
-    charge = re.compile('[+-]+$')
-    
-    chg = charge.findall(ion)
+    chg = _long_charge_pattern.findall(ion)
     if chg:
         out = chg[0][0]
         n = len(chg[0])
         if n > 1:
             out = f"{out}{n}"
     
-        return charge.sub(out, ion)
+        return _long_charge_pattern.sub(out, ion)
     else:
         return ion
-    
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def valence_short2long(ion):
     """
     Converts, e.g., Ca+2 to Ca++
     """
-    charge = re.compile('[+-][0-9]+$')
-    
-    chg = charge.findall(ion)
+    chg = _short_charge_pattern.findall(ion)
     if chg:
         out = chg[0][0]
         
         if len(chg[0]) > 1:
             n = int(chg[0][1:])
             out *= n    
-        return charge.sub(out, ion)
+        return _short_charge_pattern.sub(out, ion)
     else:
         return ion
 
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def get_charge(ion):
+    """
+    Returns the charge of an ion, e.g. Ca+2 or Ca++ -> 2, CO3-2 -> -2, B(OH)3 -> 0.
+    """
+    ion = valence_long2short(ion)
+    chg = _short_charge_pattern.findall(ion)
+    if chg:
+        return int(chg[0])
+    if ion.endswith('+'):
+        return 1
+    if ion.endswith('-'):
+        return -1
+    return 0
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _decompose_molecule(molecule, n):
+    ps = _parens_pattern.findall(molecule)  # find subgroups in parentheses
+    rem = _parens_pattern.sub('', molecule)  # get remainder
+    
+    comp = {}
+    for s, ns in ps:
+        for k, v in _decompose_molecule(s, 1 if ns == '' else int(ns)):
+            if k != 'valence':
+                comp[k] = comp.get(k, 0) + v * n
+        
+    for e, ns in _stoich_pattern.findall(rem):
+        if e not in comp:
+            comp[e] = 0
+        if ns == '':
+            ns = 1 * n
+        else:
+            ns = int(ns) * n
+        comp[e] += ns
+    
+    # valence information, if present:
+    if _valence_pattern.match(rem):
+        comp['valence'] = _valence_pattern.findall(rem)[0]
+    
+    return tuple(comp.items())
+
 def decompose_molecule(molecule, n=1):
     """
     Returns the chemical constituents of the molecule, and their number.
 
+    Results are cached on (molecule, n).
+
     Parameters
     ----------
     molecule : str
@@ -87,36 +142,45 @@ def decompose_molecule(molecule, n=1):
             n = 1
         n = int(n)
     
-    # define regexs
-    parens = re.compile('\(([A-z0-9()]+)\)([0-9]+)?')
-    stoich = re.compile('([A-Z][a-z]?)([0-9]+)?')
-    valence = re.compile('.*([+-][0-9]{1})')
+    return dict(_decompose_molecule(molecule, n))
 
-    ps = parens.findall(molecule)  # find subgroups in parentheses
-    rem = parens.sub('', molecule)  # get remainder
-    
-    if len(ps) > 0:
-        for s, ns in ps:
-            comp = decompose_molecule(s, ns)
-        for k, v in comp.items():
-            comp[k] = v * n
-    else:
-        comp = {}
-        
-    for e, ns in stoich.findall(rem):
-        if e not in comp:
-            comp[e] = 0
-        if ns == '':
-            ns = 1 * n
-        else:
-            ns = int(ns) * n
-        comp[e] += ns
-    
-    # valence information, if present:
-    if valence.match(rem):
-        comp['valence'] = valence.findall(rem)[0]
+def stoichiometry_matrix(formulas, elements=None, charge=False):
+    """
+    Returns the stoichiometry of many formulae as a (formula x element) array.
+
+    Parameters
+    ----------
+    formulas : array-like
+        Formulae in standard chemical notation, e.g. ['CaCO3', 'B(OH)4-', 'Mg+2'].
+    elements : array-like
+        The elements (columns) of the matrix. If None, all elements present
+        in `formulas` are used, in alphabetical order.
+    charge : bool
+        If True, an additional final column contains the charge of each formula.
+
+    Returns
+    -------
+    tuple : (matrix, columns), where matrix is a float64 array of shape 
+    (len(formulas), len(columns)).
+    """
+    comps = [_decompose_molecule(f, 1) for f in formulas]
+    if elements is None:
+        elements = sorted({k for c in comps for k, _ in c if k != 'valence'})
+    columns = list(elements)
+    col = {e: i for i, e in enumerate(columns)}
+
+    out = np.zeros((len(comps), len(columns) + int(charge)), dtype=np.float64)
+    for i, c in enumerate(comps):
+        for k, v in c:
+            j = col.get(k)
+            if j is not None:
+                out[i, j] += v
     
-    return comp
+    if charge:
+        out[:, -1] = [get_charge(f) for f in formulas]
+        columns.append('charge')
+
+    return out, columns
 
 def calc_Istr(ion_molarity, ion_carges):
     return 0.5 * np.sum(ion_molarity * ion_carges**2, axis=1)
@@ -1,2 +1,2 @@
 from .run import iphreeqc
-from .parser import datParser
\ No newline at end of file
+from .parser import datParser, DatabaseHandle
\ No newline at end of file
@@ -0,0 +1,186 @@
+"""
+Running PHREEQC from asyncio code.
+
+An `AsyncRunner` owns long-lived executors: a thread pool that runs batches
+of solutions on keep-alive engines from an `EnginePool`, and a process pool
+of persistent engines for Monte Carlo samples. Jobs are submitted with
+backpressure, results are streamed as they complete, and cancelling a request
+cancels any of its jobs that have not yet started.
+"""
+
+import asyncio
+import weakref
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .engine import EnginePool, run_batched
+from .multiprocessing import init_worker
+from .montecarlo import mc_input_dfs, make_and_run_input_persistent, concat_mc_results
+
+class AsyncRunner:
+    """
+    Long-lived executors for running PHREEQC jobs from an event loop.
+
+    Parameters
+    ----------
+    database : datParser
+        The database to use.
+    iphreeqc_path : str
+        Path to the iphreeqc shared library.
+    threads : int
+        Number of threads (and keep-alive engines) for `stream`.
+    processes : int
+        Number of worker processes for `stream_mc`. The process pool is
+        started by the first Monte Carlo request. Defaults to the number of CPUs.
+    max_pending : int
+        Maximum number of jobs submitted to the executors at once, across
+        all requests on an event loop. Further requests wait until jobs complete.
+    engines : EnginePool
+        Pool of engines used by the thread executor. If None, a new pool is made.
+    """
+    def __init__(self, database, iphreeqc_path=None, threads=4, processes=None, max_pending=64, engines=None):
+        self.database = database
+        self.iphreeqc_path = iphreeqc_path
+        self.processes = processes
+        self.max_pending = max_pending
+        self.engines = EnginePool(iphreeqc_path, max_engines=threads) if engines is None else engines
+
+        self._threads = ThreadPoolExecutor(max_workers=threads)
+        self._processes = None
+        # one semaphore per event loop, as asyncio primitives are bound to the loop they are used in
+        self._slots = weakref.WeakKeyDictionary()
+
+    def _process_executor(self):
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(max_workers=self.processes, initializer=init_worker,
+                                                  initargs=(self.database.path, self.iphreeqc_path, self.database.handle()))
+        return self._processes
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._slots:
+            self._slots[loop] = asyncio.Semaphore(self.max_pending)
+        return self._slots[loop]
+
+    async def _job(self, key, executor, fn, *args):
+        return key, await asyncio.wrap_future(executor.submit(fn, *args))
+
+    async def _stream(self, executor, jobs):
+        """
+        Submit (key, fn, args) jobs with backpressure, yielding (key, result) as they complete.
+        """
+        slots = self._semaphore()
+
+        pending = set()
+        try:
+            for key, fn, args in jobs:
+                await slots.acquire()
+                task = asyncio.ensure_future(self._job(key, executor, fn, *args))
+                # release in a callback, which also runs if the task is cancelled before it starts
+                task.add_done_callback(lambda t: slots.release())
+                pending.add(task)
+
+                done = {p for p in pending if p.done()}
+                pending -= done
+                for d in done:
+                    yield d.result()
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for d in done:
+                    yield d.result()
+        finally:
+            for p in pending:
+                p.cancel()
+
+    def _run_chunk(self, inputs, outputs, start=0):
+        with self.engines.engine(self.database.path) as engine:
+            out = run_batched(engine, inputs, outputs, chunksize=len(inputs))
+        if ('general', 'soln') in out.columns:
+            # number solutions by position in the whole request, as in `run_batched`
+            out[('general', 'soln')] += start
+        return out
+
+    async def stream(self, inputs, outputs, chunksize=100):
+        """
+        Run solutions in chunks on the thread executor, yielding results as they complete.
+
+        Parameters
+        ----------
+        inputs : pandas.DataFrame
+            Checked solution inputs, one solution per row.
+        outputs : str
+            SELECTED_OUTPUT string.
+        chunksize : int
+            Number of solutions per job.
+
+        Returns
+        -------
+        async generator : yields (chunk number, output DataFrame indexed by the index of `inputs`).
+        """
+        jobs = ((i, self._run_chunk, (inputs.iloc[start:start + chunksize], outputs, start))
+                for i, start in enumerate(range(0, len(inputs), chunksize)))
+        async for key, out in self._stream(self._threads, jobs):
+            yield key, out
+
+    async def stream_mc(self, inputs, N, outputs, uncertainty_id='_std', distribution=None, random_state=None, sampler='random',
+                        correlation=None, covariance=None):
+        """
+        Run Monte Carlo samples on the process executor, yielding results as they complete.
+
+        Inputs are drawn in blocks of samples, as in `mc_input_dfs`, so that a given
+        `random_state` gives the same samples as `run_mc`. At most `max_pending`
+        samples are submitted to the process executor at once.
+
+        Returns
+        -------
+        async generator : yields (sample number, output DataFrame of N iterations).
+        """
+        mc = mc_input_dfs(inputs, N=N, uncertainty_id=uncertainty_id, distribution=distribution, outputs=outputs, db=None,
+                          random_state=random_state, sampler=sampler, correlation=correlation, covariance=covariance)
+        jobs = ((i, make_and_run_input_persistent, args) for i, args in enumerate(mc))
+        async for key, (out, _) in self._stream(self._process_executor(), jobs):
+            yield key, out
+
+    async def run(self, inputs, outputs, chunksize=100, timeout=None):
+        """
+        Run solutions, returning all outputs in the order of `inputs`.
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds before the request is cancelled, raising `asyncio.TimeoutError`.
+        """
+        async def collect():
+            results = {}
+            async for key, out in self.stream(inputs, outputs, chunksize=chunksize):
+                results[key] = out
+            return pd.concat([results[k] for k in sorted(results)])
+        return await asyncio.wait_for(collect(), timeout)
+
+    async def run_mc(self, inputs, N, outputs, timeout=None, **kwargs):
+        """
+        Run Monte Carlo samples, returning results indexed by (sample, iteration).
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds before the request is cancelled, raising `asyncio.TimeoutError`.
+
+        Other parameters are as in `stream_mc`.
+        """
+        async def collect():
+            results = {}
+            async for key, out in self.stream_mc(inputs, N, outputs, **kwargs):
+                results[key] = out
+            return concat_mc_results([results[k] for k in sorted(results)])
+        return await asyncio.wait_for(collect(), timeout)
+
+    def close(self, wait=True):
+        """
+        Shut down the executors, cancelling jobs that have not started.
+        """
+        self._threads.shutdown(wait=wait, cancel_futures=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=wait, cancel_futures=True)
+            self._processes = None
@@ -0,0 +1,189 @@
+"""
+On-disk cache of parsed PHREEQC databases.
+
+Parsing a database means reading the file, dropping comments, finding
+the sections and building the master species, SOLUTION_SPECIES and PHASES
+tables. The results are stored as a pickle, keyed on the path,
+modification time and content hash of the database file, so that
+subsequent `datParser` instances can load them in milliseconds.
+
+The cache is opt-in. `datParser` uses it when the `BLAZY_CACHE_DIR`
+environment variable is set (the cache then lives in that directory), or
+when it is created with `use_cache=True` (the cache then lives in
+`~/.cache/blazy`, unless `BLAZY_CACHE_DIR` is set). Entries are pickles,
+so only entries owned by the current user are loaded.
+
+To pre-build the cache for all bundled databases, run `blazy-cache-databases`
+from the command line, or call `warm_cache()`, with `BLAZY_CACHE_DIR` set
+to the directory the cache should be read from.
+"""
+
+import os
+import sys
+import pickle
+import hashlib
+import tempfile
+import warnings
+from glob import glob
+import pkg_resources as pkgrs
+
+# increment when the contents of cache entries change
+CACHE_VERSION = 2
+
+def enabled():
+    """
+    Returns True if the cache is enabled by the `BLAZY_CACHE_DIR` environment variable.
+    """
+    return bool(os.environ.get('BLAZY_CACHE_DIR'))
+
+def cache_dir():
+    """
+    Returns the directory where parsed databases are cached.
+    """
+    return os.environ.get('BLAZY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'blazy'))
+
+def file_hash(path):
+    """
+    Returns the sha1 hash of the contents of a file.
+    """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def cache_path(path):
+    """
+    Returns the path of the cache entry for a database file.
+    """
+    path = os.path.abspath(path)
+    name = os.path.basename(path).replace('.dat', '')
+    return os.path.join(cache_dir(), f"{name}-{hashlib.sha1(path.encode()).hexdigest()[:12]}.pickle")
+
+def load_cached(path):
+    """
+    Load the parsed contents of a database from the cache.
+
+    The entry is valid if it was made from the same file (path) with the
+    same modification time and size. If these have changed, the entry is
+    still used if the file contents (hash) are unchanged.
+
+    Parameters
+    ----------
+    path : str
+        Path to a PHREEQC database.
+
+    Returns
+    -------
+    dict or None : the cached contents, or None if there is no valid entry.
+    """
+    cfile = cache_path(path)
+    if not os.path.exists(cfile):
+        return None
+
+    if hasattr(os, 'getuid') and os.stat(cfile).st_uid != os.getuid():
+        # unpickling can run arbitrary code, so only trust our own entries
+        return None
+
+    try:
+        with open(cfile, 'rb') as f:
+            entry = pickle.load(f)
+    except Exception:
+        return None
+
+    if entry.get('version') != CACHE_VERSION or entry.get('path') != os.path.abspath(path):
+        return None
+
+    stat = os.stat(path)
+    if (entry['mtime'], entry['size']) == (stat.st_mtime, stat.st_size):
+        return entry
+
+    if entry['hash'] == file_hash(path):
+        entry['mtime'], entry['size'] = stat.st_mtime, stat.st_size
+        _write(cfile, entry)
+        return entry
+
+    return None
+
+def save_cached(path, contents):
+    """
+    Store the parsed contents of a database in the cache.
+
+    Parameters
+    ----------
+    path : str
+        Path to the PHREEQC database the contents were parsed from.
+    contents : dict
+        The parsed contents.
+    """
+    stat = os.stat(path)
+    entry = {
+        'version': CACHE_VERSION,
+        'path': os.path.abspath(path),
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'hash': file_hash(path),
+    }
+    entry.update(contents)
+    _write(cache_path(path), entry)
+
+def _write(cfile, entry):
+    try:
+        os.makedirs(os.path.dirname(cfile), exist_ok=True)
+        # a unique temporary file for each writer, whether another process or thread
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cfile), prefix=os.path.basename(cfile) + '.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cfile)  # atomic, so concurrent workers never see a partial entry
+    except OSError as e:
+        warnings.warn(f'Could not write database cache to {cfile}: {e}')
+
+def invalidate(path=None):
+    """
+    Remove cache entries.
+
+    Parameters
+    ----------
+    path : str
+        Path to a database. If None, the entire cache is cleared.
+    """
+    if path is None:
+        cfiles = glob(os.path.join(cache_dir(), '*.pickle'))
+    else:
+        cfiles = [cache_path(path)]
+    for c in cfiles:
+        if os.path.exists(c):
+            os.remove(c)
+
+def warm_cache(databases=None, silent=False):
+    """
+    Parse databases and store them in the cache.
+
+    Parameters
+    ----------
+    databases : list
+        Names or paths of databases. If None, all bundled databases are used.
+
+    Returns
+    -------
+    list : paths of the cached databases.
+    """
+    from .parser import datParser
+
+    if databases is None:
+        databases = sorted(glob(pkgrs.resource_filename('blazy', os.path.join('resources', 'database', '*.dat'))))
+
+    paths = []
+    for d in databases:
+        db = datParser(d, silent=True, use_cache=False)
+        db.save_cache()
+        paths.append(db.path)
+        if not silent:
+            print(f'  cached {os.path.basename(db.path)} -> {cache_path(db.path)}')
+    return paths
+
+def main():
+    """
+    Command line entry point: cache the databases given as arguments, or all bundled databases.
+    """
+    warm_cache(sys.argv[1:] or None)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+"""
+Persistent IPhreeqc engines that load a database once and are re-used for many runs.
+"""
+
+import os
+import time
+import threading
+import contextlib
+import numpy as np
+import pandas as pd
+import phreeqpy.iphreeqc.phreeqc_dll as phreeqc_mod
+from concurrent.futures import ThreadPoolExecutor
+
+from .io import phreeqfind, output_parser, resolve_database_path, format_solutions
+
+class PhreeqcEngine:
+    """
+    A single IPhreeqc instance with a database pre-loaded.
+
+    Creating an IPhreeqc instance and loading a large database (e.g. llnl.dat)
+    can take longer than the speciation calculation itself. An engine pays
+    this start-up cost once, and then runs any number of input strings.
+
+    Parameters
+    ----------
+    database : str
+        Name of an included database (e.g. 'pitzer'), or a path
+        to a PHREEQC database file.
+    iphreeqc_path : str
+        Path to the iphreeqc shared library. If None, `phreeqfind` is used.
+
+    Attributes
+    ----------
+    startup_time : float
+        Seconds spent creating the IPhreeqc instance and loading the database.
+    solve_time : float
+        Cumulative seconds spent in `run_string`.
+    parse_time : float
+        Cumulative seconds spent retrieving and parsing selected output.
+    n_runs : int
+        Number of input strings run by this engine.
+    """
+    def __init__(self, database='pitzer', iphreeqc_path=None):
+        self.database = resolve_database_path(database)
+        if iphreeqc_path is None:
+            iphreeqc_path = phreeqfind()
+        self.iphreeqc_path = iphreeqc_path
+
+        self.n_runs = 0
+        self.solve_time = 0.
+        self.parse_time = 0.
+
+        t0 = time.perf_counter()
+        self.phreeqc = phreeqc_mod.IPhreeqc(self.iphreeqc_path)
+        self.phreeqc.load_database(self.database)
+        self.startup_time = time.perf_counter() - t0
+
+    def run(self, input_string, parse_output=True):
+        """
+        Run an input string and return the selected output.
+
+        Parameters
+        ----------
+        input_string : str
+            Valid phreeqc input string with SELECTED_OUTPUT.
+        parse_output : bool
+            If True, the output is parsed by `output_parser` into a DataFrame.
+            If False, the raw selected output array is returned.
+
+        Returns
+        -------
+        pandas.DataFrame or list
+        """
+        t0 = time.perf_counter()
+        self.phreeqc.run_string(input_string)
+        t1 = time.perf_counter()
+        out = self.phreeqc.get_selected_output_array()
+        if parse_output:
+            out = output_parser(out)
+        t2 = time.perf_counter()
+
+        self.n_runs += 1
+        self.solve_time += t1 - t0
+        self.parse_time += t2 - t1
+
+        return out
+
+    def stats(self):
+        """
+        Returns a dict of the timing counters of this engine.
+        """
+        return {
+            'pid': os.getpid(),
+            'database': os.path.basename(self.database),
+            'n_runs': self.n_runs,
+            'startup_time': self.startup_time,
+            'solve_time': self.solve_time,
+            'parse_time': self.parse_time,
+        }
+
+    def destroy(self):
+        """
+        Release the underlying IPhreeqc instance.
+        """
+        if hasattr(self, 'phreeqc'):
+            self.phreeqc.destroy_iphreeqc()
+            del self.phreeqc
+
+def chunk_solutions(inputs, chunksize=None, max_chars=None):
+    """
+    Split a DataFrame of solutions into batches of SOLUTION blocks.
+
+    Solutions are numbered by their position in `inputs` (starting at 1), so
+    that outputs can be returned to the original row order.
+
+    Parameters
+    ----------
+    inputs : pandas.DataFrame
+        Checked solution inputs, one solution per row.
+    chunksize : int
+        Maximum number of solutions in each batch.
+    max_chars : int
+        Maximum length of the SOLUTION text in each batch. A single solution
+        longer than this is still run in a batch of its own.
+
+    Returns
+    -------
+    generator : yields lists of SOLUTION block strings.
+    """
+    if chunksize is None and max_chars is None:
+        chunksize = len(inputs)
+
+    batch = []
+    nchars = 0
+    for sol in format_solutions(inputs, numbers=np.arange(1, len(inputs) + 1)).tolist():
+        full = (chunksize is not None and len(batch) >= chunksize) or (max_chars is not None and batch and nchars + len(sol) > max_chars)
+        if full:
+            yield batch
+            batch = []
+            nchars = 0
+        batch.append(sol)
+        nchars += len(sol)
+    if batch:
+        yield batch
+
+def merge_selected_output(arrays, index=None, parse_output=True):
+    """
+    Combine raw selected output arrays from several runs, sorted by solution number.
+
+    Parameters
+    ----------
+    arrays : list
+        Raw arrays returned by `get_selected_output_array`, where the
+        first row of each is the header.
+    index : array-like
+        Labels of the input solutions, in the order they were numbered.
+        If given, the output is indexed by the label of each row's solution.
+    parse_output : bool
+        If False, the merged raw array is returned.
+
+    Returns
+    -------
+    pandas.DataFrame : parsed output in solution order.
+    """
+    if not arrays:
+        # no solutions were run
+        if not parse_output:
+            return []
+        return pd.DataFrame(index=None if index is None else pd.Index(index)[:0])
+
+    header = arrays[0][0]
+    rows = [r for a in arrays for r in a[1:]]
+    isoln = header.index('soln')
+    rows.sort(key=lambda r: r[isoln])  # stable, so multiple rows per solution keep their order
+
+    if not parse_output:
+        return [header] + rows
+
+    out = output_parser([header] + rows)
+    if index is not None:
+        out.index = pd.Index(index)[[r[isoln] - 1 for r in rows]]
+    return out
+
+def run_batched(engine, inputs, outputs, chunksize=1000, max_chars=None, parse_output=True):
+    """
+    Run many solutions on an engine, with a controlled number of solutions per `run_string` call.
+
+    Parameters
+    ----------
+    engine : PhreeqcEngine
+        The engine to run the batches on.
+    inputs : pandas.DataFrame
+        Checked solution inputs, one solution per row.
+    outputs : str
+        SELECTED_OUTPUT string.
+    chunksize : int
+        Maximum number of solutions in each `run_string` call.
+    max_chars : int
+        Maximum length of the SOLUTION text in each `run_string` call.
+    parse_output : bool
+        If False, the raw selected output array (in row order) is returned.
+
+    Returns
+    -------
+    pandas.DataFrame : parsed output, indexed by the index of `inputs`.
+    """
+    arrays = []
+    for batch in chunk_solutions(inputs, chunksize=chunksize, max_chars=max_chars):
+        arrays.append(engine.run('\n'.join(batch) + '\n' + outputs + '\nEND', parse_output=False))
+    return merge_selected_output(arrays, index=inputs.index, parse_output=parse_output)
+
+class EnginePool:
+    """
+    A thread-safe pool of keep-alive engines, with checkout/checkin semantics.
+
+    Engines are created on demand for each database, up to `max_engines` per
+    database, and are handed to one user at a time. Separate IPhreeqc instances
+    are independent, and ctypes releases the GIL during `run_string`, so engines
+    checked out by different threads run in parallel.
+
+    Parameters
+    ----------
+    iphreeqc_path : str
+        Path to the iphreeqc shared library. If None, `phreeqfind` is used.
+    max_engines : int
+        Maximum number of engines per database. `checkout` blocks while this
+        many are in use. If None, engines are created whenever none are idle.
+    max_runs : int
+        Engines are destroyed when checked in after this many runs, limiting
+        memory growth in long-lived instances. If None, engines are kept.
+
+    Attributes
+    ----------
+    n_created, n_recycled : int
+        Number of engines created, and destroyed after reaching `max_runs`.
+    """
+    def __init__(self, iphreeqc_path=None, max_engines=None, max_runs=None):
+        if iphreeqc_path is None:
+            iphreeqc_path = phreeqfind()
+        self.iphreeqc_path = iphreeqc_path
+        self.max_engines = max_engines
+        self.max_runs = max_runs
+
+        self._idle = {}
+        self._busy = {}
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.n_created = 0
+        self.n_recycled = 0
+
+    def checkout(self, database='pitzer', timeout=None):
+        """
+        Take an engine for `database` from the pool.
+
+        Parameters
+        ----------
+        database : str
+            Name or path of the database.
+        timeout : float
+            Seconds to wait for an engine if `max_engines` are in use.
+
+        Returns
+        -------
+        PhreeqcEngine : must be returned with `checkin`.
+        """
+        database = resolve_database_path(database)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('This EnginePool has been closed.')
+            idle = self._idle.setdefault(database, [])
+            busy = self._busy.setdefault(database, 0)
+            if not idle and self.max_engines is not None and busy >= self.max_engines:
+                available = lambda: self._closed or self._idle.get(database) or self._busy.get(database, 0) < self.max_engines
+                if not self._cond.wait_for(available, timeout=timeout):
+                    raise TimeoutError(f'No engine for {os.path.basename(database)} became available within {timeout} s.')
+                if self._closed:
+                    raise RuntimeError('This EnginePool has been closed.')
+                idle = self._idle.setdefault(database, [])
+            self._busy[database] += 1
+            if idle:
+                return idle.pop()
+
+        # create outside the lock, so other threads aren't blocked while the database loads
+        try:
+            engine = PhreeqcEngine(database, self.iphreeqc_path)
+        except BaseException:
+            with self._cond:
+                self._busy[database] -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.n_created += 1
+        return engine
+
+    def checkin(self, engine):
+        """
+        Return an engine to the pool.
+        """
+        with self._cond:
+            self._busy[engine.database] -= 1
+            if self._closed or (self.max_runs is not None and engine.n_runs >= self.max_runs):
+                engine.destroy()
+                if not self._closed:
+                    self.n_recycled += 1
+            else:
+                self._idle[engine.database].append(engine)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def engine(self, database='pitzer', timeout=None):
+        """
+        Context manager that checks out an engine, and checks it back in on exit.
+        """
+        engine = self.checkout(database, timeout=timeout)
+        try:
+            yield engine
+        finally:
+            self.checkin(engine)
+
+    def run(self, input_string, database='pitzer', parse_output=True):
+        """
+        Run an input string on any free engine for `database`.
+        """
+        with self.engine(database) as engine:
+            return engine.run(input_string, parse_output=parse_output)
+
+    def stats(self):
+        """
+        Returns a dict of the number of engines created, recycled, idle and in use.
+        """
+        with self._cond:
+            return {
+                'created': self.n_created,
+                'recycled': self.n_recycled,
+                'idle': {os.path.basename(k): len(v) for k, v in self._idle.items()},
+                'busy': {os.path.basename(k): v for k, v in self._busy.items()},
+            }
+
+    def close(self):
+        """
+        Destroy all idle engines. Engines in use are destroyed when checked in,
+        and threads waiting in `checkout` raise RuntimeError.
+        """
+        with self._cond:
+            self._closed = True
+            for engines in self._idle.values():
+                for engine in engines:
+                    engine.destroy()
+            self._idle = {}
+            self._cond.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def run_threaded(pool, database, inputs, outputs, threads=4, chunksize=1000, max_chars=None, parse_output=True):
+    """
+    Run many solutions in batches on engines from a pool, using a pool of threads.
+
+    Parameters
+    ----------
+    pool : EnginePool
+        The pool that supplies engines.
+    database : str
+        Name or path of the database.
+    threads : int
+        Number of threads, and so the number of engines used at once.
+    
+    Other parameters are as in `run_batched`.
+
+    Returns
+    -------
+    pandas.DataFrame : parsed output, indexed by the index of `inputs`.
+    """
+    def run(batch):
+        with pool.engine(database) as engine:
+            return engine.run('\n'.join(batch) + '\n' + outputs + '\nEND', parse_output=False)
+
+    batches = chunk_solutions(inputs, chunksize=chunksize, max_chars=max_chars)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        arrays = list(executor.map(run, batches))
+    return merge_selected_output(arrays, index=inputs.index, parse_output=parse_output)
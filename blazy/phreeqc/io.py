@@ -4,6 +4,8 @@ Functions for handling iPHREEQC inputs and outputs.
 
 import os
 import re
+import operator
+import functools
 import platform
 import numpy as np
 import pandas as pd
@@ -42,6 +44,71 @@ def make_solution(inputs, n=1):
             inp.append(f'    {k:20s}{float(v):.8e}')
     return '\n'.join(inp) + '\n'
 
+def format_solutions(inputs, numbers=None):
+    """
+    Format every row of a DataFrame as a SOLUTION block, column-wise.
+
+    Produces the same text as `make_solution` applied to each row, but 
+    formats each column in a single pass rather than each value separately.
+    NaN values are omitted from their SOLUTION block.
+
+    Parameters
+    ----------
+    inputs : pandas.DataFrame
+        Solution inputs, one solution per row.
+    numbers : array-like
+        The number of each SOLUTION. Defaults to the index of `inputs`.
+
+    Returns
+    -------
+    numpy.ndarray : object array containing one SOLUTION block string per row.
+    """
+    if numbers is None:
+        numbers = inputs.index
+    numbers = np.asarray(numbers).astype(int)
+
+    columns = [[f"SOLUTION {n:d}" for n in numbers.tolist()]]
+    for k in inputs.columns:
+        col = inputs[k]
+        if pd.api.types.is_numeric_dtype(col):
+            text = [f'\n    {k:20s}{x:.8e}' for x in col.values.astype(np.float64).tolist()]
+        else:
+            text = [f'\n    {k:20s}{x:s}' if isinstance(x, str) else f'\n    {k:20s}{float(x):.8e}' for x in col.values.tolist()]
+        # NaN values are dropped from the SOLUTION
+        for i in np.flatnonzero(pd.isnull(col.values)).tolist():
+            text[i] = ''
+        columns.append(text)
+    columns.append(['\n'] * len(numbers))
+    
+    return np.array([''.join(row) for row in zip(*columns)], dtype=object)
+
+def make_solutions(inputs, numbers=None):
+    """
+    Format all rows of a DataFrame as a single string of SOLUTION blocks.
+
+    See `format_solutions` for parameters.
+
+    Returns
+    -------
+    str : all SOLUTION blocks.
+    """
+    return '\n'.join(format_solutions(inputs, numbers=numbers).tolist())
+
+def iter_solutions(inputs, chunksize, numbers=None):
+    """
+    Format a DataFrame as SOLUTION blocks, yielding strings of `chunksize` solutions at a time.
+
+    See `format_solutions` for parameters.
+
+    Returns
+    -------
+    generator : yields strings of SOLUTION blocks.
+    """
+    if numbers is None:
+        numbers = inputs.index
+    for start in range(0, len(inputs), chunksize):
+        yield make_solutions(inputs.iloc[start:start + chunksize], numbers=numbers[start:start + chunksize])
+
 def select_inputs(inputs, column_lookup):
     selected = inputs.loc[:, column_lookup.keys()]
     selected.columns = [column_lookup[c] for c in selected.columns]
@@ -115,6 +182,30 @@ def phreeqfind():
         raise ValueError(f'Cannot find libiphreeqc at the default loation ({phreeq_path}). Have you installed it, or do you have a custom install? If so, please specify `phreeq_path` manually to point at the correct location.')
 
 
+def resolve_database_path(database=None):
+    """
+    Return the full path to a PHREEQC database.
+
+    Parameters
+    ----------
+    database : str
+        Name of an included database (e.g. 'pitzer'), or 
+        a complete path to a different phreeqc database. Defaults to pitzer.
+
+    Returns
+    -------
+    str : path to the database file.
+    """
+    if database is None:
+        database = get_database_path()
+    elif not os.path.exists(database):
+        database = get_database_path(database)
+
+    if not os.path.exists(database):
+        raise ValueError(f"Can't phreeqc database: {database}\n   Please check that it exists.")
+    
+    return database
+
 def run_phreeqc(input_string, database=None, phreeq_path=None, output_file=False, parse_output=True):
     """
     Run input string in phreeqc with specified database.
@@ -139,12 +230,7 @@ def run_phreeqc(input_string, database=None, phreeq_path=None, output_file=False
 
     if database is None:
         print('No database specified  :  using pitzer')
-        database = get_database_path()
-    elif not os.path.exists(database):
-        database = os.path.join(get_database_path(database))
-
-    if not os.path.exists(database):
-        raise ValueError(f"Can't phreeqc database: {database}\n   Please check that it exists.")
+    database = resolve_database_path(database)
 
     phreeqc = phreeqc_mod.IPhreeqc(phreeq_path)
     phreeqc.load_database(database)
@@ -154,31 +240,94 @@ def run_phreeqc(input_string, database=None, phreeq_path=None, output_file=False
     out = phreeqc.get_selected_output_array()
     phreeqc.destroy_iphreeqc()
     if parse_output:
-        return output_parser(out).replace(-999.999, np.nan)
+        return output_parser(out)
     else:
         return out
 
-def output_parser(phreeqc_out):
-    out = pd.DataFrame(phreeqc_out[1:], columns=phreeqc_out[0])
+# patterns for classifying selected output columns
+output_interpreter = {
+    'molality (mol/kgw)': re.compile(r'm_(.*)\(mol/kgw\)'),
+    'total (mol/kgw)': re.compile(r'^([^m_]+)\(mol/kgw\)'),
+    'log10(activity)': re.compile('la_(.*)'),
+    'log10(saturation)': re.compile('si_(.*)')
+}
 
-    interpreter = {
-        'molality (mol/kgw)': re.compile('m_(.*)\(mol/kgw\)'),
-        'total (mol/kgw)': re.compile('^([^m_]+)\(mol/kgw\)'),
-        'log10(activity)': re.compile('la_(.*)'),
-        'log10(saturation)': re.compile('si_(.*)')
-    }
+@functools.lru_cache(maxsize=256)
+def output_columns(header):
+    """
+    Classify selected output column names into a (type, name) MultiIndex.
 
+    Cached on the header, which is identical for every run with the same
+    SELECTED_OUTPUT.
+
+    Parameters
+    ----------
+    header : tuple
+        Column names of the selected output.
+
+    Returns
+    -------
+    pandas.MultiIndex
+    """
     index = []
-    for c in out.columns:
+    for c in header:
         done = False
-        for s, pat in interpreter.items():
+        for s, pat in output_interpreter.items():
             if pat.match(c):
                 cclean = pat.findall(c)[0]
                 index.append((s, cclean))
                 done = True
         if not done:
             index.append(('general', c))
-        
-    out.columns = pd.MultiIndex.from_tuples(index)
     
-    return out
\ No newline at end of file
+    return pd.MultiIndex.from_tuples(index)
+
+def output_parser(phreeqc_out, missing_value=-999.999):
+    """
+    Parse a raw selected output array into a DataFrame with MultiIndex columns.
+
+    Parameters
+    ----------
+    phreeqc_out : list
+        As returned by `get_selected_output_array`, with the header in the first row.
+    missing_value : float
+        The value PHREEQC uses for missing outputs, which is replaced with NaN.
+        If None, no replacement is made.
+
+    Returns
+    -------
+    pandas.DataFrame : columns whose values are all integers (e.g. 'sim', 'soln')
+    are int64, text columns (e.g. 'state') are strings, and the rest are float64.
+    """
+    header = tuple(phreeqc_out[0])
+    columns = output_columns(header)
+    rows = phreeqc_out[1:]
+
+    if len(rows) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # non-numeric columns (e.g. 'state') are identified from the first row
+    text = [i for i, v in enumerate(rows[0]) if isinstance(v, str)]
+    numeric = [i for i in range(len(header)) if i not in text]
+
+    if text:
+        getter = operator.itemgetter(*numeric)
+        block = np.array([getter(r) for r in rows], dtype=np.float64).reshape(len(rows), len(numeric))
+    else:
+        block = np.array(rows, dtype=np.float64)
+    if missing_value is not None:
+        block[block == missing_value] = np.nan
+
+    # keep integer columns (e.g. 'sim', 'soln', 'step') as integers
+    ints = {j for j, i in enumerate(numeric) if isinstance(rows[0][i], int) and all(isinstance(r[i], int) for r in rows)}
+    if ints:
+        # build from columns, which pandas consolidates into one block per dtype
+        arrays = {j: block[:, j].astype(np.int64) if j in ints else block[:, j] for j in range(len(numeric))}
+        out = pd.DataFrame(arrays)
+        out.columns = columns[numeric]
+    else:
+        out = pd.DataFrame(block, columns=columns[numeric], copy=False)
+    for i in text:
+        out.insert(i, columns[i], [r[i] for r in rows])
+    
+    return out
@@ -4,20 +4,31 @@ Monte-Carlo uncertainties in phreeqc solution chemistry.
 
 # from .phreeq import input_str, run_phreeqc
 # import uncertainties as un
+import warnings
 import numpy as np
 import pandas as pd
 from scipy import stats
+from scipy.stats import qmc
 import multiprocessing as mp
+from functools import partial
 from tqdm.autonotebook import tqdm
-from .io import run_phreeqc
+from .io import run_phreeqc, output_columns, format_solutions
+from .multiprocessing import init_worker, get_worker_engine, get_worker_parser, collect_worker_stats
+from .store import MCStore
+from .scheduler import cost_features, run_scheduled
+from .transport import SharedFrame, SHARE_OUTPUTS, start_tracker, imap_shared
 from . import istarmap
 
 # Monte Carlo functions
 
-def mc_input_dfs(df, N=1000, uncertainty_id='_std', distribution=None, outputs=None, db=None):
-    if distribution is None:
-        distribution = stats.norm
+def split_uncertainty_columns(df, uncertainty_id='_std'):
+    """
+    Sort the columns of df into those with and without uncertainties.
 
+    Returns
+    -------
+    tuple : (all value columns, columns without uncertainties, columns with uncertainties)
+    """
     cols = [c for c in df.columns if uncertainty_id not in c]  # all column names
     uncs = [c for c in df.columns if uncertainty_id in c]  # all uncertainty columns
     col_no_unc = [c for c in cols if c + uncertainty_id not in uncs]  # all columns without uncertainties
@@ -25,31 +36,754 @@ def mc_input_dfs(df, N=1000, uncertainty_id='_std', distribution=None, outputs=N
 
     if not col_with_unc:
         raise ValueError(f"None of your columns contain uncertainties (have '{uncertainty_id}' in the name).")
+    
+    return cols, col_no_unc, col_with_unc
+
+def mc_uniforms(n, N, d, sampler='random', random_state=None):
+    """
+    Draw uniform (0, 1) points for Monte Carlo sampling.
+
+    Parameters
+    ----------
+    n : int
+        Number of samples. Each sample gets an independent set of points.
+    N : int
+        Number of iterations (points) per sample.
+    d : int
+        Number of dimensions (perturbed inputs).
+    sampler : str or callable
+        'random' : independent uniform draws.
+        'lhs' : Latin hypercube.
+        'sobol' : scrambled Sobol sequence. Use a power of 2 for N: otherwise the
+        sequence is truncated and loses its balance properties. (scipy's warning
+        about this is not shown, as it would be repeated for every sample.)
+        'halton' : scrambled Halton sequence.
+        A callable with signature `sampler(n, N, d, rng)` returning an 
+        (n, N, d) array of points in (0, 1).
+    random_state : int or numpy.random.Generator
+        Seed or generator.
+
+    Returns
+    -------
+    array : of shape (n, N, d)
+    """
+    rng = np.random.default_rng(random_state)
+
+    if callable(sampler):
+        u = sampler(n, N, d, rng)
+    elif sampler == 'random':
+        u = rng.random((n, N, d))
+    elif sampler == 'lhs':
+        # an independent random permutation of the N strata for every sample and dimension
+        strata = rng.random((n, N, d)).argsort(axis=1)
+        u = (strata + rng.random((n, N, d))) / N
+    elif sampler in ('sobol', 'halton'):
+        engine = {'sobol': qmc.Sobol, 'halton': qmc.Halton}[sampler]
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            u = np.stack([engine(d, scramble=True, seed=rng).random(N) for _ in range(n)]) if n > 0 else np.empty((0, N, d))
+        # scipy warns for every sample (e.g. if N is not a power of 2 for Sobol), so pass each warning on once
+        for message, category in dict.fromkeys((str(w.message), w.category) for w in caught):
+            warnings.warn(message, category, stacklevel=2)
+    else:
+        raise ValueError(f"sampler must be one of 'random', 'lhs', 'sobol', 'halton' or a callable, not '{sampler}'.")
+    
+    # avoid infinite values at the edges of the inverse CDF
+    return np.clip(u, 1e-12, 1 - 1e-12)
+
+def _to_matrix(m, columns):
+    """
+    Expand a (partial) correlation or covariance DataFrame to a full matrix over `columns`.
+
+    Columns missing from `m` are uncorrelated, with unit variance.
+    """
+    if not isinstance(m, pd.DataFrame):
+        m = np.asarray(m, dtype=np.float64)
+        if m.shape != (len(columns), len(columns)):
+            raise ValueError(f'Correlation/covariance arrays must be of shape ({len(columns)}, {len(columns)}), ordered as {columns}.')
+        return m, np.ones(len(columns), dtype=bool)
+    
+    out = np.eye(len(columns))
+    present = np.array([c in m.index for c in columns])
+    idx = [c for c in columns if c in m.index]
+    pos = np.flatnonzero(present)
+    out[np.ix_(pos, pos)] = m.loc[idx, idx].values
+    return out, present
+
+def correlation_matrices(df, columns, correlation=None, covariance=None):
+    """
+    Build the correlation matrix of the perturbed inputs of every sample.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The input samples.
+    columns : list
+        The perturbed input columns.
+    correlation, covariance : DataFrame, array or dict
+        A single matrix applied to all samples, or a dict of {sample index: matrix}
+        for per-sample matrices (samples not in the dict are uncorrelated). 
+        DataFrames are labelled by input name, and inputs that are not 
+        included are uncorrelated. Arrays must be ordered as `columns`.
+        If `covariance` is given, the standard deviations on its diagonal
+        replace the uncertainty columns of the inputs it contains.
+
+    Returns
+    -------
+    tuple : (R, std), where R is an array of shape (sample, input, input), and
+    std is an array of shape (sample, input) of standard deviations from the
+    covariance, which is NaN where no covariance was given.
+    """
+    if correlation is not None and covariance is not None:
+        raise ValueError('Specify either `correlation` or `covariance`, not both.')
+    spec = covariance if covariance is not None else correlation
+    
+    n, d = len(df), len(columns)
+
+    def expand(m):
+        m, present = _to_matrix(m, columns)
+        sd = np.full(d, np.nan)
+        if covariance is not None:
+            sd_all = np.sqrt(np.diag(m))
+            m = m / np.outer(sd_all, sd_all)
+            sd[present] = sd_all[present]
+        return m, sd
+
+    if spec is not None and not isinstance(spec, dict):
+        # a single matrix for all samples
+        m, sd = expand(spec)
+        return np.broadcast_to(m, (n, d, d)).copy(), np.broadcast_to(sd, (n, d)).copy()
+
+    R = np.broadcast_to(np.eye(d), (n, d, d)).copy()
+    std = np.full((n, d), np.nan)
+    for label, m in (spec or {}).items():
+        # all rows with this label, which may be repeated
+        rows = df.index.get_indexer_for([label])
+        rows = rows[rows >= 0]
+        if len(rows) == 0:
+            continue
+        R[rows], std[rows] = expand(m)
+    
+    return R, std
+
+def correlation_factors(R):
+    """
+    Factor a stack of correlation matrices, so that `L @ L.T == R`.
+
+    Uses a (vectorized) Cholesky decomposition, falling back to an eigendecomposition
+    for positive semi-definite matrices, such as perfectly correlated inputs.
+    """
+    try:
+        return np.linalg.cholesky(R)
+    except np.linalg.LinAlgError:
+        w, v = np.linalg.eigh(R)
+        if np.any(w < -1e-8):
+            raise ValueError('Correlation matrices must be positive semi-definite.')
+        return v * np.sqrt(np.clip(w, 0, None))[:, np.newaxis, :]
+
+def mc_input_arrays(df, N=1000, uncertainty_id='_std', distribution=None, random_state=None, sampler='random', correlation=None, covariance=None):
+    """
+    Draw Monte Carlo inputs for all samples in a single vectorized call.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Solution compositions, with uncertainties in columns 
+        ending with `uncertainty_id`.
+    N : int
+        Number of Monte Carlo iterations per sample.
+    distribution : scipy.stats distribution
+        Parameterised by (loc, scale). Defaults to `stats.norm`.
+    random_state : int or numpy.random.Generator
+        Seed or generator for the random draws.
+    sampler : str or callable
+        How points are sampled (see `mc_uniforms`). If 'random', inputs are 
+        drawn directly from `distribution`. Otherwise, points from the sampler are 
+        mapped through the inverse CDF (`ppf`) of `distribution`.
+    correlation, covariance : DataFrame, array or dict
+        Correlation or covariance between perturbed inputs, for all samples 
+        or per sample (see `correlation_matrices`). Correlated standard normal 
+        draws are generated with a Cholesky factor and mapped to `distribution`.
+        For example, inputs that all scale with salinity (e.g. from `chemistry.SW`)
+        can be given a correlation of 1.
+
+    Returns
+    -------
+    tuple : (numeric_columns, values, constants)
+        `values` is a float64 array of shape (sample, iteration, numeric_column),
+        so `values[i]` is a view of the inputs of sample i. `constants` is a 
+        DataFrame of the non-numeric columns (e.g. 'units'), which are not perturbed.
+    """
+    if distribution is None:
+        distribution = stats.norm
+    rng = np.random.default_rng(random_state)
 
-    for i, r in df.iterrows():
-        out = pd.DataFrame(columns=cols, index=range(N))
+    cols, col_no_unc, col_with_unc = split_uncertainty_columns(df, uncertainty_id)
+    
+    numeric = df.loc[:, cols].select_dtypes(include='number').columns.tolist()
+    constants = df.loc[:, [c for c in cols if c not in numeric]]
+    
+    values = np.empty((len(df), N, len(numeric)), dtype=np.float64)
+    values[:] = df.loc[:, numeric].values.astype(np.float64)[:, np.newaxis, :]
 
-        for c in col_no_unc:
-            out.loc[:, c] = r.loc[c]
-        for c in col_with_unc:
-            if all(~np.isnan([r.loc[c], r.loc[c + uncertainty_id]])):
-                out.loc[:, c] = distribution(r.loc[c], r.loc[c + uncertainty_id]).rvs(N)
+    perturb = [c for c in col_with_unc if c in numeric]
+    if perturb:
+        loc = df.loc[:, perturb].values.astype(np.float64)
+        scale = df.loc[:, [c + uncertainty_id for c in perturb]].values.astype(np.float64)
+        valid = ~np.isnan(loc) & ~np.isnan(scale)
+        
+        correlated = correlation is not None or covariance is not None
+        if correlated:
+            R, std = correlation_matrices(df, perturb, correlation=correlation, covariance=covariance)
+            scale = np.where(np.isnan(std), scale, std)
+            valid = ~np.isnan(loc) & ~np.isnan(scale)
+        
+        loc3 = loc[:, np.newaxis, :]
+        scale3 = np.where(valid, scale, 1.)[:, np.newaxis, :]
+        size = (len(df), N, len(perturb))
+        if correlated:
+            if sampler == 'random':
+                z = rng.standard_normal(size)
+            else:
+                z = stats.norm.ppf(mc_uniforms(*size, sampler=sampler, random_state=rng))
+            z = np.einsum('sij,snj->sni', correlation_factors(R), z)
+            if distribution is stats.norm:
+                draws = loc3 + scale3 * z
             else:
-                out.loc[:, c] = r.loc[c]
+                draws = distribution.ppf(stats.norm.cdf(z), loc=loc3, scale=scale3)
+        elif sampler == 'random':
+            draws = distribution.rvs(loc=loc3, scale=scale3, size=size, random_state=rng)
+        else:
+            u = mc_uniforms(*size, sampler=sampler, random_state=rng)
+            draws = distribution.ppf(u, loc=loc3, scale=scale3)
+        
+        ind = [numeric.index(c) for c in perturb]
+        values[:, :, ind] = np.where(valid[:, np.newaxis, :], draws, loc[:, np.newaxis, :])
+    
+    return numeric, values, constants
+
+def mc_input_dfs(df, N=1000, uncertainty_id='_std', distribution=None, outputs=None, db=None, random_state=None, block_size=1000, sampler='random', correlation=None, covariance=None):
+    """
+    Generate Monte Carlo input DataFrames for each sample in df.
 
-        yield out, outputs, db
+    Inputs are drawn in blocks of `block_size` samples by `mc_input_arrays`, and
+    each yielded DataFrame is built on a view of the drawn array. See
+    `mc_input_arrays` for `distribution`, `random_state`, `sampler`, 
+    `correlation` and `covariance`.
+
+    Returns
+    -------
+    generator : yields (inputs, outputs, db) for each sample.
+    """
+    rng = np.random.default_rng(random_state)
+    
+    for start in range(0, len(df), block_size):
+        block = df.iloc[start:start + block_size]
+        numeric, values, constants = mc_input_arrays(block, N=N, uncertainty_id=uncertainty_id, 
+                                                     distribution=distribution, random_state=rng, sampler=sampler,
+                                                     correlation=correlation, covariance=covariance)
+        for i in range(len(block)):
+            out = pd.DataFrame(values[i], columns=numeric, copy=False)
+            for c in constants.columns:
+                out[c] = constants.iloc[i][c]
+            
+            yield out, outputs, db
 
 def concat_mc_results(mc_dfs):
     for i,o in enumerate(mc_dfs):
         o.index = pd.MultiIndex.from_product([[i], o.index], names=['sample', 'iteration'])
     return pd.concat(mc_dfs)
 
-def make_and_run_input(inputs, outputs, db):
-    input_str = db.generate_SOLUTIONS(inputs) + '\n' + outputs + '\nEND'
-    out = run_phreeqc(input_str, parse_output=True, database=db.name)
+def make_input_string(inputs, outputs, db=None):
+    if db is None:
+        return '\n'.join(format_solutions(inputs).tolist()) + '\n' + outputs + '\nEND'
+    return '\n'.join(db.generate_SOLUTIONS(inputs)) + '\n' + outputs + '\nEND'
+
+def make_and_run_input(inputs, outputs, db, phreeq_path=None, reduce=None):
+    if outputs is None:
+        outputs = db.outputs
+    input_str = make_input_string(inputs, outputs, db)
+    out = run_phreeqc(input_str, parse_output=True, database=db.path, phreeq_path=phreeq_path)
+    if reduce is not None:
+        out = reduce(out)
+    return out
+
+def make_and_run_input_persistent(inputs, outputs, db, reduce=None):
+    """
+    Runs inputs on the persistent engine of the current pool worker.
+
+    If `reduce` is given, it is applied to the output DataFrame before it is returned.
+    If `outputs` is None, the SELECTED_OUTPUT of the worker's database handle is used.
+
+    Returns
+    -------
+    tuple : (output, engine stats dict)
+    """
+    engine = get_worker_engine()
+    if outputs is None:
+        outputs = get_worker_parser().outputs
+    out = engine.run(make_input_string(inputs, outputs, db))
+    if reduce is not None:
+        out = reduce(out)
+    return out, engine.stats()
+
+def make_and_run_input_shared(inputs, outputs, reduce=None):
+    """
+    Runs inputs held in shared memory on the persistent engine of the current pool worker.
+
+    Parameters
+    ----------
+    inputs : SharedFrame
+        The inputs. Their shared memory block is freed once read.
+    outputs : str
+        SELECTED_OUTPUT string. If None, that of the worker's database handle is used.
+
+    Returns
+    -------
+    tuple : (SharedFrame of the output, or the reduced output if `reduce` is given, engine stats dict)
+    """
+    engine = get_worker_engine()
+    if outputs is None:
+        outputs = get_worker_parser().outputs
+    out = engine.run(make_input_string(inputs.read(unlink=True), outputs))
+    if reduce is not None:
+        return reduce(out), engine.stats()
+    if SHARE_OUTPUTS:
+        return SharedFrame(out), engine.stats()
+    return out, engine.stats()
+
+def summarise_mc_sample(out, quantiles, covariance=False):
+    """
+    Reduce the Monte Carlo iterations of one sample to summary statistics.
+
+    Parameters
+    ----------
+    out : pandas.DataFrame
+        The output of all iterations of one sample.
+    quantiles : list
+        Quantiles to calculate.
+    covariance : bool or list
+        If True, the covariance between all numeric outputs is calculated. If 
+        a list of columns, the covariance between those columns is calculated.
+
+    Returns
+    -------
+    dict : containing 'quantiles', 'mean', 'std' and 'N', and 'cov' if requested.
+    """
+    out = out.select_dtypes(include='number')
+    summary = {
+        'quantiles': out.quantile(quantiles),
+        'mean': out.mean(),
+        'std': out.std(),
+        'N': len(out),
+    }
+    if covariance is not False:
+        if covariance is not True:
+            out = out.loc[:, covariance]
+        summary['cov'] = out.cov()
+    return summary
+
+def concat_mc_summaries(summaries, quantiles):
+    """
+    Combine the summaries of each sample produced by `summarise_mc_sample`.
+
+    Returns
+    -------
+    dict : containing
+        'quantiles' : DataFrame indexed by (sample, quantile), as returned by `calc_mc_quantiles`.
+        'mean', 'std' : DataFrames indexed by sample.
+        'N' : Series of the number of iterations in each sample.
+        'cov' : DataFrame indexed by (sample, output), if covariance was requested.
+    """
+    n = len(summaries)
+    out = {}
+    
+    q = pd.concat([s['quantiles'] for s in summaries])
+    q.index = pd.MultiIndex.from_product([range(n), quantiles], names=['sample', 'quantile'])
+    out['quantiles'] = q
+
+    out['mean'] = pd.DataFrame([s['mean'] for s in summaries], index=pd.RangeIndex(n, name='sample'))
+    out['std'] = pd.DataFrame([s['std'] for s in summaries], index=pd.RangeIndex(n, name='sample'))
+    out['N'] = pd.Series([s['N'] for s in summaries], index=pd.RangeIndex(n, name='sample'), name='N')
+
+    if 'cov' in summaries[0]:
+        out['cov'] = pd.concat([s['cov'] for s in summaries], keys=range(n), names=['sample'])
+    
     return out
 
-def run_mc(inputs, N, database, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std', distribution=None):
+def checkpoint_entropy(store, N, n_samples, random_state=None, resume=False):
+    """
+    Returns the root seed of a checkpointed Monte Carlo run, recording it in the store.
+
+    When resuming, the seed recorded in the store is used, after checking that the
+    run is consistent with it. Otherwise, the store must be empty.
+
+    Parameters
+    ----------
+    store : MCStore
+        The store of the run.
+    N, n_samples : int
+        Number of iterations per sample, and number of samples.
+    random_state : int
+        The requested seed. If None, a new seed is drawn, unless resuming.
+    resume : bool
+        Whether the run continues an earlier run in `store`.
+
+    Returns
+    -------
+    int : entropy for `numpy.random.SeedSequence`.
+    """
+    if resume and 'entropy' in store.meta:
+        if store.meta['N'] != N or store.meta['n_samples'] != n_samples:
+            raise ValueError(f"Cannot resume: the store contains a run of {store.meta['n_samples']} samples "
+                             f"with N={store.meta['N']}, not {n_samples} samples with N={N}.")
+        if random_state is not None and np.random.SeedSequence(random_state).entropy != store.meta['entropy']:
+            raise ValueError('Cannot resume: `random_state` differs from the seed of the run in the store.')
+        return store.meta['entropy']
+    if resume and len(store):
+        raise ValueError('Cannot resume: the store has no record of the seed of the run that produced it.')
+    if not resume and len(store):
+        raise ValueError(f'The store already contains {len(store)} samples. Use `resume=True` to continue '
+                         'the run that produced them, or an empty store.')
+
+    entropy = np.random.SeedSequence(random_state).entropy
+    store.update_meta(entropy=entropy, N=N, n_samples=n_samples)
+    return entropy
+
+def run_mc(inputs, N, database, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std', distribution=None, iphreeqc_path=None, persistent_workers=True, return_stats=False, processes=None, store=None, aggregate=False, CI=0.95, quantiles=None, covariance=False, sampler='random', random_state=None, input_correlation=None, input_covariance=None, resume=False, schedule='ordered', transport='pickle'):
+    """
+    Propagate input uncertainties through PHREEQC by Monte Carlo.
+
+    Parameters
+    ----------
+    inputs : pandas.DataFrame
+        Solution compositions, with uncertainties in columns 
+        ending with `uncertainty_id`.
+    N : int
+        Number of Monte Carlo iterations per sample.
+    database : datParser
+        The database to use.
+    iphreeqc_path : str
+        Path to the iphreeqc shared library.
+    persistent_workers : bool
+        If True, each worker process creates one IPhreeqc engine and loads
+        the database when it starts, and re-uses it for every sample.
+        If False, a new IPhreeqc instance is created for every sample.
+    return_stats : bool
+        If True (and persistent_workers is True), also return a DataFrame of
+        per-worker start-up and solve time counters.
+    processes : int
+        Number of worker processes. Defaults to `mp.cpu_count()`.
+    store : str or MCStore
+        If given, the results of each sample are written to this on-disk store
+        as they arrive, instead of being collected in memory. Each sample is then
+        given its own random stream derived from `random_state`, and the seed is
+        recorded in the store, so that any sample can be re-run identically.
+        Unless resuming, the store must be empty.
+    resume : bool
+        If True, samples already in `store` are skipped, and the remaining samples
+        are run with the seed recorded in the store. The completed store is identical
+        to that of an uninterrupted run.
+    schedule : str
+        'ordered' : samples are run in input order, one per task.
+        'cost' : samples are run most expensive first, in chunks of adaptive size, with
+        costs estimated from their composition and corrected by observed run times (see
+        `scheduler.run_scheduled`). Each sample is given its own random stream, as
+        when a `store` is used, so results do not depend on the order samples run in.
+    transport : str
+        How inputs and outputs are passed to and from persistent workers.
+        'pickle' : DataFrames are pickled through the pool's pipes.
+        'shared' : numeric blocks are passed in `multiprocessing.shared_memory`,
+        and only small handles are pickled (see `transport.SharedFrame`).
+        In both cases the database parser is sent to each worker once, when it starts.
+    aggregate : bool
+        If True, each worker reduces the iterations of a sample to summary 
+        statistics (see `summarise_mc_sample`), and only these are returned.
+    CI, quantiles : float, list
+        The confidence interval or quantiles calculated if `aggregate` is True,
+        as in `calc_mc_quantiles`.
+    covariance : bool or list
+        If `aggregate` is True, also calculate the covariance between all 
+        (True) or a list of output columns.
+    sampler : str or callable
+        How inputs are sampled: 'random', 'lhs', 'sobol', 'halton' or a 
+        callable (see `mc_uniforms`).
+    random_state : int
+        Seed for reproducible inputs.
+    input_correlation, input_covariance : DataFrame, array or dict
+        Correlation or covariance between the uncertainties of the inputs, either
+        for all samples or as a dict of {sample index: matrix} (see `correlation_matrices`).
+
+    Returns
+    -------
+    pandas.DataFrame : indexed by (sample, iteration), or the MCStore if `store` 
+    is given, or a dict of summaries (see `concat_mc_summaries`) if `aggregate`.
+    If `return_stats`, a tuple of (results, worker_stats).
+    """
+    inputs = database.check_inputs(inputs, uncertainty_id=uncertainty_id)
+    if targets is None:
+        targets = database.get_target_elements(inputs, drop_OH=drop_OH_species, uncertainty_id=uncertainty_id)
+    outputs = database.generate_SELECTED_OUTPUT(targets, totals=output_totals,
+                                                molalities=output_molalities, activities=output_activities,
+                                                phases=output_phases, phase_targets=phase_targets, 
+                                                allow_HCO=allow_HCO_phases)
+    if processes is None:
+        processes = mp.cpu_count()
+    
+    if schedule not in ['ordered', 'cost']:
+        raise ValueError(f"schedule must be 'ordered' or 'cost', not '{schedule}'.")
+    if resume and store is None:
+        raise ValueError('`resume` requires a `store`.')
+    if transport not in ['pickle', 'shared']:
+        raise ValueError(f"transport must be 'pickle' or 'shared', not '{transport}'.")
+    if transport == 'shared' and not persistent_workers:
+        raise ValueError("transport='shared' requires `persistent_workers`.")
+    if aggregate and store is not None:
+        raise ValueError('Results cannot be written to a store when `aggregate` is True.')
+    # the store is only opened once the arguments are known to be valid
+    if store is not None and not isinstance(store, MCStore):
+        store = MCStore(store)
+
+    # persistent workers are sent a handle on the database, with the SELECTED_OUTPUT, once
+    # when they start, so that tasks carry only the samples
+    handle = database.handle(outputs)
+    task_db = None if persistent_workers else handle
+
+    samples = range(len(inputs))
+    if store is None and schedule == 'ordered':
+        tasks = mc_input_dfs(df=inputs, N=N, uncertainty_id=uncertainty_id, 
+                             distribution=distribution, outputs=None, db=task_db,
+                             sampler=sampler, random_state=random_state, 
+                             correlation=input_correlation, covariance=input_covariance)
+    else:
+        # seed each sample separately, so that any subset of samples (e.g. those
+        # remaining after an interruption) can be run on their own, in any order
+        if store is None:
+            entropy = np.random.SeedSequence(random_state).entropy
+        else:
+            entropy = checkpoint_entropy(store, N, len(inputs), random_state, resume)
+        seeds = np.random.SeedSequence(entropy).spawn(len(inputs))
+        if resume:
+            samples = [i for i in samples if i not in store]
+
+        def sample_task(i):
+            task = next(mc_input_dfs(df=inputs.iloc[[i]], N=N, uncertainty_id=uncertainty_id,
+                                     distribution=distribution, outputs=None, db=task_db,
+                                     sampler=sampler, random_state=seeds[i],
+                                     correlation=input_correlation, covariance=input_covariance))
+            if transport == 'shared':
+                return SharedFrame(task[0]), None
+            return task
+        tasks = (sample_task(i) for i in samples)
+    if aggregate:
+        if quantiles is None:
+            quantiles = [0.5 - CI / 2, 0.5, 0.5 + CI / 2]
+        reduce = partial(summarise_mc_sample, quantiles=quantiles, covariance=covariance)
+    else:
+        reduce = None
+
+    if transport == 'shared':
+        if store is None and schedule == 'ordered':
+            tasks = ((SharedFrame(df), None) for df, _, _ in tasks)
+        start_tracker()
+        pool = mp.Pool(processes, initializer=init_worker, initargs=(database.path, iphreeqc_path, handle))
+        func = partial(make_and_run_input_shared, reduce=reduce)
+    elif persistent_workers:
+        pool = mp.Pool(processes, initializer=init_worker, initargs=(database.path, iphreeqc_path, handle))
+        func = partial(make_and_run_input_persistent, reduce=reduce)
+    else:
+        pool = mp.Pool(processes)
+        func = partial(make_and_run_input, phreeq_path=iphreeqc_path, reduce=reduce)
+
+    out = {}
+    stats = []
+    with pool:
+        shared = None
+        if schedule == 'cost':
+            features = cost_features(inputs.iloc[list(samples)].set_axis(list(samples)), database, N)
+            results = run_scheduled(pool, func, {i: partial(sample_task, i) for i in samples}, features, processes)
+        elif transport == 'shared':
+            # bound the number of blocks in shared memory, and free them if the run stops early
+            shared = imap_shared(pool, func, tasks, window=2 * processes)
+            results = zip(samples, shared)
+        else:
+            results = zip(samples, pool.istarmap(func, tasks))
+
+        try:
+            for i, r in tqdm(results, total=len(samples), desc='Running MC'):
+                if persistent_workers:
+                    r, s = r
+                    stats.append(s)
+                if isinstance(r, SharedFrame):
+                    r = r.read(unlink=True)
+                if store is None:
+                    out[i] = r
+                else:
+                    store.append(i, r)  # write each sample as it arrives, rather than holding all in memory
+        finally:
+            if shared is not None:
+                shared.close()
+    out = [out[i] for i in sorted(out)]
+    
+    if persistent_workers:
+        stats = collect_worker_stats(stats)
+    else:
+        stats = None
+
+    if aggregate:
+        results = concat_mc_summaries(out, quantiles)
+    elif store is None:
+        results = concat_mc_results(out)
+    else:
+        results = store
+
+    if return_stats:
+        return results, stats
+    return results
+
+def parse_output_targets(targets):
+    """
+    Convert output names to output column tuples.
+
+    Parameters
+    ----------
+    targets : list
+        Either column tuples (e.g. ('general', 'pH')) or PHREEQC selected
+        output names (e.g. 'pH', 'm_B(OH)4-(mol/kgw)', 'si_Calcite').
+
+    Returns
+    -------
+    list : of column tuples.
+    """
+    return [t if isinstance(t, tuple) else output_columns((t,))[0] for t in targets]
+
+def mc_converged(out, targets, tol, criterion='sem', quantiles=None, previous=None):
+    """
+    Check whether the Monte Carlo estimates of a sample have converged.
+
+    Parameters
+    ----------
+    out : pandas.DataFrame
+        All iterations of the sample so far.
+    targets : list
+        Column tuples that must converge.
+    tol : float or dict
+        Absolute tolerance, or a dict of {target: tolerance}.
+    criterion : str
+        'sem' : the standard error of the mean of every target is below tol.
+        'quantiles' : no quantile of any target has changed by more than tol 
+        since the `previous` estimate.
+    quantiles : list
+        Quantiles used by the 'quantiles' criterion.
+    previous : pandas.DataFrame
+        The quantile estimates from the previous check.
+
+    Returns
+    -------
+    tuple : (converged, estimates), where estimates are the current quantiles 
+    (criterion='quantiles') or standard errors (criterion='sem').
+    """
+    if isinstance(tol, dict):
+        tol = pd.Series([tol[t] for t in targets], index=pd.MultiIndex.from_tuples(targets))
+    
+    values = out.loc[:, targets].astype(np.float64)
+    if criterion == 'sem':
+        est = values.std() / np.sqrt(values.notnull().sum())
+        return bool(np.all(est <= tol)), est
+    elif criterion == 'quantiles':
+        est = values.quantile(quantiles)
+        if previous is None:
+            return False, est
+        return bool(np.all((est - previous).abs() <= tol)), est
+    else:
+        raise ValueError(f"criterion must be 'sem' or 'quantiles', not '{criterion}'.")
+
+def run_adaptive_sample(sample, outputs, db, targets, tol, batch_size=100, min_N=200, max_N=10000, criterion='sem', 
+                        quantiles=None, uncertainty_id='_std', distribution=None, random_state=None, sampler='random', correlation=None, covariance=None):
+    """
+    Run Monte Carlo iterations of a single sample in batches until the targets converge.
+
+    Runs on the persistent engine of the current pool worker.
+
+    Parameters
+    ----------
+    sample : pandas.DataFrame
+        A single row of inputs, including uncertainties.
+    
+    See `run_mc_adaptive` for other parameters.
+
+    Returns
+    -------
+    tuple : (output DataFrame, converged, engine stats dict)
+    """
+    engine = get_worker_engine()
+    rng = np.random.default_rng(random_state)
+
+    results = []
+    n = 0
+    converged = False
+    previous = None
+    while n < max_N:
+        inputs, _, _ = next(mc_input_dfs(sample, N=min(batch_size, max_N - n), uncertainty_id=uncertainty_id, 
+                                         distribution=distribution, random_state=rng, sampler=sampler,
+                                         correlation=correlation, covariance=covariance))
+        results.append(engine.run(make_input_string(inputs, outputs, db)))
+        n += len(inputs)
+        if n < min_N:
+            continue
+        
+        out = pd.concat(results, ignore_index=True)
+        results = [out]
+        converged, previous = mc_converged(out, targets, tol, criterion=criterion, quantiles=quantiles, previous=previous)
+        if converged:
+            break
+    
+    return pd.concat(results, ignore_index=True), converged, engine.stats()
+
+def run_mc_adaptive(inputs, database, convergence_targets, tol, batch_size=100, min_N=200, max_N=10000, criterion='sem', CI=0.95, quantiles=None,
+                    targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, 
+                    allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std', distribution=None, iphreeqc_path=None, 
+                    processes=None, random_state=None, return_stats=False, sampler='random', input_correlation=None, input_covariance=None):
+    """
+    Monte Carlo with the number of iterations of each sample chosen by convergence.
+
+    Iterations are run in batches of `batch_size`. After at least `min_N` iterations,
+    a sample stops once the estimates of all `convergence_targets` have converged
+    (see `mc_converged`), or when it reaches `max_N` iterations.
+
+    Parameters
+    ----------
+    inputs : pandas.DataFrame
+        Solution compositions, with uncertainties in columns 
+        ending with `uncertainty_id`.
+    database : datParser
+        The database to use.
+    convergence_targets : list
+        Outputs that must converge, as column tuples (e.g. ('general', 'pH')) or
+        PHREEQC selected output names (e.g. 'pH', 'm_B(OH)4-(mol/kgw)', 'si_Calcite').
+    tol : float or dict
+        Absolute tolerance, or a dict of {target: tolerance}.
+    batch_size, min_N, max_N : int
+        Iterations per batch, and the minimum and maximum iterations per sample.
+    criterion : str
+        'sem' (standard error of the mean) or 'quantiles' (change in quantiles between batches).
+    CI, quantiles : float, list
+        Quantiles used by the 'quantiles' criterion, as in `calc_mc_quantiles`.
+    random_state : int
+        Seed. Each sample is given an independent stream derived from it.
+    sampler : str or callable
+        How inputs are sampled in each batch (see `mc_uniforms`).
+    input_correlation, input_covariance : DataFrame, array or dict
+        Correlation or covariance between input uncertainties (see `run_mc`).
+    
+    Other parameters are as in `run_mc`.
+
+    Returns
+    -------
+    tuple : (results, report), where results is indexed by (sample, iteration) and
+    report is a DataFrame of the number of iterations and convergence of each sample.
+    If `return_stats`, worker stats are returned as a third item.
+    """
     inputs = database.check_inputs(inputs, uncertainty_id=uncertainty_id)
     if targets is None:
         targets = database.get_target_elements(inputs, drop_OH=drop_OH_species, uncertainty_id=uncertainty_id)
@@ -57,18 +791,41 @@ def run_mc(inputs, N, database, targets=None, output_totals=True, output_molalit
                                                 molalities=output_molalities, activities=output_activities,
                                                 phases=output_phases, phase_targets=phase_targets, 
                                                 allow_HCO=allow_HCO_phases)
-    with mp.Pool(mp.cpu_count()) as pool:
-        out = list(tqdm(pool.istarmap(make_and_run_input, mc_input_dfs(df=inputs, N=N, uncertainty_id=uncertainty_id, 
-                                                                       distribution=distribution, outputs=outputs, db=database)), total=len(inputs), desc='Running MC'))
+    if processes is None:
+        processes = mp.cpu_count()
+    if quantiles is None:
+        quantiles = [0.5 - CI / 2, 0.5, 0.5 + CI / 2]
+    
+    convergence_targets = parse_output_targets(convergence_targets)
+    if isinstance(tol, dict):
+        tol = dict(zip(parse_output_targets(tol.keys()), tol.values()))
+    
+    seeds = np.random.SeedSequence(random_state).spawn(len(inputs))
+    tasks = ((inputs.iloc[[i]], outputs, None, seeds[i]) for i in range(len(inputs)))
+    func = partial(_run_adaptive_task, targets=convergence_targets, tol=tol, batch_size=batch_size, min_N=min_N, max_N=max_N, 
+                   criterion=criterion, quantiles=quantiles, uncertainty_id=uncertainty_id, distribution=distribution, sampler=sampler,
+                   correlation=input_correlation, covariance=input_covariance)
+
+    with mp.Pool(processes, initializer=init_worker, initargs=(database.path, iphreeqc_path, database.handle())) as pool:
+        res = list(tqdm(pool.istarmap(func, tasks), total=len(inputs), desc='Running adaptive MC'))
+    
+    results = concat_mc_results([r[0] for r in res])
+    report = pd.DataFrame({'N': [len(r[0]) for r in res], 'converged': [r[1] for r in res]}, 
+                          index=pd.RangeIndex(len(res), name='sample'))
+    
+    if return_stats:
+        return results, report, collect_worker_stats([r[2] for r in res])
+    return results, report
 
-    return concat_mc_results(out)
+def _run_adaptive_task(sample, outputs, db, seed, **kwargs):
+    return run_adaptive_sample(sample, outputs, db, random_state=seed, **kwargs)
 
 def calc_mc_quantiles(mc_output, CI=0.95, quantiles=None):
     if quantiles is None:
         quantiles = [0.5 - CI / 2, 0.5, 0.5 + CI / 2]
     out = []
     for i, g in mc_output.groupby(level=0):
-        out.append(g.quantile(quantiles))
+        out.append(g.quantile(quantiles, numeric_only=True))
     N = len(out)
     out = pd.concat(out)
     out.index = pd.MultiIndex.from_product([range(N), quantiles], names=['sample', 'quantile'])
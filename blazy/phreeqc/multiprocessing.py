@@ -1,10 +1,113 @@
+import pandas as pd
+import multiprocessing as mp
+from tqdm.autonotebook import tqdm
+
 from .io import run_phreeqc
+from .engine import PhreeqcEngine, run_batched, merge_selected_output
+
+# the persistent engine and database parser held by each pool worker process
+_worker_engine = None
+_worker_parser = None
+
+def init_worker(database, iphreeqc_path=None, parser=None):
+    """
+    Pool initializer: creates one PhreeqcEngine per worker process.
+
+    Use as `mp.Pool(n, initializer=init_worker, initargs=(database, iphreeqc_path, parser))`.
+    The database is loaded once when the worker starts, and the engine is
+    re-used for every task the worker receives. If given, `parser` (usually a
+    `DatabaseHandle`) is sent to each worker once, rather than with every task.
+    """
+    global _worker_engine, _worker_parser
+    _worker_engine = PhreeqcEngine(database, iphreeqc_path)
+    _worker_parser = parser
+
+def get_worker_engine():
+    """
+    Returns the PhreeqcEngine of the current worker process.
+    """
+    if _worker_engine is None:
+        raise RuntimeError('No engine in this process. Create the pool with `initializer=init_worker`.')
+    return _worker_engine
+
+def get_worker_parser():
+    """
+    Returns the parser or DatabaseHandle sent to the current worker process by `init_worker`.
+    """
+    if _worker_parser is None:
+        raise RuntimeError('No parser in this process. Pass `parser` to `init_worker`.')
+    return _worker_parser
+
+def collect_worker_stats(stats):
+    """
+    Reduce per-task engine stats to the latest counters for each worker.
+
+    Parameters
+    ----------
+    stats : iterable of dicts
+        As returned by `PhreeqcEngine.stats()`. Counters are cumulative,
+        so the last entry for each pid is kept.
+
+    Returns
+    -------
+    pandas.DataFrame : with one row per worker process, indexed by pid.
+    """
+    latest = {}
+    for s in stats:
+        if s['n_runs'] >= latest.get(s['pid'], {'n_runs': -1})['n_runs']:
+            latest[s['pid']] = s
+    return pd.DataFrame(list(latest.values())).set_index('pid').sort_index()
 
 def df_starchunking(df, chunksize, outputs, db):
-    """Splits df into chunks, drops data of original df inplace"""
-    while len(df):
-        # Return df chunk
-        yield df.iloc[:chunksize].copy(), outputs, db
-        # Delete data in place because it is no longer needed
-        df.drop(df.index[:chunksize], inplace=True)
+    """Splits df into chunks of `chunksize` rows, by position, so duplicate index labels are kept.
+
+    Pass a `DatabaseHandle` as `db`, rather than a datParser, to keep each chunk small to pickle."""
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize], outputs, db
+
+def run_parallel(database, inputs, outputs, n_jobs=None, chunksize=1000, max_chars=None, iphreeqc_path=None):
+    """
+    Run many solutions in chunks across a pool of processes with persistent engines.
+
+    Parameters
+    ----------
+    database : str
+        Name or path of the database.
+    inputs : pandas.DataFrame
+        Checked solution inputs, one solution per row.
+    outputs : str
+        SELECTED_OUTPUT string.
+    n_jobs : int
+        Number of worker processes. If None or -1, the number of CPUs is used.
+    chunksize : int
+        Number of solutions sent to a worker at once, and the maximum number of
+        solutions in each `run_string` call.
+    max_chars : int
+        Maximum length of the SOLUTION text in each `run_string` call.
+    iphreeqc_path : str
+        Path to the iphreeqc shared library.
+
+    Returns
+    -------
+    pandas.DataFrame : parsed output, indexed by the index of `inputs`.
+    """
+    if len(inputs) == 0:
+        # nothing to run, so don't start a pool
+        return merge_selected_output([], index=inputs.index)
+    if n_jobs is None or n_jobs == -1:
+        n_jobs = mp.cpu_count()
+    n_chunks = -(-len(inputs) // chunksize)
+
+    out = []
+    with mp.Pool(n_jobs, initializer=init_worker, initargs=(database, iphreeqc_path)) as pool:
+        tasks = ((df, outputs, max_chars) for df, outputs, _ in df_starchunking(inputs, chunksize, outputs, None))
+        for i, o in enumerate(tqdm(pool.imap(_run_parallel_task, tasks), total=n_chunks, desc='Running solutions')):
+            if ('general', 'soln') in o.columns:
+                # number solutions by position in the whole input, as in `run_batched`
+                o[('general', 'soln')] += i * chunksize
+            out.append(o)
+    return pd.concat(out)
 
+def _run_parallel_task(args):
+    inputs, outputs, max_chars = args
+    return run_batched(get_worker_engine(), inputs, outputs, chunksize=len(inputs), max_chars=max_chars)
@@ -12,7 +12,8 @@ import pkg_resources as pkgrs
 
 from ..helpers import issubset, get_database_header
 from ..chemistry import get_elements, valid_elements
-from .io import make_solution
+from .io import format_solutions
+from . import dbcache
 
 # make sure warnings are always shown
 warnings.filterwarnings('always', category=UserWarning)
@@ -39,6 +40,16 @@ def reacsplit(reac):
     sides = reac.split('=')
     return [[c for c in side.split(' ') if c not in ['+', '']] for side in sides]
 
+def invert_index(index):
+    """
+    Inverts a {key: set of elements} dict into {element: set of keys}.
+    """
+    out = {}
+    for k, els in index.items():
+        for e in els:
+            out.setdefault(e, set()).add(k)
+    return out
+
 def remove_stoich(species):
     """
     Removes stoichiometric multipler from the start of a species name.
@@ -71,7 +82,7 @@ class datParser:
     database : path
         Name of database or path to phreeqc database.
     """
-    def __init__(self, database, silent=False):
+    def __init__(self, database, silent=False, use_cache=None):
         """
         Class for loading and parsing PHREEQC databases.
 
@@ -82,16 +93,32 @@ class datParser:
         ----------
         database : path
             Name of database or path to phreeqc database.
+        use_cache : bool
+            If True, the parsed database is loaded from the on-disk
+            cache if it is up to date, and stored there if not. If None,
+            the cache is used only if the `BLAZY_CACHE_DIR` environment
+            variable is set (see `dbcache`).
         """
         self.path = self._database_path_handler(database)
         if not silent:
             print('Using ' + get_database_header(self.path))
         self.name = os.path.basename(database).replace('.dat','')
         
-        self.db = self.load(self.path)
-        self.sections = self.find_sections()
+        self._parsed = {}
+        if use_cache is None:
+            use_cache = dbcache.enabled()
+        cached = dbcache.load_cached(self.path) if use_cache else None
+        if cached is not None:
+            self._load_from_cache(cached)
+        else:
+            self.db = self.load(self.path)
+            self.sections = self.find_sections()
 
-        self.get_SOLUTION_MASTER_SPECIES()
+            self.get_SOLUTION_MASTER_SPECIES()
+            self.build_index()
+            
+            if use_cache:
+                self.save_cache()
 
         self._exempt_inputs = [
             'temperature', 'temp', 
@@ -101,6 +128,89 @@ class datParser:
             'density', 'unit', 'units'
         ]
 
+    def build_index(self):
+        """
+        Build inverted indices of the elements in each solution species and phase.
+
+        Creates four dictionaries:
+        _species_elements : {species: frozenset of elements}, for all SOLUTION_SPECIES reaction products
+        _element_species : {element: set of species containing that element}
+        _phase_elements : {phase: frozenset of elements in the phase formula}
+        _element_phases : {element: set of phases containing that element}
+
+        Returns
+        -------
+        None
+        """
+        srm = re.compile('^[0-9]+')  # pattern for removing stoichiometric multiplier from species
+        self._species_elements = {}
+        for s in self.parse_SOLUTION_SPECIES(remove_comments=True):
+            _, prod = reacsplit(s)  # only look at reaction products
+            for p in prod:
+                sp = srm.sub('', p)
+                if sp != '':
+                    self._species_elements[sp] = frozenset(get_elements(p))
+        
+        self._phase_elements = {}
+        if 'PHASES' in self.sections:
+            # keep the parsed entries, so that `get_PHASES` doesn't parse them again
+            self._parsed['PHASES'] = self.parse_PHASES(remove_comments=True)
+            for p, lines in self._parsed['PHASES'].items():
+                if lines:
+                    self._phase_elements[p] = frozenset(get_elements(reacsplit(lines[0])[0][0]))
+        
+        self._element_species = invert_index(self._species_elements)
+        self._element_phases = invert_index(self._phase_elements)
+
+    @property
+    def hash(self):
+        """
+        The sha1 hash of the database file.
+        """
+        if not hasattr(self, '_hash'):
+            self._hash = dbcache.file_hash(self.path)
+        return self._hash
+
+    def _load_from_cache(self, cached):
+        """
+        Set the parsed database contents from a cache entry.
+        """
+        self.db = cached['db']
+        self._hash = cached['hash']
+        self.sections = cached['sections']
+        self.master_species_table = cached['master_species_table']
+        self.element_2_master = cached['element_2_master']
+        self.element_2_master_nocharge = cached['element_2_master_nocharge']
+        self.master_2_element = cached['master_2_element']
+        self.master_nocharge_2_element = cached['master_nocharge_2_element']
+        self._parsed = cached['parsed']
+        self._species_elements = cached['species_elements']
+        self._phase_elements = cached['phase_elements']
+        self._element_species = invert_index(self._species_elements)
+        self._element_phases = invert_index(self._phase_elements)
+
+    def save_cache(self):
+        """
+        Store the parsed database in the on-disk cache.
+        """
+        parsed = {'SOLUTION_SPECIES': self.parse_SOLUTION_SPECIES()}
+        if 'PHASES' in self.sections:
+            parsed['PHASES'] = self.parse_PHASES()
+
+        dbcache.save_cached(self.path, {
+            'db': self.db,
+            'sections': self.sections,
+            'master_species_table': self.master_species_table,
+            'element_2_master': self.element_2_master,
+            'element_2_master_nocharge': self.element_2_master_nocharge,
+            'master_2_element': self.master_2_element,
+            'master_nocharge_2_element': self.master_nocharge_2_element,
+            'parsed': parsed,
+            'species_elements': self._species_elements,
+            'phase_elements': self._phase_elements,
+        })
+        self._parsed = parsed
+
     def _database_path_handler(self, database):
         """
         Convenience function for checking/getting the path to the database.
@@ -231,6 +341,8 @@ class datParser:
         
         """
         section = 'SOLUTION_SPECIES'
+        if remove_comments and section in self._parsed:
+            return dict(self._parsed[section])
         out = {}
         entry = None
         for p in self.get_section(section=section, remove_comments=remove_comments):
@@ -337,31 +449,22 @@ class datParser:
         set : calculated species in the database containing the target elements.
         """
         targets = self._targets_handler(targets=targets)
-        solution_species = self.parse_SOLUTION_SPECIES(remove_comments=True)
-        srm = re.compile('^[0-9]+')  # pattern for removing stoichiometric multiplier from speciues
-        out_species = set()
 
         if targets is None:
-            for s in solution_species.keys():
-                _, prod = reacsplit(s)  # only look at reaction products
-                for p in prod:
-                    out_species.add(srm.sub('', p))
-        else:
-            for s in solution_species.keys():
-                _, prod = reacsplit(s)  # only look at reaction products
-                for p in prod:
-                    pels = get_elements(p)
-                    if include_foreign:
-                        if pels.intersection(targets):
-                            out_species.add(srm.sub('', p))
-                    else:
-                        if issubset(pels, targets) and pels.intersection(targets):
-                            out_species.add(srm.sub('', p))
+            return set(self._species_elements)
+
+        # all species containing any of the targets
+        out_species = set()
+        for t in targets:
+            out_species.update(self._element_species.get(t, ()))
+
+        if not include_foreign:
+            out_species = {sp for sp in out_species if self._species_elements[sp] <= targets}
 
         # this isn't quite right - should get all possible species given solution compositions,
         # *then* filter by targets. At the moment returns species containing irrelevant elements.
         
-        return out_species.difference(['', None])
+        return out_species
 
     def parse_PHASES(self, remove_comments=True):
         """
@@ -383,6 +486,8 @@ class datParser:
         
         """
         section = 'PHASES'
+        if remove_comments and section in self._parsed:
+            return dict(self._parsed[section])
         out = {}
         entry = None
         for p in self.get_section(section=section, remove_comments=remove_comments):
@@ -410,31 +515,25 @@ class datParser:
         -------
         set : calculated phases in the database containing the target elements.
         """
-        
-        self.phases = self.parse_PHASES()
-
         targets = self._targets_handler(targets)
 
         if targets is None:
+            # parsed once, then kept
+            if not hasattr(self, 'phases'):
+                self.phases = self.parse_PHASES()
             return self.phases
 
-        possible_phases = set()
-        for p, i in self.phases.items():
-            for t in targets:
-                phase_formula = reacsplit(i[0])[0][0]
-                if t in phase_formula:
-                    possible_phases.add((p, phase_formula))
-        
         if allow_HCO:
             ftargets = targets.union(['H', 'C', 'O'])
-        out_phases = set()
-        
-        for p, f in possible_phases:
-            if issubset(get_elements(f), ftargets):
-                out_phases.add(p)
+        else:
+            ftargets = targets
 
+        # all phases containing any of the targets, and only targets (+ HCO) 
+        out_phases = set()
+        for t in targets:
+            out_phases.update(self._element_phases.get(t, ()))
         
-        return out_phases
+        return {p for p in out_phases if self._phase_elements[p] <= ftargets}
     
     def list_valid_phases(self):
         """
@@ -632,10 +731,18 @@ class datParser:
     def generate_SOLUTIONS(self, inputs):
         inputs = self.check_inputs(inputs)
 
-        solutions = []
-        for n, v in inputs.iterrows():
-            solutions.append(make_solution(v, n))
-        return solutions
+        return format_solutions(inputs).tolist()
+
+    def handle(self, outputs=None):
+        """
+        Returns a compact, picklable `DatabaseHandle` on this database, for sending to worker processes.
+
+        Parameters
+        ----------
+        outputs : str
+            SELECTED_OUTPUT string to carry with the handle.
+        """
+        return DatabaseHandle(self, outputs=outputs)
     
     def add_EQUILIBRIUM_PHASES(self, phases):
         """
@@ -652,7 +759,7 @@ class datParser:
 
         valid_phases = []
         for p in phases:
-            if p[0] not in self.get_PHASES():
+            if p[0] not in self._phase_elements:
                 print(f'{p[0]} is not in the databse; removed.')
             else:
                 valid_phases.append(map(str,p))
@@ -710,4 +817,66 @@ class datParser:
                     inp.append(sol + '\n' + eq + '\n' + output  + '\nEND')
                 self.input_str = '\n'.join(inp)
     
-        return self.input_str
\ No newline at end of file
+        return self.input_str
+
+class DatabaseHandle:
+    """
+    A compact, immutable stand-in for a `datParser` in worker processes.
+
+    A datParser holds every line of its database, so pickling one costs
+    megabytes for large databases. A handle holds only the path, hash,
+    master species maps and (optionally) a SELECTED_OUTPUT string, which
+    are enough to check inputs and format SOLUTION blocks. Anything else is
+    delegated to a full datParser, which is loaded lazily (from the database
+    cache, if it is enabled) the first time it is needed.
+
+    Parameters
+    ----------
+    parser : datParser
+        The database to make a handle on.
+    outputs : str
+        SELECTED_OUTPUT string to carry with the handle.
+    """
+    _fields = ('path', 'name', 'hash', 'outputs', 'element_2_master', 'master_2_element',
+               'master_nocharge_2_element', '_exempt_inputs')
+
+    def __init__(self, parser, outputs=None):
+        for k in self._fields:
+            object.__setattr__(self, k, getattr(parser, k, None))
+        object.__setattr__(self, 'outputs', outputs)
+        object.__setattr__(self, '_parser', parser)
+
+    check_inputs = datParser.check_inputs
+    generate_SOLUTIONS = datParser.generate_SOLUTIONS
+
+    @property
+    def parser(self):
+        """
+        The full datParser, loaded from the database cache on first use.
+        """
+        if self._parser is None:
+            parser = datParser(self.path, silent=True)
+            if parser.hash != self.hash:
+                raise ValueError(f'The database {self.path} has changed since this handle was made.')
+            object.__setattr__(self, '_parser', parser)
+        return self._parser
+
+    def __getattr__(self, name):
+        # only called for attributes the handle does not have
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.parser, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DatabaseHandle is immutable.')
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self._fields}
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            object.__setattr__(self, k, v)
+        object.__setattr__(self, '_parser', None)
+
+    def __repr__(self):
+        return f'DatabaseHandle({self.name}, {self.hash[:12]})'
@@ -0,0 +1,238 @@
+"""
+Content-addressed cache of PHREEQC results for individual solutions.
+
+Each solution is keyed on the hash of the database, its SOLUTION block
+(without the solution number) and the SELECTED_OUTPUT string, so identical
+compositions are only ever solved once.
+"""
+
+import pickle
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from .io import format_solutions, output_parser
+from .engine import run_batched, merge_selected_output
+
+def solution_keys(solutions, outputs, database_hash):
+    """
+    Returns the cache key of each SOLUTION block.
+
+    Parameters
+    ----------
+    solutions : list
+        SOLUTION block strings. The first line ('SOLUTION n') is ignored.
+    outputs : str
+        SELECTED_OUTPUT string.
+    database_hash : str
+        Hash of the database file.
+
+    Returns
+    -------
+    list : of hex digest strings.
+    """
+    prefix = hashlib.sha1(f'{database_hash}\0{outputs}\0'.encode())
+    keys = []
+    for s in solutions:
+        h = prefix.copy()
+        h.update(s.split('\n', 1)[-1].encode())
+        keys.append(h.hexdigest())
+    return keys
+
+class ResultCache:
+    """
+    Two-tier cache of selected output rows.
+
+    Parameters
+    ----------
+    max_entries : int
+        Maximum number of results held in memory. The least recently used
+        results are evicted first.
+    path : str
+        Path of an optional sqlite file used as a persistent second tier.
+        Results evicted from memory remain available there.
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of solutions found / not found in the cache.
+    disk_hits : int
+        Number of hits served by the on-disk tier.
+    duplicates : int
+        Number of solutions that were duplicates of another in the same run,
+        and were solved only once.
+    evictions : int
+        Number of results evicted from memory.
+    """
+    def __init__(self, max_entries=100000, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self._memory = OrderedDict()
+        self._headers = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.duplicates = 0
+        self.evictions = 0
+
+        if self.path is not None:
+            with self._connect() as con:
+                con.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def get_many(self, keys):
+        """
+        Look up results.
+
+        Parameters
+        ----------
+        keys : list
+            Cache keys.
+
+        Returns
+        -------
+        dict : {key: (header, row)} for the keys found in the cache.
+        """
+        found = {}
+        with self._lock:
+            for k in keys:
+                if k in self._memory:
+                    self._memory.move_to_end(k)
+                    found[k] = self._memory[k]
+
+        missing = [k for k in keys if k not in found]
+        if missing and self.path is not None:
+            with self._connect() as con:
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = con.execute(f"SELECT key, value FROM results WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                    for k, v in rows:
+                        found[k] = pickle.loads(v)
+                        self.disk_hits += 1
+                        self._remember(k, found[k])
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """
+        Store results.
+
+        Parameters
+        ----------
+        items : dict
+            {key: (header, row)}
+        """
+        for k, v in items.items():
+            self._remember(k, v)
+        if self.path is not None:
+            with self._connect() as con:
+                con.executemany('INSERT OR REPLACE INTO results VALUES (?, ?)',
+                                [(k, pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)) for k, v in items.items()])
+
+    def _remember(self, key, value):
+        header, row = value
+        # share header tuples between entries
+        value = (self._headers.setdefault(header, header), row)
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Returns a dict of the cache statistics.
+        """
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._memory),
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk_hits': self.disk_hits,
+            'duplicates': self.duplicates,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else np.nan,
+        }
+
+    def clear(self, disk=True):
+        """
+        Remove all results from memory and, if `disk`, from the on-disk tier.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._headers.clear()
+        if disk and self.path is not None:
+            with self._connect() as con:
+                con.execute('DELETE FROM results')
+
+def run_cached(engine, inputs, outputs, cache, database_hash, chunksize=1000, max_chars=None):
+    """
+    Run solutions on an engine, skipping those whose results are already cached.
+
+    Duplicate solutions within `inputs` are solved once, and their results
+    copied to every row.
+
+    Parameters
+    ----------
+    engine : PhreeqcEngine
+        The engine that solves uncached solutions.
+    inputs : pandas.DataFrame
+        Checked solution inputs, one solution per row.
+    outputs : str
+        SELECTED_OUTPUT string.
+    cache : ResultCache
+        The cache.
+    database_hash : str
+        Hash of the database file used by `engine`.
+    chunksize, max_chars : int
+        Batch sizes for `run_batched`.
+
+    Returns
+    -------
+    pandas.DataFrame : parsed output, indexed by the index of `inputs`.
+    """
+    if len(inputs) == 0:
+        return merge_selected_output([], index=inputs.index)
+
+    solutions = format_solutions(inputs, numbers=np.arange(1, len(inputs) + 1)).tolist()
+    keys = solution_keys(solutions, outputs, database_hash)
+
+    unique = list(OrderedDict.fromkeys(keys))
+    cache.duplicates += len(keys) - len(unique)
+    found = cache.get_many(unique)
+
+    todo = [k for k in unique if k not in found]
+    if todo:
+        first = {}
+        for i, k in enumerate(keys):
+            first.setdefault(k, i)
+        rows = [first[k] for k in todo]
+        raw = run_batched(engine, inputs.iloc[rows], outputs, chunksize=chunksize, max_chars=max_chars, parse_output=False)
+        header = tuple(raw[0])
+        new = {k: (header, tuple(r)) for k, r in zip(todo, raw[1:])}
+        cache.put_many(new)
+        found.update(new)
+
+    header = found[keys[0]][0]
+    isoln = header.index('soln')
+    rows = []
+    for i, k in enumerate(keys):
+        r = list(found[k][1])
+        r[isoln] = i + 1
+        rows.append(r)
+
+    out = output_parser([list(header)] + rows)
+    out.index = inputs.index
+    return out
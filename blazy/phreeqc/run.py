@@ -8,16 +8,27 @@ import phreeqpy.iphreeqc.phreeqc_dll as phreeqc_mod
 from .parser import datParser
 from ..chemistry import get_elements
 from .io import phreeqfind, output_parser
-from .montecarlo import run_mc
+from .montecarlo import run_mc, run_mc_adaptive
+from .engine import EnginePool, run_batched, run_threaded
+from .multiprocessing import run_parallel
+from .resultcache import ResultCache, run_cached
+from .surrogate import run_mc_surrogate
+from .sensitivity import jacobian
+from .sweep import sweep
+from .table import SpeciationTable
+from .aio import AsyncRunner
 
 class iphreeqc:
-    def __init__(self, database='pitzer', iphreeqc_path=None):
+    def __init__(self, database='pitzer', iphreeqc_path=None, max_engines=None, max_engine_runs=None):
         self.db = datParser(database)
         
         if iphreeqc_path is None:
             iphreeqc_path = phreeqfind()
         self.iphreeqc_path = iphreeqc_path
 
+        # keep-alive engines shared by batched and threaded runs
+        self.engines = EnginePool(self.iphreeqc_path, max_engines=max_engines, max_runs=max_engine_runs)
+
         self.make_PHREEQC_input = self.db.make_PHREEQC_input
 
         # if isinstance(solutions, dict):
@@ -48,32 +59,309 @@ class iphreeqc:
 
         self._run(input_string)
 
-        out = output_parser(self._getoutput()).replace(-999.999, np.nan)
+        out = output_parser(self._getoutput())
 
         if not keepalive:
             self._kill()
         
         return out
 
+    def close(self):
+        """
+        Destroy all IPhreeqc instances held by this object.
+        """
+        if hasattr(self, 'phreeqc'):
+            self._kill()
+        if hasattr(self, '_async_runner'):
+            self._async_runner.close()
+            del self._async_runner
+        self.engines.close()
+        self.engines = EnginePool(self.iphreeqc_path, max_engines=self.engines.max_engines, max_runs=self.engines.max_runs)
+
     def change_database(self, database):
         self.db = datParser(database)
         if hasattr(self, 'phreeqc'):
             self._load_database()
+        if hasattr(self, '_async_runner'):
+            # the runner's process pool holds engines for the old database
+            self._async_runner.close()
+            del self._async_runner
 
     # def make_input_string(self, inputs, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std'):
         # return self.db.make_PHREEQC_input(inputs=inputs, targets=targets, output_totals=output_totals, output_molalities=output_molalities, output_activities=output_activities, output_phases=output_phases, phase_targets=phase_targets, allow_HCO_phases=allow_HCO_phases, drop_OH_species=drop_OH_species, uncertainty_id=uncertainty_id)
     
-    def run(self, inputs, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, equilibrium_phases=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std'):
+    def _selected_output(self, inputs, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std'):
+        if targets is None:
+            targets = self.db.get_target_elements(inputs, drop_OH=drop_OH_species, uncertainty_id=uncertainty_id)
+        return self.db.generate_SELECTED_OUTPUT(targets, totals=output_totals, molalities=output_molalities, activities=output_activities, phases=output_phases, phase_targets=phase_targets, allow_HCO=allow_HCO_phases)
+
+    def run(self, inputs, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, equilibrium_phases=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std', chunksize=None, max_chars=None, cache=None, threads=None, n_jobs=None):
+        """
+        Calculate the speciation of solutions.
+
+        Parameters
+        ----------
+        inputs : pandas.DataFrame or dict
+            Solution compositions, one solution per row.
+        chunksize, max_chars : int
+            If given, solutions are run in batches of at most `chunksize` solutions
+            or `max_chars` characters of SOLUTION input per `run_string` call.
+        cache : ResultCache or bool
+            If given, solutions whose results are in the cache are not re-run, and
+            duplicate solutions are only run once. If True, a cache held by this
+            object is used.
+        threads : int
+            If given, batches are run in parallel on this many keep-alive engines
+            from `self.engines`, using a pool of threads. Ignored if `cache` is given.
+        n_jobs : int
+            If given, solutions are run in chunks of `chunksize` across this many worker
+            processes, each with a persistent engine. -1 uses all CPUs. Progress is shown
+            with tqdm. Takes precedence over `threads`, and is ignored if `cache` is given.
+        equilibrium_phases : list of tuples
+            Phases to equilibrate each solution with (see `datParser.add_EQUILIBRIUM_PHASES`).
+            All solutions are then run in a single input string, and
+            `chunksize`, `max_chars`, `cache`, `threads` and `n_jobs` are ignored.
+        
+        Other parameters are as in `datParser.make_PHREEQC_input`.
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
         inputs = self.db.check_inputs(inputs, uncertainty_id=uncertainty_id)
         
         inputs = inputs.loc[:, [c for c in inputs.columns if uncertainty_id not in c]]
 
+        if (chunksize is not None or max_chars is not None or cache is not None or threads is not None or n_jobs is not None) and equilibrium_phases is None:
+            # run solutions in batches of controlled size on a single engine
+            outputs = self._selected_output(inputs, targets=targets, output_totals=output_totals, output_molalities=output_molalities, output_activities=output_activities, output_phases=output_phases, phase_targets=phase_targets, allow_HCO_phases=allow_HCO_phases, drop_OH_species=drop_OH_species, uncertainty_id=uncertainty_id)
+            
+            if cache is True:
+                if not hasattr(self, 'result_cache'):
+                    self.result_cache = ResultCache()
+                cache = self.result_cache
+
+            if n_jobs is not None and cache is None:
+                if chunksize is None:
+                    chunksize = 1000
+                return run_parallel(self.db.path, inputs, outputs, n_jobs=n_jobs, chunksize=chunksize, max_chars=max_chars, iphreeqc_path=self.iphreeqc_path)
+            if threads is not None and cache is None:
+                if chunksize is None and max_chars is None:
+                    chunksize = -(-len(inputs) // threads)
+                return run_threaded(self.engines, self.db.path, inputs, outputs, threads=threads, chunksize=chunksize, max_chars=max_chars)
+            if chunksize is None and max_chars is None:
+                chunksize = len(inputs)
+
+            with self.engines.engine(self.db.path) as engine:
+                if cache is None:
+                    return run_batched(engine, inputs, outputs, chunksize=chunksize, max_chars=max_chars)
+                return run_cached(engine, inputs, outputs, cache, self.db.hash, chunksize=chunksize, max_chars=max_chars)
+
         self._input_string = self.db.make_PHREEQC_input(inputs=inputs, targets=targets, output_totals=output_totals, output_molalities=output_molalities, output_activities=output_activities, output_phases=output_phases, phase_targets=phase_targets, allow_HCO_phases=allow_HCO_phases, drop_OH_species=drop_OH_species, uncertainty_id=uncertainty_id, equilibrium_phases=equilibrium_phases)
         
         return self.run_phreeqc(self._input_string)
 
-    def run_mc(self, inputs, N, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std', distribution=None):
-        return run_mc(inputs=inputs, N=N, database=self.db, targets=targets, output_totals=output_totals, output_molalities=output_molalities, output_activities=output_activities, output_phases=output_phases, phase_targets=phase_targets, allow_HCO_phases=allow_HCO_phases, drop_OH_species=drop_OH_species, uncertainty_id=uncertainty_id)
+    @property
+    def async_runner(self):
+        """
+        The `AsyncRunner` used by `arun`, `astream`, `arun_mc` and `astream_mc`.
+
+        Created on first use, with engines from `self.engines`. Assign an
+        `AsyncRunner` to change the number of threads, processes or pending jobs.
+        """
+        if not hasattr(self, '_async_runner'):
+            self._async_runner = AsyncRunner(self.db, iphreeqc_path=self.iphreeqc_path, engines=self.engines)
+        return self._async_runner
+
+    @async_runner.setter
+    def async_runner(self, runner):
+        self._async_runner = runner
+
+    def _async_inputs(self, inputs, uncertainty_id='_std', keep_uncertainties=False, **kwargs):
+        inputs = self.db.check_inputs(inputs, uncertainty_id=uncertainty_id)
+        if not keep_uncertainties:
+            inputs = inputs.loc[:, [c for c in inputs.columns if uncertainty_id not in c]]
+        return inputs, self._selected_output(inputs, uncertainty_id=uncertainty_id, **kwargs)
+
+    async def arun(self, inputs, chunksize=100, timeout=None, uncertainty_id='_std', **kwargs):
+        """
+        Calculate the speciation of solutions without blocking the event loop.
+
+        Solutions are run in jobs of `chunksize` on the long-lived thread executor of
+        `async_runner`. Cancelling the call cancels jobs that have not started.
+
+        Parameters
+        ----------
+        inputs : pandas.DataFrame or dict
+            Solution compositions, one solution per row.
+        chunksize : int
+            Number of solutions per job.
+        timeout : float
+            Seconds before the request is cancelled, raising `asyncio.TimeoutError`.
+
+        Other parameters are as in `run`.
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        inputs, outputs = self._async_inputs(inputs, uncertainty_id=uncertainty_id, **kwargs)
+        return await self.async_runner.run(inputs, outputs, chunksize=chunksize, timeout=timeout)
+
+    async def astream(self, inputs, chunksize=100, uncertainty_id='_std', **kwargs):
+        """
+        As `arun`, but yields the output of each chunk of solutions as it completes.
+
+        Returns
+        -------
+        async generator : yields (chunk number, DataFrame).
+        """
+        inputs, outputs = self._async_inputs(inputs, uncertainty_id=uncertainty_id, **kwargs)
+        async for chunk in self.async_runner.stream(inputs, outputs, chunksize=chunksize):
+            yield chunk
+
+    async def arun_mc(self, inputs, N, timeout=None, uncertainty_id='_std', distribution=None, random_state=None, sampler='random', input_correlation=None, input_covariance=None, **kwargs):
+        """
+        Monte Carlo speciation without blocking the event loop.
+
+        Samples run on the persistent process pool of `async_runner`, which is started
+        by the first request and shared by all later ones.
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds before the request is cancelled, raising `asyncio.TimeoutError`.
+
+        Other parameters are as in `run_mc`.
+
+        Returns
+        -------
+        pandas.DataFrame : indexed by (sample, iteration).
+        """
+        inputs, outputs = self._async_inputs(inputs, uncertainty_id=uncertainty_id, keep_uncertainties=True, **kwargs)
+        return await self.async_runner.run_mc(inputs, N, outputs, timeout=timeout, uncertainty_id=uncertainty_id, distribution=distribution,
+                                              random_state=random_state, sampler=sampler, correlation=input_correlation, covariance=input_covariance)
+
+    async def astream_mc(self, inputs, N, uncertainty_id='_std', distribution=None, random_state=None, sampler='random', input_correlation=None, input_covariance=None, **kwargs):
+        """
+        As `arun_mc`, but yields the results of each sample as it completes.
+
+        Returns
+        -------
+        async generator : yields (sample number, DataFrame of N iterations).
+        """
+        inputs, outputs = self._async_inputs(inputs, uncertainty_id=uncertainty_id, keep_uncertainties=True, **kwargs)
+        async for sample in self.async_runner.stream_mc(inputs, N, outputs, uncertainty_id=uncertainty_id, distribution=distribution,
+                                                        random_state=random_state, sampler=sampler, correlation=input_correlation, covariance=input_covariance):
+            yield sample
+
+    def jacobian(self, inputs, wrt, rel_step=1e-3, abs_step=None, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std', processes=None, chunksize=1000, as_frame=False):
+        """
+        Derivatives of outputs with respect to inputs, by central finite differences.
+
+        Parameters
+        ----------
+        inputs : pandas.DataFrame or dict
+            Solution compositions, one solution per row.
+        wrt : list
+            The inputs to differentiate with respect to, e.g. ['Alkalinity', 'Ca', 'temperature'].
+        rel_step : float
+            Step relative to the value of each input.
+        abs_step : float or dict
+            Absolute step of all inputs, or a dict of {input: step}. Overrides `rel_step`.
+        processes : int
+            If given, solutions are run on a pool of this many processes.
+            Otherwise, all solutions are run on a single engine.
+        chunksize : int
+            Number of solutions per `run_string` call.
+        as_frame : bool
+            If True, return a DataFrame indexed by (sample, output) with a column
+            for each input in `wrt`.
+        
+        Other parameters are as in `datParser.make_PHREEQC_input`.
+
+        Returns
+        -------
+        tuple : (jacobian, columns), where jacobian is an array of shape
+        (sample, output, input) and columns are the output columns.
+        """
+        inputs = self.db.check_inputs(inputs, uncertainty_id=uncertainty_id)
+        inputs = inputs.loc[:, [c for c in inputs.columns if uncertainty_id not in c]]
+        wrt = [w if w in inputs.columns else self.db.master_2_element.get(w, w) for w in wrt]
+        missing = [w for w in wrt if w not in inputs.columns]
+        if missing:
+            raise ValueError(f'Cannot differentiate with respect to {missing}, which are not in the inputs.')
+
+        if targets is None:
+            targets = self.db.get_target_elements(inputs, drop_OH=drop_OH_species, uncertainty_id=uncertainty_id)
+        outputs = self.db.generate_SELECTED_OUTPUT(targets, totals=output_totals, molalities=output_molalities, activities=output_activities, phases=output_phases, phase_targets=phase_targets, allow_HCO=allow_HCO_phases)
+
+        J, columns = jacobian(inputs, outputs, wrt, self.db.path, iphreeqc_path=self.iphreeqc_path, rel_step=rel_step, abs_step=abs_step, processes=processes, chunksize=chunksize)
+        if as_frame:
+            index = pd.MultiIndex.from_tuples([(i, *c) for i in inputs.index for c in columns], names=['sample', 'kind', 'output'])
+            return pd.DataFrame(J.reshape(-1, len(wrt)), index=index, columns=wrt)
+        return J, columns
+
+    def sweep(self, axes, base=None, path=None, chunksize=500, processes=None, salinity_axis='salinity', targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True):
+        """
+        Calculate speciation over a regular grid of inputs.
+
+        Parameters
+        ----------
+        axes : dict
+            {name: values} of each grid axis, e.g. {'temperature': [5, 15, 25], 
+            'salinity': [30, 35], 'pH': np.linspace(7.5, 8.5, 11)}. The 'salinity'
+            axis sets the composition of standard seawater (`chemistry.SW`).
+        base : dict
+            Composition shared by all grid points.
+        path : str
+            Directory of a memory-mapped store. Interrupted sweeps are resumed
+            from the completed points in this directory.
+        
+        See `sweep.sweep` for other parameters.
+
+        Returns
+        -------
+        GridStore : results as an array of shape (*axis lengths, outputs).
+        """
+        return sweep(axes, self.db, base=base, path=path, chunksize=chunksize, processes=processes, iphreeqc_path=self.iphreeqc_path, salinity_axis=salinity_axis, targets=targets, output_totals=output_totals, output_molalities=output_molalities, output_activities=output_activities, output_phases=output_phases, phase_targets=phase_targets, allow_HCO_phases=allow_HCO_phases, drop_OH_species=drop_OH_species)
+
+    def speciation_table(self, axes, base=None, path=None, n_check=100, method='linear', chunksize=500, processes=None, salinity_axis='salinity', random_state=None, **kwargs):
+        """
+        Make a lookup table of speciation over a grid of inputs.
+
+        The grid is calculated by `sweep`, and the interpolation error is
+        estimated at `n_check` random points within the grid.
+
+        Parameters
+        ----------
+        axes : dict
+            {name: values} of each grid axis (see `sweep`).
+        n_check : int
+            Number of random points at which the table is checked against PHREEQC.
+        method : str
+            Interpolation method to check (see `SpeciationTable.interpolate`).
+        
+        Other parameters are passed to `sweep`.
+
+        Returns
+        -------
+        SpeciationTable
+        """
+        store = self.sweep(axes, base=base, path=path, chunksize=chunksize, processes=processes, salinity_axis=salinity_axis, **kwargs)
+        table = SpeciationTable.from_grid(store)
+        if n_check:
+            table.spot_check(n=n_check, method=method, iphreeqc_path=self.iphreeqc_path, random_state=random_state)
+        return table
+
+    def run_mc(self, inputs, N, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std', distribution=None, persistent_workers=True, return_stats=False, processes=None, store=None, aggregate=False, CI=0.95, quantiles=None, covariance=False, sampler='random', random_state=None, input_correlation=None, input_covariance=None, resume=False, schedule='ordered', transport='pickle'):
+        return run_mc(inputs=inputs, N=N, database=self.db, targets=targets, output_totals=output_totals, output_molalities=output_molalities, output_activities=output_activities, output_phases=output_phases, phase_targets=phase_targets, allow_HCO_phases=allow_HCO_phases, drop_OH_species=drop_OH_species, uncertainty_id=uncertainty_id, distribution=distribution, iphreeqc_path=self.iphreeqc_path, persistent_workers=persistent_workers, return_stats=return_stats, processes=processes, store=store, aggregate=aggregate, CI=CI, quantiles=quantiles, covariance=covariance, sampler=sampler, random_state=random_state, input_correlation=input_correlation, input_covariance=input_covariance, resume=resume, schedule=schedule, transport=transport)
+
+    def run_mc_adaptive(self, inputs, convergence_targets, tol, batch_size=100, min_N=200, max_N=10000, criterion='sem', CI=0.95, quantiles=None, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std', distribution=None, processes=None, random_state=None, return_stats=False, sampler='random', input_correlation=None, input_covariance=None):
+        return run_mc_adaptive(inputs=inputs, database=self.db, convergence_targets=convergence_targets, tol=tol, batch_size=batch_size, min_N=min_N, max_N=max_N, criterion=criterion, CI=CI, quantiles=quantiles, targets=targets, output_totals=output_totals, output_molalities=output_molalities, output_activities=output_activities, output_phases=output_phases, phase_targets=phase_targets, allow_HCO_phases=allow_HCO_phases, drop_OH_species=drop_OH_species, uncertainty_id=uncertainty_id, distribution=distribution, iphreeqc_path=self.iphreeqc_path, processes=processes, random_state=random_state, return_stats=return_stats, sampler=sampler, input_correlation=input_correlation, input_covariance=input_covariance)
+
+    def run_mc_surrogate(self, inputs, N, method='linear', n_check=20, step=1., n_anchors=30, targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std', distribution=None, processes=None, random_state=None, sampler='random', input_correlation=None, input_covariance=None, return_stats=False):
+        return run_mc_surrogate(inputs=inputs, N=N, database=self.db, method=method, n_check=n_check, step=step, n_anchors=n_anchors, targets=targets, output_totals=output_totals, output_molalities=output_molalities, output_activities=output_activities, output_phases=output_phases, phase_targets=phase_targets, allow_HCO_phases=allow_HCO_phases, drop_OH_species=drop_OH_species, uncertainty_id=uncertainty_id, distribution=distribution, iphreeqc_path=self.iphreeqc_path, processes=processes, random_state=random_state, sampler=sampler, input_correlation=input_correlation, input_covariance=input_covariance, return_stats=return_stats)
 
     def list_valid_species(self):
         print(f'Valid Species for {self.db.name}.dat:\n')
@@ -0,0 +1,200 @@
+"""
+Cost-aware scheduling of tasks on a process pool.
+
+Tasks are dispatched most expensive first, from a central queue, with only a
+few chunks in flight, so that idle workers take the next task as soon as they
+finish. Cheap tasks are grouped into chunks sized to a target run time, which
+shrinks as the remaining work runs out, to avoid a long tail of stragglers.
+Task costs are estimated from solution compositions, and the estimates are
+corrected by the run times observed as tasks complete.
+"""
+
+import time
+import queue
+import heapq
+import numpy as np
+import pandas as pd
+
+from ..chemistry import get_charge
+
+# relative cost of the activity model of each database
+DATABASE_COST = {'pitzer': 4., 'sit': 2.}
+
+# concentrations in mol/kg of each unit prefix. PHREEQC's default unit is mmol/kgw.
+_unit_scale = {'mol': 1., 'mmol': 1e-3, 'umol': 1e-6, 'nmol': 1e-9}
+
+def cost_features(inputs, database, N=1):
+    """
+    Returns the features of each solution used to estimate its cost.
+
+    Parameters
+    ----------
+    inputs : pandas.DataFrame
+        Checked solution inputs, one solution per row.
+    database : datParser
+        The database the solutions will be run with.
+    N : int or array
+        Number of times each solution is run (e.g. Monte Carlo iterations).
+
+    Returns
+    -------
+    pandas.DataFrame : with columns 'n_elements', 'ionic_strength' (a rough
+    estimate from the master species), 'N' and 'database'.
+    """
+    elements = [c for c in inputs.columns if c in database.element_2_master and c != 'Alkalinity']
+    conc = inputs.loc[:, elements].apply(pd.to_numeric, errors='coerce').values.astype(np.float64)
+
+    units = inputs.get('units', inputs.get('unit'))
+    if units is None:
+        scale = np.full(len(inputs), 1e-3)
+    else:
+        scale = np.array([_unit_scale.get(str(u).split('/')[0], 1e-3) for u in units])
+
+    z2 = np.array([get_charge(database.element_2_master[e])**2 for e in elements], dtype=np.float64)
+    return pd.DataFrame({
+        'n_elements': np.isfinite(conc).sum(axis=1),
+        'ionic_strength': 0.5 * np.nansum(conc * z2, axis=1) * scale,
+        'N': np.broadcast_to(N, len(inputs)),
+        'database': DATABASE_COST.get(database.name, 1.),
+    }, index=inputs.index)
+
+class CostModel:
+    """
+    Estimates the run time of tasks from their features, learning from observed times.
+
+    Before any times are observed, the cost of a task is
+    `N * (1 + n_elements) * (1 + ionic_strength) * database` (relative units).
+    Observed times are used to fit a correction to this, by least squares on
+    log(time / cost) against log(1 + n_elements) and log(1 + ionic_strength).
+
+    Parameters
+    ----------
+    min_fit : int
+        Number of observations before the correction depends on the features.
+        Until then, a single scale factor is used.
+    """
+    def __init__(self, min_fit=8):
+        self.min_fit = min_fit
+        self.coef = np.array([np.log(1e-5), 0., 0.])
+        self._X = []
+        self._y = []
+
+    @staticmethod
+    def _heuristic(features):
+        f = features
+        return f['N'] * (1 + f['n_elements']) * (1 + f['ionic_strength']) * f['database']
+
+    @staticmethod
+    def _design(features):
+        return np.column_stack([np.ones(len(features)), np.log1p(features['n_elements']), np.log1p(features['ionic_strength'])])
+
+    def predict(self, features):
+        """
+        Returns the expected run time of each task, in seconds.
+        """
+        return np.asarray(self._heuristic(features)) * np.exp(self._design(features) @ self.coef)
+
+    def update(self, features, seconds):
+        """
+        Add observed run times, and refit the correction.
+        """
+        self._X.extend(self._design(features))
+        self._y.extend(np.log(np.maximum(seconds, 1e-9)) - np.log(np.asarray(self._heuristic(features))))
+
+        X = np.array(self._X)
+        y = np.array(self._y)
+        if len(y) >= self.min_fit and np.linalg.matrix_rank(X) == X.shape[1]:
+            self.coef = np.linalg.lstsq(X, y, rcond=None)[0]
+        else:
+            self.coef = np.array([np.median(y), 0., 0.])
+
+    @property
+    def n_observed(self):
+        return len(self._y)
+
+def _run_chunk(func, chunk):
+    out = []
+    for label, args in chunk:
+        t0 = time.perf_counter()
+        r = func(*args)
+        out.append((label, r, time.perf_counter() - t0))
+    return out
+
+def run_scheduled(pool, func, tasks, features, processes, model=None, target_time=1., max_chunks=None):
+    """
+    Run tasks on a pool, most expensive first, in chunks of adaptive size.
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool
+        The pool to run tasks on.
+    func : callable
+        Picklable function applied to the arguments of each task.
+    tasks : dict
+        {label: args}, where args is a tuple of arguments for `func`, or a
+        callable that returns it. Callables are called when the task is dispatched,
+        so large arguments need not all be held in memory.
+    features : pandas.DataFrame
+        Cost features of each task, indexed by label (see `cost_features`).
+    processes : int
+        Number of processes in the pool.
+    model : CostModel
+        The cost model. If None, a new model is used.
+    target_time : float
+        Maximum expected seconds per chunk. Chunks are made smaller as the remaining
+        work runs out, so that all workers finish together.
+    max_chunks : int
+        Maximum number of chunks in flight. Defaults to 2 * processes.
+
+    Returns
+    -------
+    generator : yields (label, result) in order of completion.
+    """
+    if model is None:
+        model = CostModel()
+    if max_chunks is None:
+        max_chunks = 2 * processes
+
+    labels = list(tasks)
+    features = features.loc[labels]
+    heap = []
+    def prioritise():
+        remaining = [label for _, _, label in heap] if heap else labels
+        predicted = dict(zip(remaining, model.predict(features.loc[remaining])))
+        heap[:] = [(-predicted[label], i, label) for i, label in enumerate(remaining)]
+        heapq.heapify(heap)
+
+    done = queue.Queue()
+    inflight = 0
+    refit_at = model.min_fit
+    prioritise()
+
+    def submit():
+        remaining = -sum(c for c, _, _ in heap)
+        target = min(target_time, remaining / (2 * processes))
+        chunk = []
+        cost = 0.
+        while heap and (not chunk or cost - heap[0][0] <= target):
+            c, _, label = heapq.heappop(heap)
+            args = tasks[label]
+            chunk.append((label, args() if callable(args) else args))
+            cost -= c
+        pool.apply_async(_run_chunk, (func, chunk), callback=done.put, error_callback=done.put)
+
+    while heap or inflight:
+        while heap and inflight < max_chunks:
+            submit()
+            inflight += 1
+
+        result = done.get()
+        inflight -= 1
+        if isinstance(result, BaseException):
+            raise result
+
+        model.update(features.loc[[label for label, _, _ in result]], np.array([t for _, _, t in result]))
+        if heap and model.n_observed >= refit_at:
+            prioritise()
+            refit_at *= 2
+
+        for label, r, _ in result:
+            yield label, r
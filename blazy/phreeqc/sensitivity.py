@@ -0,0 +1,197 @@
+"""
+Finite-difference sensitivities of PHREEQC outputs to solution inputs.
+"""
+
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+
+from .engine import PhreeqcEngine, run_batched
+from .multiprocessing import init_worker, get_worker_engine
+
+# inputs that are not concentrations, so may be stepped below zero
+SIGNED_INPUTS = ['pH', 'pe', 'temp', 'temperature']
+
+def fd_steps(inputs, wrt, rel_step=1e-3, abs_step=None):
+    """
+    Returns the finite-difference step of each input of each solution.
+
+    Parameters
+    ----------
+    inputs : pandas.DataFrame
+        Solution compositions, one solution per row.
+    wrt : list
+        The columns to differentiate with respect to.
+    rel_step : float
+        Step relative to the value of each input. Where an input
+        is zero, `rel_step` is used as an absolute step.
+    abs_step : float or dict
+        Absolute step of all inputs, or a dict of {column: step}.
+        Overrides `rel_step` for the columns it applies to.
+
+    Returns
+    -------
+    array : of shape (len(inputs), len(wrt)).
+    """
+    x = inputs.loc[:, wrt].values.astype(np.float64)
+    h = rel_step * np.abs(x)
+    h[h == 0] = rel_step
+    if abs_step is not None:
+        if not isinstance(abs_step, dict):
+            abs_step = {c: abs_step for c in wrt}
+        for j, c in enumerate(wrt):
+            if c in abs_step:
+                h[:, j] = abs_step[c]
+    return h
+
+def fd_backward_steps(inputs, wrt, steps, nonnegative=None):
+    """
+    Returns the backward finite-difference step of each input of each solution.
+
+    Backward steps equal `steps` (central differences), except where they would
+    make a non-negative input, such as a concentration, negative. There they are
+    zero, giving a forward difference.
+
+    Parameters
+    ----------
+    inputs : pandas.DataFrame
+        Solution compositions, one solution per row.
+    wrt : list
+        The columns to differentiate with respect to.
+    steps : array
+        Step of each input of each solution, as returned by `fd_steps`.
+    nonnegative : list
+        Columns that cannot be negative. Defaults to all of `wrt` except
+        those in `SIGNED_INPUTS`.
+
+    Returns
+    -------
+    array : of shape (len(inputs), len(wrt)).
+    """
+    if nonnegative is None:
+        nonnegative = [c for c in wrt if c not in SIGNED_INPUTS]
+    x = inputs.loc[:, wrt].values.astype(np.float64)
+    bounded = np.isin(wrt, nonnegative)[np.newaxis, :]
+    return np.where(bounded & (x - steps < 0), 0., steps)
+
+def fd_design(inputs, wrt, steps, backward=None):
+    """
+    Returns the solutions needed for central differences.
+
+    Each solution is followed by 2 * len(wrt) perturbed copies: the
+    positive steps of each input in `wrt`, then the negative steps.
+
+    Parameters
+    ----------
+    inputs : pandas.DataFrame
+        Solution compositions, one solution per row.
+    wrt : list
+        The columns to perturb.
+    steps : array
+        Step of each input of each solution, as returned by `fd_steps`.
+    backward : array
+        Negative steps, as returned by `fd_backward_steps`. If None, `steps` is used.
+
+    Returns
+    -------
+    pandas.DataFrame : of len(inputs) * (2 * len(wrt) + 1) solutions.
+    """
+    if backward is None:
+        backward = steps
+    n, k = steps.shape
+    m = 2 * k + 1
+    design = inputs.iloc[np.repeat(np.arange(n), m)].reset_index(drop=True)
+
+    offsets = np.zeros((n, m, k))
+    offsets[:, 1:k + 1] = steps[:, np.newaxis, :] * np.eye(k)
+    offsets[:, k + 1:] = -backward[:, np.newaxis, :] * np.eye(k)
+    for j, c in enumerate(wrt):
+        design[c] = design[c].values.astype(np.float64) + offsets[:, :, j].ravel()
+    return design
+
+def fd_jacobian(out, steps, backward=None):
+    """
+    Calculate central-difference derivatives from the output of a `fd_design`.
+
+    Where a backward step is zero, the derivative is a forward difference.
+
+    Parameters
+    ----------
+    out : array
+        Numeric output of the design, of shape (n * (2k + 1), n_outputs).
+    steps : array
+        The steps used to make the design, of shape (n, k).
+    backward : array
+        The negative steps used to make the design. If None, `steps` is used.
+
+    Returns
+    -------
+    array : d(output)/d(input), of shape (n, n_outputs, k).
+    """
+    if backward is None:
+        backward = steps
+    n, k = steps.shape
+    out = out.reshape(n, 2 * k + 1, -1)
+    diff = out[:, 1:k + 1] - out[:, k + 1:]
+    return (diff / (steps + backward)[:, :, np.newaxis]).transpose(0, 2, 1)
+
+def jacobian(inputs, outputs, wrt, database_path, iphreeqc_path=None, rel_step=1e-3, abs_step=None, processes=None, chunksize=1000, engine=None):
+    """
+    Derivatives of PHREEQC outputs with respect to solution inputs, by central differences.
+
+    Concentrations too small to step below are differentiated by forward differences
+    (see `fd_backward_steps`).
+
+    All perturbed solutions are written into batched input strings, and run
+    on a single engine or, if `processes` is given, on a pool of engines.
+
+    Parameters
+    ----------
+    inputs : pandas.DataFrame
+        Checked solution compositions, one solution per row.
+    outputs : str
+        SELECTED_OUTPUT string.
+    wrt : list
+        The input columns to differentiate with respect to.
+    database_path : str
+        Path to the database.
+    rel_step, abs_step : float
+        Finite-difference steps (see `fd_steps`).
+    processes : int
+        If given, solutions are split between this many worker processes.
+    chunksize : int
+        Number of solutions per `run_string` call.
+    engine : PhreeqcEngine
+        An existing engine to use if `processes` is None. If None, one
+        is created for the calculation.
+
+    Returns
+    -------
+    tuple : (jacobian, columns), where jacobian is an array of shape
+    (sample, output, input) and columns are the numeric output columns.
+    """
+    steps = fd_steps(inputs, wrt, rel_step=rel_step, abs_step=abs_step)
+    backward = fd_backward_steps(inputs, wrt, steps)
+    design = fd_design(inputs, wrt, steps, backward)
+
+    if processes is None:
+        destroy = engine is None
+        if engine is None:
+            engine = PhreeqcEngine(database_path, iphreeqc_path)
+        try:
+            out = run_batched(engine, design, outputs, chunksize=chunksize)
+        finally:
+            if destroy:
+                engine.destroy()
+    else:
+        m = 2 * len(wrt) + 1
+        splits = np.array_split(np.arange(len(inputs)), processes)
+        tasks = [(design.iloc[s[0] * m:(s[-1] + 1) * m], outputs, chunksize) for s in splits if len(s)]
+        with mp.Pool(processes, initializer=init_worker, initargs=(database_path, iphreeqc_path)) as pool:
+            out = pd.concat(pool.starmap(_run_design_task, tasks), ignore_index=True)
+
+    columns = out.select_dtypes(include='number').columns.drop(('general', 'soln'), errors='ignore')
+    return fd_jacobian(out.loc[:, columns].values.astype(np.float64), steps, backward), columns
+
+def _run_design_task(design, outputs, chunksize):
+    return run_batched(get_worker_engine(), design, outputs, chunksize=chunksize)
@@ -0,0 +1,190 @@
+"""
+On-disk storage of Monte Carlo results, written one sample at a time.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+class MCStore:
+    """
+    A directory of Monte Carlo results, with one block of iterations per sample.
+
+    Each sample's numeric outputs are stored as a float64 `.npy` file, and any
+    text outputs (e.g. 'state') in a separate `.npz` file, with a mask of missing
+    values. The column MultiIndex and dtypes are stored once in `columns.json`,
+    and the dtypes are restored when samples are read. Samples are written atomically, and the
+    values file is written last, so a partially written sample is never visible
+    to a reader.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the store. Created if it doesn't exist.
+
+    Attributes
+    ----------
+    meta : dict
+        Information about the run that produced the results (e.g. the seed),
+        stored in `meta.json`.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+        self._meta_file = os.path.join(self.path, 'columns.json')
+        if os.path.exists(self._meta_file):
+            with open(self._meta_file, 'r') as f:
+                meta = json.load(f)
+            self.columns = pd.MultiIndex.from_tuples([tuple(c) for c in meta['columns']])
+            self._numeric = meta['numeric']
+            self._text = meta['text']
+            # stores written before dtypes were recorded hold float64 and text columns
+            self._dtypes = meta.get('dtypes') or ['float64' if i in self._numeric else 'object' for i in range(len(self.columns))]
+        else:
+            self.columns = None
+
+        self._run_meta_file = os.path.join(self.path, 'meta.json')
+        if os.path.exists(self._run_meta_file):
+            with open(self._run_meta_file, 'r') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {}
+
+    def update_meta(self, **kwargs):
+        """
+        Add items to `meta`, saving them to the store.
+        """
+        self.meta.update(kwargs)
+        _atomic_write(self._run_meta_file, lambda f: f.write(json.dumps(self.meta).encode()))
+
+    def _sample_file(self, sample, kind='values'):
+        ext = 'npz' if kind == 'text' else 'npy'
+        return os.path.join(self.path, f'{int(sample):08d}.{kind}.{ext}')
+
+    def _write_meta(self, df):
+        self.columns = df.columns
+        self._numeric = [i for i, d in enumerate(df.dtypes) if pd.api.types.is_numeric_dtype(d)]
+        self._text = [i for i in range(df.shape[1]) if i not in self._numeric]
+        self._dtypes = [str(d) for d in df.dtypes]
+        _atomic_write(self._meta_file, lambda f: f.write(json.dumps({
+            'columns': [list(c) for c in self.columns],
+            'numeric': self._numeric,
+            'text': self._text,
+            'dtypes': self._dtypes
+        }).encode()))
+
+    def append(self, sample, df):
+        """
+        Write the results of one sample to the store.
+
+        Parameters
+        ----------
+        sample : int
+            The sample number.
+        df : pandas.DataFrame
+            The results for each iteration of the sample, as returned by PHREEQC.
+        """
+        if self.columns is None:
+            self._write_meta(df)
+        elif not df.columns.equals(self.columns):
+            raise ValueError('The columns of this sample do not match the columns in the store.')
+
+        if self._text:
+            text = df.iloc[:, self._text]
+            missing = text.isna().values
+            text = np.where(missing, '', text.values.astype(object)).astype(str)
+            _atomic_write(self._sample_file(sample, 'text'), lambda f: np.savez(f, text=text, missing=missing))
+        # the values file marks the sample as complete, so is written last
+        values = df.iloc[:, self._numeric].values.astype(np.float64)
+        _atomic_write(self._sample_file(sample), lambda f: np.save(f, values))
+
+    @property
+    def samples(self):
+        """
+        Sorted list of the samples in the store.
+        """
+        return sorted(int(f.split('.')[0]) for f in os.listdir(self.path) if f.endswith('.values.npy'))
+
+    def __contains__(self, sample):
+        return os.path.exists(self._sample_file(sample))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def get_array(self, sample):
+        """
+        Returns a read-only memory map of the numeric outputs of one sample.
+        """
+        return np.load(self._sample_file(sample), mmap_mode='r')
+
+    def get_sample(self, sample, columns=None):
+        """
+        Read the results of one sample.
+
+        Parameters
+        ----------
+        sample : int
+            The sample number.
+        columns : list
+            Column tuples to read. If None, all columns are read.
+
+        Returns
+        -------
+        pandas.DataFrame : indexed by (sample, iteration)
+        """
+        if sample not in self:
+            raise KeyError(f'Sample {sample} is not in the store.')
+
+        values = np.load(self._sample_file(sample))
+        N = values.shape[0]
+        arrays = {i: values[:, j].astype(self._dtypes[i], copy=False) for j, i in enumerate(self._numeric)}
+        if self._text:
+            with np.load(self._sample_file(sample, 'text')) as f:
+                text, missing = f['text'].astype(object), f['missing']
+            text[missing] = np.nan
+            for j, i in enumerate(self._text):
+                arrays[i] = pd.array(text[:, j], dtype=self._dtypes[i])
+
+        out = pd.DataFrame({i: arrays[i] for i in range(len(self.columns))}, index=pd.RangeIndex(N))
+        out.columns = self.columns
+        out.index = pd.MultiIndex.from_product([[sample], range(N)], names=['sample', 'iteration'])
+        if columns is not None:
+            out = out.loc[:, columns]
+        return out
+
+    def __getitem__(self, sample):
+        return self.get_sample(sample)
+
+    def iter_samples(self, samples=None, columns=None):
+        """
+        Generator yielding the results of each sample in turn.
+        """
+        if samples is None:
+            samples = self.samples
+        for s in samples:
+            yield self.get_sample(s, columns=columns)
+
+    def read(self, samples=None, columns=None):
+        """
+        Read results from the store into a single DataFrame.
+
+        Parameters
+        ----------
+        samples : list
+            Sample numbers to read. If None, all samples are read.
+        columns : list
+            Column tuples to read. If None, all columns are read.
+
+        Returns
+        -------
+        pandas.DataFrame : indexed by (sample, iteration), as returned by `run_mc`.
+        """
+        return pd.concat(list(self.iter_samples(samples=samples, columns=columns)))
+
+def _atomic_write(path, write):
+    tmp = path + f'.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
@@ -0,0 +1,229 @@
+"""
+Surrogate models of PHREEQC outputs for dense Monte Carlo ensembles.
+
+All iterations of a Monte Carlo sample are small perturbations of one
+composition. Rather than solving every iteration, a local response model
+is fitted to a few anchor points solved by PHREEQC, and used to predict
+the remaining iterations. A random subset of iterations is solved by
+PHREEQC as a check, giving an estimate of the surrogate error.
+"""
+
+import warnings
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from functools import partial
+from scipy import stats
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import RBF, ConstantKernel, WhiteKernel
+from sklearn.exceptions import ConvergenceWarning
+from tqdm.autonotebook import tqdm
+
+from .engine import run_batched
+from .sensitivity import fd_design, fd_jacobian, fd_backward_steps
+from .multiprocessing import init_worker, get_worker_engine, collect_worker_stats
+from .montecarlo import mc_input_dfs, mc_uniforms, split_uncertainty_columns, concat_mc_results
+from . import istarmap
+
+class LinearSurrogate:
+    """
+    Linear model of outputs around a composition, from central finite differences.
+
+    Parameters
+    ----------
+    center : pandas.DataFrame
+        Output at the central composition (one row).
+    jacobian : array
+        d(output)/d(input), of shape (output, input).
+    x0 : array
+        The central values of the perturbed inputs.
+    """
+    def __init__(self, center, jacobian, x0):
+        self.center = center.values.astype(np.float64).ravel()
+        self.jacobian = jacobian
+        self.x0 = x0
+
+    def predict(self, X):
+        return self.center + (X - self.x0) @ self.jacobian.T
+
+class GPSurrogate:
+    """
+    Gaussian process model of outputs, fitted to anchor points.
+
+    Inputs are scaled by their uncertainty and outputs are standardised before fitting.
+    """
+    def __init__(self, X, Y, x0, xscale):
+        self.x0 = x0
+        self.xscale = xscale
+        self.ymean = np.nan_to_num(np.nanmean(Y, axis=0))
+        self.yscale = np.nanstd(Y, axis=0)
+        self.yscale[~(self.yscale > 0)] = 1.
+
+        kernel = ConstantKernel() * RBF(length_scale=np.ones(X.shape[1])) + WhiteKernel(1e-5)
+        self.gp = GaussianProcessRegressor(kernel=kernel, normalize_y=False)
+        with warnings.catch_warnings():
+            # poor hyperparameter fits show up in the spot-check errors
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            self.gp.fit((X - x0) / xscale, np.nan_to_num((Y - self.ymean) / self.yscale))
+
+    def predict(self, X):
+        return self.gp.predict((X - self.x0) / self.xscale) * self.yscale + self.ymean
+
+def fit_surrogate(engine, sample, outputs, columns, method='linear', step=1., n_anchors=30, uncertainty_id='_std', random_state=None, chunksize=1000):
+    """
+    Fit a surrogate model of PHREEQC outputs around one sample.
+
+    Parameters
+    ----------
+    engine : PhreeqcEngine
+        Engine used to solve the anchor points.
+    sample : pandas.DataFrame
+        A single row of inputs, including uncertainties.
+    outputs : str
+        SELECTED_OUTPUT string.
+    columns : list
+        The perturbed input columns modelled by the surrogate.
+    method : str
+        'linear' : central finite differences of +/- `step` standard deviations
+        in each input (2 * len(columns) + 1 solutions).
+        'gp' : a Gaussian process fitted to the centre and `n_anchors` Latin
+        hypercube points drawn from the input distribution.
+
+    Returns
+    -------
+    tuple : (surrogate, center), where center is the PHREEQC output at the central composition.
+    """
+    x0 = sample.loc[:, columns].values.astype(np.float64).ravel()
+    std = sample.loc[:, [c + uncertainty_id for c in columns]].values.astype(np.float64).ravel()
+    d = len(columns)
+
+    center = sample.loc[:, [c for c in sample.columns if uncertainty_id not in c]]
+
+    if method == 'linear':
+        steps = step * std[np.newaxis]
+        # forward differences for concentrations that would step below zero
+        backward = fd_backward_steps(center, columns, steps)
+        anchors = fd_design(center, columns, steps, backward)
+    elif method == 'gp':
+        u = mc_uniforms(1, n_anchors, d, sampler='lhs', random_state=random_state)[0]
+        X = np.vstack([x0, x0 + stats.norm.ppf(u) * std])
+        anchors = pd.concat([center] * len(X), ignore_index=True)
+        anchors.loc[:, columns] = X
+    else:
+        raise ValueError(f"method must be 'linear' or 'gp', not '{method}'.")
+
+    out = run_batched(engine, anchors, outputs, chunksize=chunksize)
+
+    numeric = out.select_dtypes(include='number')
+    Y = numeric.values.astype(np.float64)
+    if method == 'linear':
+        return LinearSurrogate(numeric.iloc[[0]], fd_jacobian(Y, steps, backward)[0], x0), out.iloc[[0]]
+    return GPSurrogate(X, Y, x0, std), out.iloc[[0]]
+
+def run_surrogate_sample(sample, outputs, db, N, method='linear', n_check=20, step=1., n_anchors=30, uncertainty_id='_std',
+                         distribution=None, random_state=None, sampler='random', correlation=None, covariance=None):
+    """
+    Run the Monte Carlo iterations of one sample, mostly by surrogate.
+
+    Runs on the persistent engine of the current pool worker. `n_check` randomly
+    chosen iterations are solved by PHREEQC, and these exact results are used in
+    the output in place of the surrogate predictions.
+
+    Returns
+    -------
+    tuple : (output DataFrame, max absolute spot-check error of each output, engine stats dict)
+    """
+    engine = get_worker_engine()
+    rng = np.random.default_rng(random_state)
+
+    _, _, col_with_unc = split_uncertainty_columns(sample, uncertainty_id)
+    columns = [c for c in col_with_unc if np.isfinite(sample[c].values[0]) and sample[c + uncertainty_id].values[0] > 0]
+
+    inputs, _, _ = next(mc_input_dfs(sample, N=N, uncertainty_id=uncertainty_id, distribution=distribution, random_state=rng,
+                                     sampler=sampler, correlation=correlation, covariance=covariance))
+
+    model, center = fit_surrogate(engine, sample, outputs, columns, method=method, step=step, n_anchors=n_anchors,
+                                  uncertainty_id=uncertainty_id, random_state=rng)
+
+    numeric = center.select_dtypes(include='number').columns
+    predicted = pd.DataFrame(model.predict(inputs.loc[:, columns].values.astype(np.float64)), columns=numeric)
+    for i, c in enumerate(center.columns):
+        if c not in numeric:
+            predicted.insert(i, c, center[c].values[0])
+    for c, d in center.dtypes.items():
+        if pd.api.types.is_integer_dtype(d):
+            # counters (e.g. 'sim', 'step') are not predicted
+            predicted[c] = center[c].values[0]
+    if ('general', 'soln') in predicted.columns:
+        predicted[('general', 'soln')] = np.arange(1, N + 1)
+
+    check = np.sort(rng.choice(N, size=min(n_check, N), replace=False))
+    if len(check):
+        exact = run_batched(engine, inputs.iloc[check], outputs)
+        exact.index = check
+        if ('general', 'soln') in exact.columns:
+            exact[('general', 'soln')] = check + 1
+        errors = (exact.loc[:, numeric] - predicted.loc[check, numeric]).abs().max()
+        predicted.iloc[check] = exact.loc[:, predicted.columns]
+    else:
+        errors = pd.Series(np.nan, index=numeric)
+    return predicted, errors, engine.stats()
+
+def run_mc_surrogate(inputs, N, database, method='linear', n_check=20, step=1., n_anchors=30, targets=None, output_totals=True, output_molalities=True,
+                     output_activities=True, output_phases=True, phase_targets=None, allow_HCO_phases=True, drop_OH_species=True, uncertainty_id='_std',
+                     distribution=None, iphreeqc_path=None, processes=None, random_state=None, sampler='random', input_correlation=None,
+                     input_covariance=None, return_stats=False):
+    """
+    Monte Carlo using a local surrogate model of PHREEQC for each sample.
+
+    For each sample, PHREEQC solves a small set of anchor points (see `fit_surrogate`),
+    and the surrogate predicts the outputs of all N iterations. `n_check` randomly
+    chosen iterations are also solved by PHREEQC to estimate the surrogate error.
+
+    Parameters
+    ----------
+    method : str
+        'linear' (finite-difference Jacobian) or 'gp' (Gaussian process).
+    n_check : int
+        Number of iterations per sample solved by PHREEQC as a check.
+    step : float
+        Finite-difference step, in standard deviations of each input ('linear').
+    n_anchors : int
+        Number of anchor points per sample ('gp').
+
+    Other parameters are as in `run_mc`.
+
+    Returns
+    -------
+    tuple : (results, errors), where results is indexed by (sample, iteration), and
+    errors contains the maximum absolute difference between the surrogate and PHREEQC
+    for each output of each sample. If `return_stats`, worker stats are returned
+    as a third item.
+    """
+    inputs = database.check_inputs(inputs, uncertainty_id=uncertainty_id)
+    if targets is None:
+        targets = database.get_target_elements(inputs, drop_OH=drop_OH_species, uncertainty_id=uncertainty_id)
+    outputs = database.generate_SELECTED_OUTPUT(targets, totals=output_totals,
+                                                molalities=output_molalities, activities=output_activities,
+                                                phases=output_phases, phase_targets=phase_targets,
+                                                allow_HCO=allow_HCO_phases)
+    if processes is None:
+        processes = mp.cpu_count()
+
+    seeds = np.random.SeedSequence(random_state).spawn(len(inputs))
+    tasks = ((inputs.iloc[[i]], outputs, None, seeds[i]) for i in range(len(inputs)))
+    func = partial(_run_surrogate_task, N=N, method=method, n_check=n_check, step=step, n_anchors=n_anchors, uncertainty_id=uncertainty_id,
+                   distribution=distribution, sampler=sampler, correlation=input_correlation, covariance=input_covariance)
+
+    with mp.Pool(processes, initializer=init_worker, initargs=(database.path, iphreeqc_path, database.handle())) as pool:
+        res = list(tqdm(pool.istarmap(func, tasks), total=len(inputs), desc='Running surrogate MC'))
+
+    results = concat_mc_results([r[0] for r in res])
+    errors = pd.DataFrame([r[1] for r in res], index=pd.RangeIndex(len(res), name='sample'))
+
+    if return_stats:
+        return results, errors, collect_worker_stats([r[2] for r in res])
+    return results, errors
+
+def _run_surrogate_task(sample, outputs, db, seed, **kwargs):
+    return run_surrogate_sample(sample, outputs, db, random_state=seed, **kwargs)
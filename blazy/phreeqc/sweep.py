@@ -0,0 +1,269 @@
+"""
+Speciation over regular grids of input parameters.
+
+The Cartesian product of the grid axes is never built in full. Grid points
+are generated in chunks of flat indices, run across a pool of persistent
+engines, and written into an N-dimensional array that is optionally backed
+by a memory-mapped file so that interrupted sweeps can be resumed.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from tqdm.autonotebook import tqdm
+
+from ..chemistry import SW
+from .engine import run_batched
+from .multiprocessing import init_worker, get_worker_engine
+
+def grid_points(axes, flat_index):
+    """
+    Returns the axis values at flat indices of the grid.
+
+    Parameters
+    ----------
+    axes : dict
+        {name: values} of each grid axis, in order.
+    flat_index : array
+        Indices into the flattened (C-ordered) grid.
+
+    Returns
+    -------
+    pandas.DataFrame : with a column for each axis, indexed by `flat_index`.
+    """
+    shape = tuple(len(v) for v in axes.values())
+    idx = np.unravel_index(flat_index, shape)
+    return pd.DataFrame({k: np.asarray(v)[i] for (k, v), i in zip(axes.items(), idx)},
+                        index=pd.Index(flat_index, name='point'))
+
+def compose_solutions(points, base=None, salinity_axis='salinity'):
+    """
+    Make solution compositions from grid points.
+
+    Parameters
+    ----------
+    points : pandas.DataFrame
+        Axis values, as returned by `grid_points`.
+    base : dict
+        Composition shared by all solutions. Axis values replace these.
+    salinity_axis : str
+        If this axis is present, each solution starts from the standard
+        seawater composition at that salinity (`chemistry.SW`).
+
+    Returns
+    -------
+    pandas.DataFrame : one solution per point.
+    """
+    out = pd.DataFrame(index=points.index)
+    if salinity_axis in points.columns:
+        sw = pd.DataFrame([SW(s) for s in points[salinity_axis].values], index=points.index)
+        out = pd.concat([out, sw], axis=1)
+    if base is not None:
+        for k, v in base.items():
+            out[k] = v
+    for c in points.columns:
+        if c != salinity_axis:
+            out[c] = points[c].values
+    return out
+
+class GridStore:
+    """
+    Results of a grid sweep, as an array of shape (*axis lengths, outputs).
+
+    Parameters
+    ----------
+    axes : dict
+        {name: values} of each grid axis, in order.
+    path : str
+        Directory of a memory-mapped store. If it already contains a sweep,
+        it is reopened and completed points are kept. If None, results are
+        held in memory.
+
+    Attributes
+    ----------
+    values : array
+        The results, with NaN at points that have not been run.
+    done : array
+        Boolean array of the grid shape, True where a point has been run.
+    columns : pandas.MultiIndex
+        The output columns (the last dimension of `values`).
+    meta : dict
+        Information needed to reproduce the sweep (database, SELECTED_OUTPUT,
+        base composition), set by `sweep`.
+    """
+    def __init__(self, axes, path=None):
+        self.axes = {k: np.asarray(v) for k, v in axes.items()}
+        self.shape = tuple(len(v) for v in self.axes.values())
+        self.size = int(np.prod(self.shape))
+        self.path = path
+        self.columns = None
+        self.values = None
+        self.meta = {}
+
+        if self.path is None:
+            self.done = np.zeros(self.shape, dtype=bool)
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        self._meta_file = os.path.join(self.path, 'grid.json')
+        if os.path.exists(self._meta_file):
+            with open(self._meta_file, 'r') as f:
+                meta = json.load(f)
+            if meta['axes'] != {k: v.tolist() for k, v in self.axes.items()}:
+                raise ValueError(f'The grid stored in {self.path} has different axes.')
+            if meta['columns'] is not None:
+                self._open(pd.MultiIndex.from_tuples([tuple(c) for c in meta['columns']]), mode='r+')
+            self.meta = meta.get('meta', {})
+            self.done = np.lib.format.open_memmap(os.path.join(self.path, 'done.npy'), mode='r+')
+        else:
+            self.done = np.lib.format.open_memmap(os.path.join(self.path, 'done.npy'), mode='w+', dtype=bool, shape=self.shape)
+            self._write_meta()
+
+    def _write_meta(self):
+        with open(self._meta_file, 'w') as f:
+            json.dump({'axes': {k: v.tolist() for k, v in self.axes.items()},
+                       'columns': None if self.columns is None else [list(c) for c in self.columns],
+                       'meta': self.meta}, f)
+
+    def _open(self, columns, mode='w+'):
+        self.columns = columns
+        shape = self.shape + (len(columns),)
+        if self.path is None:
+            self.values = np.full(shape, np.nan)
+            return
+        self.values = np.lib.format.open_memmap(os.path.join(self.path, 'values.npy'), mode=mode, dtype=np.float64, shape=shape if mode == 'w+' else None)
+        if mode == 'w+':
+            self.values[:] = np.nan
+            self._write_meta()
+
+    def update_meta(self, **kwargs):
+        """
+        Add items to `meta`, saving them to the store.
+        """
+        self.meta.update(kwargs)
+        if self.path is not None:
+            self._write_meta()
+
+    def todo(self):
+        """
+        Returns the flat indices of the points that have not been run.
+        """
+        return np.flatnonzero(~self.done.ravel())
+
+    def write(self, out):
+        """
+        Write the output of a chunk of points, indexed by flat grid index.
+        """
+        if self.values is None:
+            self._open(out.columns)
+        flat = self.values.reshape(self.size, -1)
+        flat[out.index.values] = out.loc[:, self.columns].values.astype(np.float64)
+        self.done.ravel()[out.index.values] = True
+
+    def flush(self):
+        if self.path is not None:
+            if self.values is not None:
+                self.values.flush()
+            self.done.flush()
+
+    def _check_values(self):
+        if self.values is None:
+            raise ValueError('The grid has no completed points, so its outputs are not known yet.')
+
+    def get(self, output):
+        """
+        Returns one output over the grid, as an array of the grid shape.
+
+        Parameters
+        ----------
+        output : tuple
+            Output column, e.g. ('log10(activity)', 'B(OH)4-').
+        """
+        self._check_values()
+        return self.values[..., self.columns.get_loc(output)]
+
+    def to_frame(self):
+        """
+        Returns the results as a DataFrame indexed by the grid axes.
+
+        Raises ValueError if no points have been run.
+        """
+        self._check_values()
+        index = pd.MultiIndex.from_product(list(self.axes.values()), names=list(self.axes.keys()))
+        return pd.DataFrame(np.asarray(self.values).reshape(self.size, -1), index=index, columns=self.columns)
+
+def sweep(axes, database, base=None, path=None, chunksize=500, processes=None, iphreeqc_path=None, salinity_axis='salinity',
+          targets=None, output_totals=True, output_molalities=True, output_activities=True, output_phases=True, phase_targets=None,
+          allow_HCO_phases=True, drop_OH_species=True):
+    """
+    Calculate speciation over a regular grid of input parameters.
+
+    Parameters
+    ----------
+    axes : dict
+        {name: values} of each grid axis, e.g. {'temperature': [0, 10, 20],
+        'salinity': [30, 35], 'pH': np.linspace(7, 9, 21), 'B': [...]}.
+        Axis names are solution inputs, except `salinity_axis`.
+    database : datParser
+        The database to use.
+    base : dict
+        Composition shared by all grid points.
+    path : str
+        Directory of a memory-mapped store of the results. If the directory already
+        contains part of this sweep, only the remaining points are run.
+        The database, SELECTED_OUTPUT, base composition and salinity axis must match
+        those of the stored sweep.
+    chunksize : int
+        Number of grid points per task.
+    processes : int
+        Number of worker processes. Defaults to the number of CPUs.
+    salinity_axis : str
+        Name of the axis that sets the composition via `chemistry.SW`.
+
+    Other parameters are as in `datParser.make_PHREEQC_input`.
+
+    Returns
+    -------
+    GridStore
+    """
+    store = GridStore(axes, path=path)
+    todo = store.todo()
+
+    first = database.check_inputs(compose_solutions(grid_points(store.axes, [0]), base=base, salinity_axis=salinity_axis))
+    if targets is None:
+        targets = database.get_target_elements(first, drop_OH=drop_OH_species)
+    outputs = database.generate_SELECTED_OUTPUT(targets, totals=output_totals,
+                                                molalities=output_molalities, activities=output_activities,
+                                                phases=output_phases, phase_targets=phase_targets,
+                                                allow_HCO=allow_HCO_phases)
+    meta = dict(database=database.path, database_hash=database.hash, outputs=outputs, base=base, salinity_axis=salinity_axis)
+    if store.meta:
+        # compare as stored in grid.json
+        for k in ['database_hash', 'outputs', 'base', 'salinity_axis']:
+            if store.meta.get(k) != json.loads(json.dumps(meta[k])):
+                raise ValueError(f'Cannot resume: the sweep stored in {path} was run with a different {k}.')
+    store.update_meta(**meta)
+    if len(todo) == 0:
+        return store
+
+    if processes is None:
+        processes = mp.cpu_count()
+
+    def chunks():
+        for i in range(0, len(todo), chunksize):
+            points = grid_points(store.axes, todo[i:i + chunksize])
+            yield database.check_inputs(compose_solutions(points, base=base, salinity_axis=salinity_axis)), outputs
+
+    with mp.Pool(processes, initializer=init_worker, initargs=(database.path, iphreeqc_path)) as pool:
+        for out in tqdm(pool.imap_unordered(_run_sweep_task, chunks()), total=-(-len(todo) // chunksize), desc='Running sweep'):
+            store.write(out)
+            store.flush()
+
+    return store
+
+def _run_sweep_task(args):
+    inputs, outputs = args
+    out = run_batched(get_worker_engine(), inputs, outputs, chunksize=len(inputs))
+    return out.select_dtypes(include='number').drop(columns=[('general', 'soln')], errors='ignore')
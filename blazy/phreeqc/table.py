@@ -0,0 +1,213 @@
+"""
+Precomputed speciation lookup tables.
+
+A `SpeciationTable` holds PHREEQC outputs over a grid of inputs (usually from
+`sweep`), and answers queries by vectorised interpolation. Interpolation errors
+are estimated by comparison with PHREEQC at randomly chosen points.
+"""
+
+import json
+import numpy as np
+import pandas as pd
+from scipy.interpolate import RegularGridInterpolator, LinearNDInterpolator, NearestNDInterpolator
+
+from .engine import PhreeqcEngine, run_batched
+from .parser import datParser
+from .sweep import compose_solutions
+
+class SpeciationTable:
+    """
+    PHREEQC outputs tabulated over a grid of inputs, with fast interpolation.
+
+    Parameters
+    ----------
+    axes : dict
+        {name: values} of each grid axis.
+    values : array
+        Outputs of shape (*axis lengths, outputs). Points that were
+        not calculated should be NaN.
+    columns : pandas.MultiIndex
+        The output columns.
+    meta : dict
+        Information about how the table was made, as in `GridStore.meta`.
+        Required by `spot_check`.
+
+    Attributes
+    ----------
+    errors : dict
+        {method: DataFrame} of interpolation errors from `spot_check`.
+    """
+    def __init__(self, axes, values, columns, meta=None):
+        # interpolators need ascending axes, and at least two points in each
+        order = {k: np.argsort(v) for k, v in axes.items()}
+        values = np.asarray(values, dtype=np.float64)
+        for i, o in enumerate(order.values()):
+            values = np.take(values, o, axis=i)
+
+        self.constants = {k: np.asarray(v)[0] for k, v in axes.items() if len(v) == 1}
+        self.axes = {k: np.asarray(v)[order[k]] for k, v in axes.items() if k not in self.constants}
+        self.values = values.reshape(tuple(len(v) for v in self.axes.values()) + (values.shape[-1],))
+        self.columns = columns
+        self.meta = {} if meta is None else meta
+        self.errors = {}
+        self._interpolators = {}
+
+    @classmethod
+    def from_grid(cls, store):
+        """
+        Make a table from a `GridStore`, which must have at least one completed point.
+        """
+        if store.values is None or not store.done.any():
+            raise ValueError('Cannot make a table from a grid with no completed points.')
+        return cls(store.axes, np.asarray(store.values), store.columns, meta=dict(store.meta))
+
+    @property
+    def complete(self):
+        """
+        True if the table has no missing points.
+        """
+        return not np.isnan(self.values).all(axis=-1).any()
+
+    def _query_array(self, points):
+        if isinstance(points, dict):
+            points = pd.DataFrame({k: np.atleast_1d(v) for k, v in points.items()})
+        if isinstance(points, pd.DataFrame):
+            return points.loc[:, list(self.axes)].values.astype(np.float64)
+        points = np.asarray(points, dtype=np.float64)
+        return points.reshape(-1, len(self.axes))
+
+    def _interpolator(self, method, outputs):
+        key = (method, outputs)
+        if key not in self._interpolators:
+            values = self.values if outputs is None else self.values[..., list(outputs)]
+            if self.complete:
+                interp = RegularGridInterpolator(tuple(self.axes.values()), values, method=method, bounds_error=False, fill_value=np.nan)
+            elif method in ['linear', 'nearest']:
+                # scattered interpolation between the points that have been calculated
+                grid = np.stack(np.meshgrid(*self.axes.values(), indexing='ij'), axis=-1).reshape(-1, len(self.axes))
+                flat = values.reshape(len(grid), -1)
+                ok = ~np.isnan(flat).all(axis=1)
+                scattered = LinearNDInterpolator if method == 'linear' else NearestNDInterpolator
+                interp = scattered(grid[ok], flat[ok])
+            else:
+                raise ValueError(f"Only 'linear' and 'nearest' interpolation are possible on a table with missing points, not '{method}'.")
+            self._interpolators[key] = interp
+        return self._interpolators[key]
+
+    def interpolate(self, points, outputs=None, method='linear', as_array=False):
+        """
+        Interpolate outputs at query points.
+
+        Parameters
+        ----------
+        points : pandas.DataFrame, dict or array
+            Query points, with a column (or key) for each axis. Arrays must
+            be of shape (n, len(axes)), with columns in axis order.
+        outputs : list
+            Output columns to return. If None, all outputs are returned.
+        method : str
+            Interpolation method: 'linear' (multilinear), 'nearest', or one of the
+            spline methods of `scipy.interpolate.RegularGridInterpolator`
+            ('slinear', 'cubic', 'quintic', 'pchip').
+        as_array : bool
+            If True, return an array of shape (n, outputs) rather than a DataFrame.
+
+        Returns
+        -------
+        pandas.DataFrame or array : NaN outside the bounds of the table.
+        """
+        columns = self.columns
+        iout = None
+        if outputs is not None:
+            iout = tuple(self.columns.get_loc(o) for o in outputs)
+            columns = self.columns[list(iout)]
+
+        out = self._interpolator(method, iout)(self._query_array(points))
+        if as_array:
+            return out
+        index = points.index if isinstance(points, pd.DataFrame) else None
+        return pd.DataFrame(out, index=index, columns=columns)
+
+    __call__ = interpolate
+
+    def random_points(self, n, random_state=None):
+        """
+        Returns `n` points drawn uniformly within the bounds of the table.
+        """
+        rng = np.random.default_rng(random_state)
+        return pd.DataFrame({k: rng.uniform(v.min(), v.max(), n) for k, v in self.axes.items()})
+
+    def spot_check(self, n=100, method='linear', iphreeqc_path=None, engine=None, random_state=None):
+        """
+        Estimate interpolation errors by comparison with PHREEQC at random points.
+
+        Parameters
+        ----------
+        n : int
+            Number of points to check.
+        method : str
+            The interpolation method to check.
+        iphreeqc_path : str
+            Path to the IPhreeqc library, used if `engine` is None.
+        engine : PhreeqcEngine
+            Engine used to solve the check points. Must use the database of the table.
+
+        Returns
+        -------
+        pandas.DataFrame : the maximum and root-mean-square absolute error, and the
+        95th percentile of the absolute error of each output. Also stored in `errors`.
+        """
+        if 'outputs' not in self.meta:
+            raise ValueError('This table has no record of how it was calculated, so cannot be checked against PHREEQC.')
+
+        points = self.random_points(n, random_state=random_state)
+        for k, v in self.constants.items():
+            points[k] = v
+        inputs = compose_solutions(points, base=self.meta.get('base'), salinity_axis=self.meta.get('salinity_axis', 'salinity'))
+        # check the compositions as `sweep` did, so the same solutions are compared
+        database = datParser(self.meta['database'], silent=True)
+        if 'database_hash' in self.meta and database.hash != self.meta['database_hash']:
+            raise ValueError(f"The database {self.meta['database']} has changed since this table was made.")
+        inputs = database.check_inputs(inputs)
+
+        destroy = engine is None
+        if engine is None:
+            engine = PhreeqcEngine(self.meta['database'], iphreeqc_path)
+        try:
+            exact = run_batched(engine, inputs, self.meta['outputs'], chunksize=n)
+        finally:
+            if destroy:
+                engine.destroy()
+
+        err = np.abs(exact.loc[:, self.columns].values.astype(np.float64) - self.interpolate(points, method=method, as_array=True))
+        errors = pd.DataFrame({'max': np.nanmax(err, axis=0), 'rmse': np.sqrt(np.nanmean(err**2, axis=0)),
+                               'p95': np.nanpercentile(err, 95, axis=0)}, index=self.columns)
+        self.errors[method] = errors
+        return errors
+
+    def save(self, path):
+        """
+        Save the table to a `.npz` file.
+        """
+        np.savez(path, values=self.values, meta=json.dumps({
+            'axes': {k: v.tolist() for k, v in self.axes.items()},
+            'constants': {k: v.tolist() for k, v in self.constants.items()},
+            'columns': [list(c) for c in self.columns],
+            'meta': self.meta,
+            'errors': {m: e.values.tolist() for m, e in self.errors.items()}
+        }))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a table saved by `save`.
+        """
+        with np.load(path) as f:
+            values = f['values']
+            meta = json.loads(str(f['meta']))
+        columns = pd.MultiIndex.from_tuples([tuple(c) for c in meta['columns']])
+        axes = {k: [v] for k, v in meta['constants'].items()}
+        axes.update(meta['axes'])
+        table = cls(axes, values[(np.newaxis,) * len(meta['constants'])], columns, meta=meta['meta'])
+        table.errors = {m: pd.DataFrame(e, index=columns, columns=['max', 'rmse', 'p95']) for m, e in meta['errors'].items()}
+        return table
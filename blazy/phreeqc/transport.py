@@ -0,0 +1,172 @@
+"""
+Shared-memory transport of numeric blocks between the parent and pool workers.
+
+Rather than pickling DataFrames through the pool's pipes, the numeric columns
+of a DataFrame are copied into a `multiprocessing.shared_memory` block, and only
+a small descriptor (`SharedFrame`) is pickled. Whoever reads a SharedFrame with
+`unlink=True` frees the block, so each block is read once.
+"""
+
+import os
+from collections import deque
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory, resource_tracker
+
+# On Windows a block is freed when its last handle closes, so a worker cannot
+# hand a block it created back to the parent. Outputs are pickled instead.
+SHARE_OUTPUTS = os.name != 'nt'
+
+class SharedFrame:
+    """
+    A picklable handle on a DataFrame whose numeric columns are in shared memory.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The DataFrame to share. Numeric columns are copied into a new shared
+        memory block, as float64, and are restored to their original dtypes when
+        read. Other columns are stored as integer codes and their unique values,
+        which are pickled with the handle, as is the index.
+    """
+    def __init__(self, df):
+        numeric = [i for i, d in enumerate(df.dtypes) if pd.api.types.is_numeric_dtype(d)]
+        values = df.iloc[:, numeric].values.astype(np.float64)
+
+        self.shape = values.shape
+        self.index = df.index
+        self.columns = df.columns
+        self.numeric = numeric
+        self.dtypes = [df.dtypes.iloc[i] for i in numeric]
+        self.text = {}
+        for i in range(df.shape[1]):
+            if i not in numeric:
+                # missing values have code -1
+                codes, uniques = pd.factorize(df.iloc[:, i])
+                self.text[i] = (codes.astype(np.int32), np.asarray(uniques, dtype=object))
+
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(self.shape, dtype=np.float64, buffer=shm.buf)[:] = values
+        self.name = shm.name
+        shm.close()
+
+    def read(self, unlink=True):
+        """
+        Copy the DataFrame out of shared memory.
+
+        Parameters
+        ----------
+        unlink : bool
+            If True, the shared memory block is freed after it is read.
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            values = np.array(np.ndarray(self.shape, dtype=np.float64, buffer=shm.buf))
+        finally:
+            shm.close()
+            if unlink:
+                shm.unlink()
+
+        # build from columns, restoring dtypes, which pandas consolidates into one block per dtype
+        arrays = {j: values[:, j].astype(d, copy=False) for j, d in enumerate(self.dtypes)}
+        out = pd.DataFrame(arrays, index=self.index)
+        out.columns = self.columns[self.numeric]
+        for i, (codes, uniques) in self.text.items():
+            text = np.full(len(codes), np.nan, dtype=object)
+            found = codes >= 0
+            text[found] = uniques[codes[found]]
+            out.insert(i, self.columns[i], text)
+        return out
+
+    def unlink(self):
+        """
+        Free the shared memory block without reading it, if it has not already been freed.
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self.columns, pd.MultiIndex):
+            # column tuples pickle more compactly than a MultiIndex
+            state['columns'] = tuple(self.columns)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state['columns'], tuple):
+            state['columns'] = pd.MultiIndex.from_tuples(state['columns'])
+        self.__dict__.update(state)
+
+def start_tracker():
+    """
+    Start the shared memory resource tracker in this process.
+
+    Call before creating a pool, so that workers share the parent's tracker and
+    blocks created in one process and freed in another are tracked correctly.
+    """
+    resource_tracker.ensure_running()
+
+def _unlink_all(x):
+    """
+    Free the blocks of any SharedFrames in x, or in a tuple of arguments or results.
+    """
+    for item in (x if isinstance(x, tuple) else (x,)):
+        if isinstance(item, SharedFrame):
+            item.unlink()
+
+def imap_shared(pool, func, tasks, window):
+    """
+    Apply `func` to tuples of arguments holding SharedFrames, yielding the results in order.
+
+    Unlike `Pool.imap`, which consumes `tasks` as fast as it can, at most `window`
+    tasks are submitted at once, so that only their blocks are held in shared memory.
+
+    If the generator is closed before all results are read (e.g. on an error), the
+    blocks of the submitted tasks whose results were not read are freed. This waits
+    for tasks that are already running to finish, so the generator must be closed
+    while the pool is running.
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool
+        The pool to run tasks on.
+    func : callable
+        Picklable function applied to the arguments of each task.
+    tasks : iterable
+        Tuples of arguments for `func`.
+    window : int
+        Maximum number of tasks in flight.
+
+    Returns
+    -------
+    generator : yields the result of each task, in the order of `tasks`.
+    """
+    tasks = iter(tasks)
+    pending = deque()
+    try:
+        while True:
+            for args in tasks:
+                pending.append((args, pool.apply_async(func, args)))
+                if len(pending) >= window:
+                    break
+            if not pending:
+                return
+            result = pending[0][1].get()
+            pending.popleft()
+            yield result
+    finally:
+        # free inputs first, so that tasks which have not started fail at once
+        for args, _ in pending:
+            _unlink_all(args)
+        for _, result in pending:
+            result.wait()
+            if result.successful():
+                _unlink_all(result.get())
@@ -23,7 +23,7 @@ setup(name='blazy',
                    'Topic :: Scientific/Engineering',
                    'Programming Language :: Python :: 3',
                    ],
-      python_requires='>3.6',
+      python_requires='>=3.9',
       install_requires=['numpy',
                         'pandas',
                         'matplotlib',
@@ -39,4 +39,7 @@ setup(name='blazy',
         'latools': ['resources/*',
                     'resources/database/*'],
       },
+      entry_points={
+        'console_scripts': ['blazy-cache-databases=blazy.phreeqc.dbcache:main'],
+      },
       zip_safe=True)
@@ -0,0 +1,74 @@
+import time
+import asyncio
+import unittest
+import threading
+
+from blazy.phreeqc.aio import AsyncRunner
+
+class TestAsyncRunner(unittest.TestCase):
+
+    def setUp(self):
+        # no engines are created unless a PHREEQC job is run
+        self.runner = AsyncRunner(None, iphreeqc_path='unused', threads=2, max_pending=3)
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.runner.close()
+
+    def job(self, x):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        return x * 2
+
+    def test_stream(self):
+        async def main():
+            jobs = ((i, self.job, (i,)) for i in range(20))
+            return [r async for r in self.runner._stream(self.runner._threads, jobs)], self.runner._semaphore()._value
+
+        results, free = asyncio.run(main())
+        self.assertEqual(sorted(results), [(i, 2 * i) for i in range(20)])
+        self.assertLessEqual(self.max_running, 2)
+        self.assertEqual(free, 3)
+
+    def test_several_loops(self):
+        runner = AsyncRunner(None, iphreeqc_path='unused', threads=2, max_pending=1)
+
+        async def main():
+            jobs = ((i, self.job, (i,)) for i in range(5))
+            return [r async for r in runner._stream(runner._threads, jobs)]
+
+        try:
+            # the semaphore must not stay bound to the first loop
+            for _ in range(2):
+                self.assertEqual(sorted(asyncio.run(main())), [(i, 2 * i) for i in range(5)])
+        finally:
+            runner.close()
+        self.assertEqual(self.max_running, 1)
+
+    def test_timeout_cancels(self):
+        started = []
+        def slow(i):
+            started.append(i)
+            time.sleep(0.05)
+            return i
+
+        async def main():
+            async def collect():
+                return [r async for r in self.runner._stream(self.runner._threads, ((i, slow, (i,)) for i in range(50)))]
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(collect(), 0.08)
+            await asyncio.sleep(0.2)
+            return self.runner._semaphore()._value
+
+        free = asyncio.run(main())
+        self.assertLess(len(started), 10)
+        self.assertEqual(free, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+
+from blazy.chemistry import decompose_molecule, get_elements, get_charge, valence_long2short, valence_short2long, stoichiometry_matrix
+
+class TestFormulae(unittest.TestCase):
+
+    def test_decompose_molecule(self):
+        self.assertEqual(decompose_molecule('B(OH)4'), {'O': 4, 'H': 4, 'B': 1})
+        self.assertEqual(decompose_molecule('CaCO3', 2), {'Ca': 2, 'C': 2, 'O': 6})
+        self.assertEqual(decompose_molecule('Al(OH)2(SO4)'), {'O': 6, 'H': 2, 'S': 1, 'Al': 1})
+        self.assertEqual(decompose_molecule('Ca+2')['valence'], '+2')
+
+        # cached results are not shared between calls
+        d = decompose_molecule('CO2')
+        d['C'] = 10
+        self.assertEqual(decompose_molecule('CO2')['C'], 1)
+
+    def test_charges(self):
+        self.assertEqual(get_elements('CaB(OH)4+'), {'Ca', 'B', 'O', 'H'})
+        self.assertEqual(valence_long2short('Ca++'), 'Ca+2')
+        self.assertEqual(valence_short2long('SO4-2'), 'SO4--')
+        self.assertEqual([get_charge(s) for s in ['Ca+2', 'Ca++', 'HCO3-', 'B(OH)3', 'Na+']], [2, 2, -1, 0, 1])
+
+    def test_stoichiometry_matrix(self):
+        m, cols = stoichiometry_matrix(['CaCO3', 'B(OH)4-', 'Mg+2'], charge=True)
+        self.assertEqual(cols, ['B', 'C', 'Ca', 'H', 'Mg', 'O', 'charge'])
+        self.assertTrue(np.array_equal(m, [
+            [0, 1, 1, 0, 0, 3, 0],
+            [1, 0, 0, 4, 0, 4, -1],
+            [0, 0, 0, 0, 1, 0, 2],
+        ]))
+
+        m, cols = stoichiometry_matrix(['CaCO3', 'MgCO3'], elements=['Ca', 'Mg'])
+        self.assertTrue(np.array_equal(m, np.eye(2)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,14 @@
 import os
+import pickle
 import unittest
+import tempfile
+from unittest import mock
 from glob import glob
 import pkg_resources as pkgrs
 
-from blazy.phreeqc.parser import datParser
+from blazy.phreeqc.parser import datParser, reacsplit, remove_stoich
+from blazy.chemistry import get_elements
+from blazy.phreeqc import dbcache
 
 class TestDatabaseInteraction(unittest.TestCase):
 
@@ -50,5 +55,128 @@ class TestDatabaseInteraction(unittest.TestCase):
             else:
                 print('  -X skipped get_PHASES (no PHASES in database)')
 
+class TestDatabaseCache(unittest.TestCase):
+
+    def setUp(self):
+        self._cache_dir = os.environ.get('BLAZY_CACHE_DIR')
+        self.tmp = tempfile.TemporaryDirectory()
+        os.environ['BLAZY_CACHE_DIR'] = self.tmp.name
+
+    def tearDown(self):
+        if self._cache_dir is None:
+            os.environ.pop('BLAZY_CACHE_DIR', None)
+        else:
+            os.environ['BLAZY_CACHE_DIR'] = self._cache_dir
+        self.tmp.cleanup()
+
+    def test_opt_in(self):
+        datParser('pitzer', silent=True)
+        self.assertIsNotNone(dbcache.load_cached(datParser('pitzer', silent=True).path))
+
+        # without BLAZY_CACHE_DIR, the cache is only used if asked for
+        del os.environ['BLAZY_CACHE_DIR']
+        self.assertFalse(dbcache.enabled())
+        with mock.patch.object(dbcache, 'load_cached') as load, mock.patch.object(dbcache, 'save_cached') as save:
+            datParser('phreeqc', silent=True)
+        load.assert_not_called()
+        save.assert_not_called()
+
+    def test_cached_matches_parsed(self):
+        parsed = datParser('llnl', silent=True, use_cache=False)
+        self.assertIsNone(dbcache.load_cached(parsed.path))
+
+        dbcache.warm_cache(['llnl'], silent=True)
+        self.assertIsNotNone(dbcache.load_cached(parsed.path))
+        
+        cached = datParser('llnl', silent=True)
+        self.assertEqual(cached.sections, parsed.sections)
+        self.assertEqual(cached.element_2_master, parsed.element_2_master)
+        self.assertEqual(cached.parse_SOLUTION_SPECIES(), parsed.parse_SOLUTION_SPECIES())
+        self.assertEqual(cached.parse_PHASES(), parsed.parse_PHASES())
+        self.assertEqual(cached.get_SOLUTION_SPECIES('B'), parsed.get_SOLUTION_SPECIES('B'))
+
+    def test_invalidation(self):
+        src = pkgrs.resource_filename('blazy', os.path.join('resources', 'database', 'pitzer.dat'))
+        path = os.path.join(self.tmp.name, 'test.dat')
+        with open(src) as f:
+            dat = f.read()
+        with open(path, 'w') as f:
+            f.write(dat)
+
+        datParser(path, silent=True)
+        self.assertIsNotNone(dbcache.load_cached(path))
+
+        # changing the contents invalidates the entry
+        with open(path, 'w') as f:
+            f.write(dat.replace('Na+', 'Na+ ', 1))
+        os.utime(path, (0, 0))
+        self.assertIsNone(dbcache.load_cached(path))
+
+        # the entry is still valid if only the modification time changes
+        datParser(path, silent=True)
+        os.utime(path, (1, 1))
+        self.assertIsNotNone(dbcache.load_cached(path))
+
+        dbcache.invalidate(path)
+        self.assertIsNone(dbcache.load_cached(path))
+
+    def test_handle(self):
+        db = datParser('pitzer', silent=True)
+        outputs = db.generate_SELECTED_OUTPUT({'Ca', 'B'})
+        handle = pickle.loads(pickle.dumps(db.handle(outputs)))
+        self.assertLess(len(pickle.dumps(handle)), len(pickle.dumps(db)) / 10)
+        self.assertEqual(handle.outputs, outputs)
+        self.assertEqual(handle.hash, db.hash)
+
+        inputs = {'Ca': 10., 'B': 0.4, 'pH': 8.1}
+        self.assertEqual(handle.generate_SOLUTIONS(inputs), db.generate_SOLUTIONS(inputs))
+        self.assertIsNone(handle._parser)
+
+        # other methods rehydrate the full parser from the cache
+        self.assertEqual(handle.get_SOLUTION_SPECIES('B'), db.get_SOLUTION_SPECIES('B'))
+        with self.assertRaises(AttributeError):
+            handle.outputs = ''
+
+class TestIndexedQueries(unittest.TestCase):
+    """
+    Species and phase queries answered from the element index match a direct scan of the reactions.
+    """
+    targets = [{'Ca'}, {'C'}, {'B', 'Ca', 'Mg'}, {'Fe', 'S'}, {'Na', 'Cl', 'K', 'Sr', 'Ba'},
+               {'Ca', 'Mg', 'S', 'Si', 'Al', 'K', 'Na', 'Cl'}]
+
+    @classmethod
+    def setUpClass(cls):
+        # llnl has the most species, phreeqc many more parsed phases
+        cls.databases = [datParser(d, silent=True) for d in ['llnl', 'phreeqc']]
+
+    def test_species(self):
+        for db in self.databases:
+            products = [(remove_stoich(p), get_elements(p)) for s in db.parse_SOLUTION_SPECIES(remove_comments=True)
+                        for p in reacsplit(s)[1]]
+            for targets in self.targets:
+                foreign = {sp for sp, els in products if sp and els & targets}
+                native = {sp for sp, els in products if sp and els & targets and els <= targets}
+                self.assertEqual(db.get_SOLUTION_SPECIES(targets), foreign)
+                self.assertEqual(db.get_SOLUTION_SPECIES(targets, include_foreign=False), native)
+
+    def test_phases(self):
+        for db in self.databases:
+            formulas = {p: get_elements(reacsplit(lines[0])[0][0]) for p, lines in db.parse_PHASES().items() if lines}
+            for targets in self.targets:
+                for allow_HCO in [True, False]:
+                    allowed = targets | {'H', 'C', 'O'} if allow_HCO else targets
+                    expected = {p for p, els in formulas.items() if els & targets and els <= allowed}
+                    self.assertEqual(db.get_PHASES(targets, allow_HCO=allow_HCO), expected)
+
+        # a query that should find many phases
+        self.assertGreater(len(self.databases[1].get_PHASES(self.targets[-1])), 20)
+
+    def test_phases_parsed_once(self):
+        db = self.databases[1]
+        db.get_PHASES()
+        with mock.patch.object(db, 'parse_PHASES', side_effect=AssertionError('PHASES parsed again')):
+            self.assertGreater(len(db.get_PHASES()), 0)
+            db.get_PHASES(self.targets[-1])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
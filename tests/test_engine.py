@@ -0,0 +1,198 @@
+import re
+import time
+import unittest
+import threading
+import numpy as np
+import pandas as pd
+from unittest import mock
+
+from blazy.phreeqc.engine import PhreeqcEngine, EnginePool, chunk_solutions, merge_selected_output, run_batched
+from blazy.phreeqc.multiprocessing import collect_worker_stats
+
+class FakeEngine:
+    """Stands in for PhreeqcEngine, without loading IPhreeqc."""
+    def __init__(self, database, iphreeqc_path=None):
+        self.database = database
+        self.n_runs = 0
+        self.destroyed = False
+
+    def destroy(self):
+        self.destroyed = True
+
+class FakeIPhreeqc:
+    """Stands in for phreeqpy's IPhreeqc, recording the calls made to it."""
+    def __init__(self, iphreeqc_path):
+        self.calls = []
+
+    def load_database(self, database):
+        self.calls.append(('load_database', database))
+
+    def run_string(self, input_string):
+        self.calls.append(('run_string', input_string))
+
+    def get_selected_output_array(self):
+        return [['sim', 'state', 'soln', 'pH'], [1, 'i_soln', 1, 8.1]]
+
+    def destroy_iphreeqc(self):
+        self.calls.append(('destroy_iphreeqc',))
+
+class EchoEngine:
+    """Returns one raw selected output row per SOLUTION, in reverse order, with pH from the input."""
+    def __init__(self):
+        self.inputs = []
+
+    def run(self, input_string, parse_output=True):
+        self.inputs.append(input_string)
+        solutions = re.findall(r'SOLUTION (\d+)\n    pH\s+(\S+)', input_string)
+        return [['sim', 'state', 'soln', 'pH']] + [[1, 'i_soln', int(n), float(pH)] for n, pH in solutions[::-1]]
+
+class TestBatching(unittest.TestCase):
+
+    def setUp(self):
+        self.inputs = pd.DataFrame({'pH': np.linspace(7, 8, 5)}, index=list('edcba'))
+
+    def test_chunk_solutions(self):
+        batches = list(chunk_solutions(self.inputs, chunksize=2))
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.assertTrue(batches[2][0].startswith('SOLUTION 5'))
+
+        # a batch is started before max_chars would be exceeded, but holds at least one solution
+        length = len(batches[0][0])
+        self.assertEqual([len(b) for b in chunk_solutions(self.inputs, max_chars=2 * length)], [2, 2, 1])
+        self.assertEqual([len(b) for b in chunk_solutions(self.inputs, max_chars=1)], [1] * 5)
+        self.assertEqual(len(list(chunk_solutions(self.inputs))), 1)
+
+    def test_merge_selected_output(self):
+        header = ['sim', 'state', 'soln', 'pH']
+        arrays = [[header, [1, 'i_soln', 3, 7.3], [1, 'i_soln', 1, 7.1]], [header, [2, 'i_soln', 2, 7.2]]]
+        raw = merge_selected_output(arrays, parse_output=False)
+        self.assertEqual([r[2] for r in raw[1:]], [1, 2, 3])
+
+        out = merge_selected_output(arrays, index=['a', 'b', 'c'])
+        self.assertEqual(out.index.tolist(), ['a', 'b', 'c'])
+        self.assertEqual(out[('general', 'pH')].tolist(), [7.1, 7.2, 7.3])
+
+        self.assertEqual(merge_selected_output([], parse_output=False), [])
+        self.assertEqual(len(merge_selected_output([], index=[])), 0)
+
+    def test_run_batched(self):
+        engine = EchoEngine()
+        out = run_batched(engine, self.inputs, 'SELECTED_OUTPUT', chunksize=2)
+        self.assertEqual(len(engine.inputs), 3)
+        self.assertTrue(all(i.endswith('SELECTED_OUTPUT\nEND') for i in engine.inputs))
+        self.assertEqual(out.index.tolist(), list('edcba'))
+        self.assertTrue(np.allclose(out[('general', 'pH')], self.inputs['pH']))
+
+        self.assertEqual(len(run_batched(engine, self.inputs.iloc[:0], 'SELECTED_OUTPUT')), 0)
+
+@mock.patch('blazy.phreeqc.engine.phreeqc_mod.IPhreeqc', FakeIPhreeqc)
+class TestPhreeqcEngine(unittest.TestCase):
+
+    def test_run(self):
+        engine = PhreeqcEngine('pitzer', iphreeqc_path='iphreeqc')
+        self.assertTrue(engine.database.endswith('pitzer.dat'))
+        self.assertEqual(engine.phreeqc.calls, [('load_database', engine.database)])
+
+        out = engine.run('SOLUTION 1\nEND')
+        self.assertEqual(out[('general', 'pH')].tolist(), [8.1])
+        raw = engine.run('SOLUTION 1\nEND', parse_output=False)
+        self.assertEqual(raw[0], ['sim', 'state', 'soln', 'pH'])
+
+        # the database is loaded once, however many inputs are run
+        self.assertEqual([c[0] for c in engine.phreeqc.calls], ['load_database', 'run_string', 'run_string'])
+
+        stats = engine.stats()
+        self.assertEqual((stats['database'], stats['n_runs']), ('pitzer.dat', 2))
+        self.assertTrue(all(stats[k] >= 0 for k in ['startup_time', 'solve_time', 'parse_time']))
+
+    def test_destroy(self):
+        engine = PhreeqcEngine('pitzer', iphreeqc_path='iphreeqc')
+        phreeqc = engine.phreeqc
+        engine.destroy()
+        engine.destroy()
+        self.assertEqual(phreeqc.calls[-1], ('destroy_iphreeqc',))
+        self.assertEqual(len(phreeqc.calls), 2)
+
+class TestWorkerStats(unittest.TestCase):
+
+    def test_collect_worker_stats(self):
+        stats = [{'pid': 2, 'n_runs': 1, 'solve_time': 0.1}, {'pid': 1, 'n_runs': 1, 'solve_time': 0.2},
+                 {'pid': 2, 'n_runs': 3, 'solve_time': 0.5}, {'pid': 2, 'n_runs': 2, 'solve_time': 0.3}]
+        out = collect_worker_stats(stats)
+
+        # the latest (cumulative) counters of each worker, whatever order they arrive in
+        self.assertEqual(out.index.tolist(), [1, 2])
+        self.assertEqual(out['n_runs'].tolist(), [1, 3])
+        self.assertEqual(out['solve_time'].tolist(), [0.2, 0.5])
+
+@mock.patch('blazy.phreeqc.engine.PhreeqcEngine', FakeEngine)
+class TestEnginePool(unittest.TestCase):
+
+    def checkout_in_thread(self, pool, **kwargs):
+        result = {}
+        def target():
+            try:
+                result['engine'] = pool.checkout('pitzer', **kwargs)
+            except Exception as e:
+                result['error'] = e
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread, result
+
+    def test_checkout_blocks(self):
+        pool = EnginePool('iphreeqc', max_engines=1)
+        engine = pool.checkout('pitzer')
+        with self.assertRaises(TimeoutError):
+            pool.checkout('pitzer', timeout=0.05)
+
+        thread, result = self.checkout_in_thread(pool, timeout=5)
+        time.sleep(0.05)
+        self.assertTrue(thread.is_alive())
+        pool.checkin(engine)
+        thread.join(5)
+        self.assertIs(result['engine'], engine)
+        self.assertEqual(pool.n_created, 1)
+
+    def test_recycling(self):
+        pool = EnginePool('iphreeqc', max_runs=2)
+        engine = pool.checkout('pitzer')
+        engine.n_runs = 1
+        pool.checkin(engine)
+        self.assertIs(pool.checkout('pitzer'), engine)
+
+        engine.n_runs = 2
+        pool.checkin(engine)
+        self.assertTrue(engine.destroyed)
+        self.assertEqual(pool.n_recycled, 1)
+        self.assertIsNot(pool.checkout('pitzer'), engine)
+        self.assertEqual(pool.n_created, 2)
+
+    def test_stats(self):
+        pool = EnginePool('iphreeqc', max_runs=1)
+        a, b = pool.checkout('pitzer'), pool.checkout('pitzer')
+        self.assertEqual(pool.stats(), {'created': 2, 'recycled': 0, 'idle': {'pitzer.dat': 0}, 'busy': {'pitzer.dat': 2}})
+
+        b.n_runs = 1
+        pool.checkin(a)
+        pool.checkin(b)
+        self.assertEqual(pool.stats(), {'created': 2, 'recycled': 1, 'idle': {'pitzer.dat': 1}, 'busy': {'pitzer.dat': 0}})
+
+    def test_close(self):
+        pool = EnginePool('iphreeqc', max_engines=1)
+        engine = pool.checkout('pitzer')
+
+        thread, result = self.checkout_in_thread(pool)
+        time.sleep(0.05)
+        pool.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsInstance(result['error'], RuntimeError)
+
+        # engines in use are destroyed when checked in
+        pool.checkin(engine)
+        self.assertTrue(engine.destroyed)
+        with self.assertRaises(RuntimeError):
+            pool.checkout('pitzer')
+
+if __name__ == '__main__':
+    unittest.main()
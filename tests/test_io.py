@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from blazy.phreeqc.io import make_solution, format_solutions, make_solutions, iter_solutions, output_columns, output_parser
+
+class TestSolutionSerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'Na': [0.5, np.nan, 0.3],
+            'Cl': [0.5, 0.4, 0.3],
+            'pH': [8.1, 8.0, 7.9],
+            'units': ['mol/kgw', np.nan, 'mol/kgs']
+        })
+
+    def test_matches_make_solution(self):
+        expected = [make_solution(r, n) for n, r in self.df.iterrows()]
+        self.assertEqual(format_solutions(self.df).tolist(), expected)
+        self.assertEqual(make_solutions(self.df), '\n'.join(expected))
+
+    def test_numbers(self):
+        sols = format_solutions(self.df, numbers=[10, 11, 12])
+        self.assertTrue(sols[0].startswith('SOLUTION 10\n'))
+        self.assertNotIn('Na', sols[1])
+        self.assertNotIn('units', sols[1])
+
+    def test_iter_solutions(self):
+        chunks = list(iter_solutions(self.df, chunksize=2))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[1], make_solution(self.df.iloc[2], 2))
+
+class TestOutputParser(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = [
+            ['sim', 'state', 'soln', 'dist_x', 'pH', 'Na(mol/kgw)', 'm_Na+(mol/kgw)', 'la_Na+', 'si_Calcite'],
+            [1, 'i_soln', 1, -99.0, 8.1, 0.47, 0.46, -0.95, 0.6],
+            [1, 'i_soln', 2, -99.0, 8.2, 0.48, 0.47, -0.94, -999.999],
+        ]
+
+    def test_columns(self):
+        columns = output_columns(tuple(self.raw[0]))
+        self.assertEqual(list(columns), [
+            ('general', 'sim'), ('general', 'state'), ('general', 'soln'), ('general', 'dist_x'), ('general', 'pH'),
+            ('total (mol/kgw)', 'Na'), ('molality (mol/kgw)', 'Na+'), ('log10(activity)', 'Na+'), ('log10(saturation)', 'Calcite')])
+
+    def test_parser(self):
+        out = output_parser(self.raw)
+        self.assertTrue(out.columns.equals(output_columns(tuple(self.raw[0]))))
+        self.assertEqual(out[('general', 'state')].tolist(), ['i_soln', 'i_soln'])
+        self.assertEqual(out[('general', 'soln')].tolist(), [1, 2])
+        self.assertEqual(out[('log10(activity)', 'Na+')].tolist(), [-0.95, -0.94])
+
+        # integer columns stay integers, and missing values become NaN
+        self.assertEqual(out[('general', 'sim')].dtype, np.int64)
+        self.assertEqual(out[('general', 'soln')].dtype, np.int64)
+        self.assertEqual(out[('general', 'dist_x')].dtype, np.float64)
+        self.assertTrue(np.isnan(out[('log10(saturation)', 'Calcite')].iloc[1]))
+        self.assertEqual(output_parser(self.raw, missing_value=None)[('log10(saturation)', 'Calcite')].iloc[1], -999.999)
+
+        self.assertEqual(len(output_parser(self.raw[:1])), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,328 @@
+import os
+import unittest
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+from unittest import mock
+
+from blazy.phreeqc.montecarlo import mc_input_arrays, mc_input_dfs, mc_uniforms, correlation_matrices, concat_mc_results, calc_mc_quantiles, summarise_mc_sample, concat_mc_summaries, mc_converged, parse_output_targets, checkpoint_entropy, run_mc
+from blazy.phreeqc.parser import datParser
+from blazy.phreeqc.store import MCStore
+
+class SerialPool:
+    """Stands in for multiprocessing.Pool, running tasks in this process."""
+    def __init__(self, processes=None, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def istarmap(self, func, tasks):
+        for args in tasks:
+            yield func(*args)
+
+class MCEngine:
+    """Stands in for the PhreeqcEngine of pool workers, returning the Na and Cl of each solution."""
+    fail_after = None
+
+    def __init__(self, database, iphreeqc_path=None):
+        self.n_runs = 0
+
+    def run(self, input_string):
+        if MCEngine.fail_after is not None and self.n_runs >= MCEngine.fail_after:
+            raise RuntimeError('interrupted')
+        self.n_runs += 1
+        rows = []
+        for block in input_string.split('SOLUTION ')[1:]:
+            lines = block.split('\n')
+            values = dict(l.split()[:2] for l in lines[1:] if len(l.split()) > 1)
+            rows.append([int(lines[0]), 'i_soln', float(values['Na']), float(values['Cl'])])
+        return pd.DataFrame(rows, columns=pd.MultiIndex.from_tuples(
+            [('general', 'soln'), ('general', 'state'), ('molality (mol/kgw)', 'Na'), ('molality (mol/kgw)', 'Cl')]))
+
+    def stats(self):
+        return {'pid': os.getpid(), 'n_runs': self.n_runs}
+
+class TestMCInputs(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'Na': [0.5, 0.4, np.nan],
+            'Na_std': [0.01, np.nan, 0.1],
+            'Cl': [0.5, 0.5, 0.5],
+            'Cl_std': [0.01, 0.02, 0.03],
+            'pH': [8., 8., 8.],
+            'units': ['mol/kgw'] * 3
+        })
+
+    def test_mc_input_arrays(self):
+        numeric, values, constants = mc_input_arrays(self.df, N=500, random_state=0)
+
+        self.assertEqual(numeric, ['Na', 'Cl', 'pH'])
+        self.assertEqual(values.shape, (3, 500, 3))
+        self.assertEqual(values.dtype, np.float64)
+        self.assertEqual(constants.columns.tolist(), ['units'])
+
+        # columns without valid uncertainties are constant
+        self.assertTrue(np.all(values[1, :, 0] == 0.4))
+        self.assertTrue(np.all(np.isnan(values[2, :, 0])))
+        self.assertTrue(np.all(values[:, :, 2] == 8.))
+
+        # perturbed columns follow the distribution
+        self.assertAlmostEqual(values[0, :, 0].mean(), 0.5, places=2)
+        self.assertAlmostEqual(values[2, :, 1].std(), 0.03, places=2)
+
+    def test_reproducible(self):
+        _, a, _ = mc_input_arrays(self.df, N=10, random_state=42)
+        _, b, _ = mc_input_arrays(self.df, N=10, random_state=42)
+        self.assertTrue(np.array_equal(a, b, equal_nan=True))
+
+    def test_mc_input_dfs(self):
+        dfs = list(mc_input_dfs(self.df, N=10, random_state=0, block_size=2))
+
+        self.assertEqual(len(dfs), 3)
+        for out, _, _ in dfs:
+            self.assertEqual(out.shape, (10, 4))
+            self.assertEqual(out['Cl'].dtype, np.float64)
+            self.assertTrue(all(out['units'] == 'mol/kgw'))
+
+    def test_samplers(self):
+        for sampler in ['random', 'lhs', 'sobol', 'halton']:
+            u = mc_uniforms(3, 64, 2, sampler=sampler, random_state=0)
+            self.assertEqual(u.shape, (3, 64, 2))
+            self.assertTrue(np.all((u > 0) & (u < 1)))
+            self.assertTrue(np.array_equal(u, mc_uniforms(3, 64, 2, sampler=sampler, random_state=0)))
+
+            _, values, _ = mc_input_arrays(self.df, N=64, sampler=sampler, random_state=0)
+            self.assertAlmostEqual(values[0, :, 0].mean(), 0.5, places=2)
+            self.assertTrue(np.all(values[1, :, 0] == 0.4))
+
+        # Latin hypercube: exactly one point in each of the N strata
+        u = mc_uniforms(2, 10, 3, sampler='lhs', random_state=0)
+        self.assertTrue(np.all(np.sort(np.floor(u * 10), axis=1) == np.arange(10)[:, np.newaxis]))
+
+        with self.assertRaises(ValueError):
+            mc_uniforms(1, 10, 1, sampler='unknown')
+
+        # scipy's balance warning is shown once, rather than for every sample
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            mc_uniforms(20, 1000, 2, sampler='sobol', random_state=0)
+        self.assertEqual(len(w), 1)
+        self.assertIn('balance properties of Sobol', str(w[0].message))
+
+    def test_correlation(self):
+        df = pd.DataFrame({'Na': [0.5, 0.4], 'Na_std': [0.01, 0.02], 'Cl': [0.5, 0.5], 'Cl_std': [0.01, 0.01], 
+                           'Mg': [0.05, 0.05], 'Mg_std': [0.001, 0.001]}, index=['a', 'b'])
+        R = pd.DataFrame([[1, 0.8], [0.8, 1]], index=['Na', 'Cl'], columns=['Na', 'Cl'])
+        
+        _, values, _ = mc_input_arrays(df, N=20000, correlation=R, random_state=0)
+        r = np.corrcoef(values[0].T)
+        self.assertAlmostEqual(r[0, 1], 0.8, places=1)
+        self.assertAlmostEqual(r[0, 2], 0, places=1)
+        self.assertAlmostEqual(values[1, :, 0].std(), 0.02, places=3)
+
+        # per-sample, perfectly correlated
+        ones = pd.DataFrame(1., index=['Na', 'Cl', 'Mg'], columns=['Na', 'Cl', 'Mg'])
+        _, values, _ = mc_input_arrays(df, N=1000, correlation={'b': ones}, random_state=0, sampler='lhs')
+        self.assertTrue(np.allclose(np.corrcoef(values[1].T), 1))
+        self.assertAlmostEqual(np.corrcoef(values[0].T)[0, 1], 0, places=1)
+
+        # covariance replaces the uncertainty columns
+        cov = pd.DataFrame([[4e-4, 1e-4], [1e-4, 1e-4]], index=['Na', 'Cl'], columns=['Na', 'Cl'])
+        _, values, _ = mc_input_arrays(df, N=20000, covariance=cov, random_state=0)
+        self.assertTrue(np.allclose(np.cov(values[0, :, :2].T), cov.values, atol=1e-5))
+
+        with self.assertRaises(ValueError):
+            mc_input_arrays(df, N=10, correlation=R, covariance=cov)
+
+    def test_correlation_matrices(self):
+        df = pd.DataFrame({'Na': [0.5, 0.4, 0.3]}, index=['a', 'b', 'a'])
+        columns = ['Na', 'Cl', 'Mg']
+        cov = pd.DataFrame([[4e-4, 1e-4], [1e-4, 1e-4]], index=['Na', 'Cl'], columns=['Na', 'Cl'])
+
+        # a single matrix is expanded once for all samples
+        R, std = correlation_matrices(df, columns, covariance=cov)
+        self.assertEqual(R.shape, (3, 3, 3))
+        self.assertTrue(np.allclose(R[:, 0, 1], 0.5))
+        self.assertTrue(np.allclose(R[:, 2], [0, 0, 1]))
+        self.assertTrue(np.allclose(std[:, :2], [0.02, 0.01]))
+        self.assertTrue(np.isnan(std[:, 2]).all())
+
+        # per-sample matrices apply to every row with the label, and unknown labels are ignored
+        R, std = correlation_matrices(df, columns, correlation={'a': np.ones((3, 3)), 'z': np.ones((3, 3))})
+        self.assertTrue(np.allclose(R[[0, 2]], 1))
+        self.assertTrue(np.allclose(R[1], np.eye(3)))
+        self.assertTrue(np.isnan(std).all())
+
+    def test_no_uncertainties(self):
+        with self.assertRaises(ValueError):
+            mc_input_arrays(self.df.loc[:, ['Na', 'Cl']], N=10)
+
+def make_result(seed, N=5):
+    rng = np.random.default_rng(seed)
+    out = pd.DataFrame(rng.normal(size=(N, 3)), columns=pd.MultiIndex.from_tuples(
+        [('general', 'pH'), ('molality (mol/kgw)', 'Na+'), ('log10(activity)', 'Na+')]))
+    out.insert(1, ('general', 'state'), 'i_soln')
+    return out
+
+class TestMCSummaries(unittest.TestCase):
+
+    def test_matches_calc_mc_quantiles(self):
+        results = [make_result(i, N=50) for i in range(4)]
+        quantiles = [0.025, 0.5, 0.975]
+
+        expected = calc_mc_quantiles(concat_mc_results([r.copy() for r in results]))
+        summary = concat_mc_summaries([summarise_mc_sample(r, quantiles, covariance=True) for r in results], quantiles)
+
+        pd.testing.assert_frame_equal(summary['quantiles'], expected)
+        self.assertEqual(summary['mean'].shape, (4, 3))
+        self.assertAlmostEqual(summary['std'].iloc[2, 0], results[2].iloc[:, 0].std())
+        self.assertEqual(summary['N'].tolist(), [50] * 4)
+        self.assertEqual(summary['cov'].shape, (12, 3))
+
+class TestMCConvergence(unittest.TestCase):
+
+    def test_parse_output_targets(self):
+        self.assertEqual(parse_output_targets(['pH', 'm_B(OH)4-(mol/kgw)', 'si_Calcite', ('general', 'temp')]), 
+                         [('general', 'pH'), ('molality (mol/kgw)', 'B(OH)4-'), ('log10(saturation)', 'Calcite'), ('general', 'temp')])
+
+    def test_sem(self):
+        out = make_result(0, N=400)
+        targets = [('general', 'pH')]
+        converged, sem = mc_converged(out, targets, tol=0.1)
+        self.assertTrue(converged)
+        self.assertAlmostEqual(sem.iloc[0], out[targets[0]].std() / 20)
+        self.assertFalse(mc_converged(out, targets, tol={('general', 'pH'): 0.01})[0])
+
+    def test_quantiles(self):
+        out = make_result(0, N=400)
+        targets = [('general', 'pH'), ('log10(activity)', 'Na+')]
+        converged, q = mc_converged(out.iloc[:200], targets, tol=0.05, criterion='quantiles', quantiles=[0.5])
+        self.assertFalse(converged)
+        converged, _ = mc_converged(out, targets, tol=1., criterion='quantiles', quantiles=[0.5], previous=q)
+        self.assertTrue(converged)
+
+class TestMCStore(unittest.TestCase):
+
+    def make_result(self, seed):
+        return make_result(seed)
+
+    def test_roundtrip(self):
+        results = [self.make_result(i) for i in range(3)]
+        with tempfile.TemporaryDirectory() as tmp:
+            store = MCStore(tmp)
+            for i, r in enumerate(results):
+                store.append(i, r)
+            
+            expected = concat_mc_results([r.copy() for r in results])
+
+            reopened = MCStore(tmp)
+            self.assertEqual(reopened.samples, [0, 1, 2])
+            self.assertIn(1, reopened)
+            self.assertNotIn(3, reopened)
+            pd.testing.assert_frame_equal(reopened.read(), expected)
+            pd.testing.assert_frame_equal(reopened[1], expected.loc[[1]])
+            self.assertEqual(reopened.read(samples=[2], columns=[('general', 'pH')]).shape, (5, 1))
+
+            with self.assertRaises(ValueError):
+                store.append(3, results[0].iloc[:, :2])
+
+    def test_dtypes(self):
+        result = self.make_result(0)
+        result.insert(0, ('general', 'soln'), np.arange(1, 6))
+        result[('general', 'state')] = ['i_soln', None, 'react', 'nan', None]
+        with tempfile.TemporaryDirectory() as tmp:
+            MCStore(tmp).append(0, result)
+            out = MCStore(tmp)[0]
+
+        self.assertEqual(out[('general', 'soln')].dtype, np.int64)
+        pd.testing.assert_frame_equal(out.reset_index(drop=True), result)
+        # missing text stays missing, and is not confused with the string 'nan'
+        self.assertEqual(out[('general', 'state')].isna().tolist(), [False, True, False, False, True])
+
+    def test_checkpoint_entropy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = MCStore(tmp)
+            entropy = checkpoint_entropy(store, N=100, n_samples=4)
+            store.append(0, self.make_result(0))
+            
+            reopened = MCStore(tmp)
+            self.assertEqual(reopened.meta, {'entropy': entropy, 'N': 100, 'n_samples': 4})
+            self.assertEqual(checkpoint_entropy(reopened, N=100, n_samples=4, resume=True), entropy)
+
+            with self.assertRaises(ValueError):
+                checkpoint_entropy(reopened, N=200, n_samples=4, resume=True)
+            with self.assertRaises(ValueError):
+                checkpoint_entropy(reopened, N=100, n_samples=4, random_state=entropy + 1, resume=True)
+            
+            # a new run cannot write into a store that has samples
+            with self.assertRaises(ValueError):
+                checkpoint_entropy(reopened, N=100, n_samples=2, random_state=1)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = MCStore(tmp)
+            checkpoint_entropy(store, N=100, n_samples=4)
+            # a new run in an empty store replaces the seed
+            self.assertEqual(checkpoint_entropy(store, N=100, n_samples=4, random_state=1), 1)
+
+    def test_interrupted_append(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = MCStore(tmp)
+            store.append(0, self.make_result(0))
+            self.assertTrue(store._text)
+
+            # a sample is only complete once its values file is written
+            result = self.make_result(1)
+            text = result.iloc[:, store._text].values.astype(str)
+            with open(store._sample_file(1, 'text'), 'wb') as f:
+                np.savez(f, text=text, missing=np.zeros(text.shape, dtype=bool))
+            self.assertNotIn(1, store)
+            self.assertEqual(store.samples, [0])
+            store.read()
+
+@mock.patch('blazy.phreeqc.multiprocessing.PhreeqcEngine', MCEngine)
+@mock.patch('blazy.phreeqc.montecarlo.mp.Pool', SerialPool)
+class TestRunMCStore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = datParser('pitzer', silent=True)
+        cls.inputs = pd.DataFrame({'Na': np.linspace(440, 480, 6), 'Na_std': 5., 'Cl': 500., 'Cl_std': 4., 'units': 'mmol/kgw'})
+
+    def tearDown(self):
+        MCEngine.fail_after = None
+
+    def run_mc(self, store, **kwargs):
+        return run_mc(self.inputs, N=8, database=self.db, store=store, random_state=3, processes=1, **kwargs)
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            expected = self.run_mc(os.path.join(tmp, 'once')).read()
+
+            store = os.path.join(tmp, 'resumed')
+            MCEngine.fail_after = 2
+            with self.assertRaises(RuntimeError):
+                self.run_mc(store)
+            self.assertEqual(MCStore(store).samples, [0, 1])
+
+            MCEngine.fail_after = None
+            with self.assertRaises(ValueError):
+                self.run_mc(store)
+            pd.testing.assert_frame_equal(self.run_mc(store, resume=True).read(), expected)
+
+    def test_invalid_arguments(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = os.path.join(tmp, 'store')
+            with self.assertRaises(ValueError):
+                self.run_mc(store, aggregate=True)
+            # nothing is written before the arguments are checked
+            self.assertFalse(os.path.exists(store))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import numpy as np
+import pandas as pd
+from unittest import mock
+
+from blazy.phreeqc.multiprocessing import df_starchunking, run_parallel
+from tests.test_engine import EchoEngine
+
+class WorkerEngine(EchoEngine):
+    """An EchoEngine made by `init_worker`, in place of PhreeqcEngine."""
+    def __init__(self, database, iphreeqc_path=None):
+        super().__init__()
+
+class SerialPool:
+    """Stands in for multiprocessing.Pool, running tasks in this process."""
+    def __init__(self, processes=None, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def imap(self, func, tasks):
+        return map(func, tasks)
+
+class TestChunking(unittest.TestCase):
+
+    def test_df_starchunking(self):
+        df = pd.DataFrame({'Na': np.arange(10.), 'pH': 8.}, index=[f's{i}' for i in range(10)][::-1])
+        chunks = list(df_starchunking(df, 4, 'outputs', None))
+
+        self.assertEqual([len(c) for c, _, _ in chunks], [4, 4, 2])
+        self.assertTrue(all(o == 'outputs' and db is None for _, o, db in chunks))
+        self.assertTrue(pd.concat([c for c, _, _ in chunks]).equals(df))
+
+    def test_duplicate_labels(self):
+        # e.g. concatenated replicate frames
+        df = pd.DataFrame({'Na': np.arange(6.)}, index=[0, 1, 0, 1, 0, 1])
+        chunks = [c for c, _, _ in df_starchunking(df, 2, 'outputs', None)]
+
+        self.assertEqual(len(chunks), 3)
+        out = pd.concat(chunks)
+        self.assertEqual(out.index.tolist(), [0, 1, 0, 1, 0, 1])
+        self.assertEqual(out['Na'].tolist(), df['Na'].tolist())
+
+@mock.patch('blazy.phreeqc.multiprocessing.PhreeqcEngine', WorkerEngine)
+@mock.patch('blazy.phreeqc.multiprocessing.mp.Pool', SerialPool)
+class TestRunParallel(unittest.TestCase):
+
+    def test_run_parallel(self):
+        inputs = pd.DataFrame({'pH': np.linspace(7, 8, 7)}, index=list('gfedcba'))
+        out = run_parallel('pitzer', inputs, 'SELECTED_OUTPUT', n_jobs=2, chunksize=3)
+
+        self.assertEqual(out.index.tolist(), list('gfedcba'))
+        # solutions are numbered across chunks, by position in the whole input
+        self.assertEqual(out[('general', 'soln')].tolist(), list(range(1, 8)))
+        self.assertEqual(out.columns.tolist(), [('general', 'sim'), ('general', 'state'), ('general', 'soln'), ('general', 'pH')])
+        self.assertTrue(np.allclose(out[('general', 'pH')], inputs['pH']))
+
+    def test_empty(self):
+        with mock.patch.object(SerialPool, '__init__', side_effect=AssertionError('pool started')):
+            out = run_parallel('pitzer', pd.DataFrame({'pH': []}), 'SELECTED_OUTPUT')
+        self.assertEqual(len(out), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import unittest
+import tempfile
+import pandas as pd
+
+from blazy.phreeqc.resultcache import ResultCache, solution_keys, run_cached
+from tests.test_engine import EchoEngine
+
+class TestResultCache(unittest.TestCase):
+
+    header = ('soln', 'pH')
+
+    def test_keys(self):
+        sols = ['SOLUTION 1\n    Na    1.0\n', 'SOLUTION 2\n    Na    1.0\n', 'SOLUTION 3\n    Na    2.0\n']
+        keys = solution_keys(sols, '-pH', 'abc')
+        self.assertEqual(keys[0], keys[1])  # solution number is ignored
+        self.assertNotEqual(keys[0], keys[2])
+        self.assertNotEqual(keys[0], solution_keys(sols, '-pH', 'abd')[0])
+        self.assertNotEqual(keys[0], solution_keys(sols, '-pe', 'abc')[0])
+
+    def test_lru(self):
+        cache = ResultCache(max_entries=2)
+        cache.put_many({'a': (self.header, (1, 8.)), 'b': (self.header, (2, 7.))})
+        cache.get_many(['a'])
+        cache.put_many({'c': (self.header, (3, 6.))})  # evicts b, the least recently used
+        
+        found = cache.get_many(['a', 'b', 'c'])
+        self.assertEqual(set(found), {'a', 'c'})
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (3, 1, 1))
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'results.sqlite')
+            cache = ResultCache(max_entries=1, path=path)
+            cache.put_many({'a': (self.header, (1, 8.)), 'b': (self.header, (2, 7.))})
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(cache.get_many(['a'])['a'], (self.header, (1, 8.)))
+            self.assertEqual(cache.stats()['disk_hits'], 1)
+
+            reopened = ResultCache(path=path)
+            self.assertEqual(set(reopened.get_many(['a', 'b'])), {'a', 'b'})
+            reopened.clear()
+            self.assertEqual(ResultCache(path=path).get_many(['a', 'b']), {})
+
+    def test_run_cached(self):
+        engine = EchoEngine()
+        cache = ResultCache()
+        inputs = pd.DataFrame({'pH': [7., 7.5, 7.]}, index=list('abc'))
+
+        out = run_cached(engine, inputs, 'SELECTED_OUTPUT', cache, 'abc')
+        self.assertEqual(out.index.tolist(), list('abc'))
+        self.assertEqual(out[('general', 'pH')].tolist(), [7., 7.5, 7.])
+        self.assertEqual(out[('general', 'soln')].tolist(), [1, 2, 3])
+        self.assertEqual(cache.duplicates, 1)
+
+        # all cached, so nothing is run
+        run_cached(engine, inputs, 'SELECTED_OUTPUT', cache, 'abc')
+        self.assertEqual(len(engine.inputs), 1)
+
+        self.assertEqual(len(run_cached(engine, inputs.iloc[:0], 'SELECTED_OUTPUT', cache, 'abc')), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+from blazy.phreeqc.parser import datParser
+from blazy.phreeqc.scheduler import cost_features, CostModel, run_scheduled
+
+class TestScheduler(unittest.TestCase):
+
+    def test_cost_features(self):
+        db = datParser('pitzer', silent=True)
+        df = pd.DataFrame({'Na': [0.5, 0.01], 'Cl': [0.5, 0.01], 'Ca': [0.01, np.nan], 'pH': [8, 8], 'units': ['mol/kgw', 'mol/kgw']})
+        f = cost_features(df, db, N=100)
+        self.assertEqual(f['n_elements'].tolist(), [3, 2])
+        self.assertAlmostEqual(f['ionic_strength'].iloc[0], 0.5 * (0.5 + 0.5 + 4 * 0.01))
+        self.assertEqual(f['database'].iloc[0], 4.)
+
+    def test_cost_model(self):
+        rng = np.random.default_rng(0)
+        f = pd.DataFrame({'n_elements': rng.integers(1, 12, 50), 'ionic_strength': rng.uniform(0, 5, 50), 'N': 100, 'database': 1.})
+        seconds = 1e-4 * f['N'] * (1 + f['n_elements'])**2 * (1 + f['ionic_strength'])
+        
+        model = CostModel()
+        model.update(f.iloc[:4], seconds.values[:4])
+        self.assertTrue(np.allclose(model.coef[1:], 0))
+        model.update(f.iloc[4:], seconds.values[4:])
+        self.assertTrue(np.allclose(model.predict(f), seconds))
+
+    def test_run_scheduled(self):
+        tasks = {f's{i}': (2, i) for i in range(30)}
+        tasks['s0'] = lambda: (3, 2)  # arguments made on dispatch
+        features = pd.DataFrame({'n_elements': np.arange(30), 'ionic_strength': 0., 'N': 1, 'database': 1.}, index=list(tasks))
+        
+        with mp.Pool(2) as pool:
+            results = list(run_scheduled(pool, pow, tasks, features, processes=2, target_time=1e-4))
+        
+        self.assertEqual(dict(results), {**{f's{i}': 2**i for i in range(30)}, 's0': 9})
+        # the most expensive tasks run first
+        self.assertIn(results[0][0], ['s29', 's28', 's27', 's26'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from blazy.phreeqc.sensitivity import fd_steps, fd_backward_steps, fd_design, fd_jacobian
+
+class TestFiniteDifferences(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({'Ca': [0.01, 0.02], 'pH': [8., 0.], 'units': ['mol/kgw'] * 2})
+
+    def test_steps(self):
+        h = fd_steps(self.df, ['Ca', 'pH'], rel_step=1e-3)
+        self.assertTrue(np.allclose(h, [[1e-5, 8e-3], [2e-5, 1e-3]]))
+        h = fd_steps(self.df, ['Ca', 'pH'], abs_step={'pH': 0.01})
+        self.assertTrue(np.allclose(h[:, 1], 0.01))
+
+    def test_design(self):
+        steps = fd_steps(self.df, ['Ca', 'pH'])
+        design = fd_design(self.df, ['Ca', 'pH'], steps)
+
+        self.assertEqual(design.shape, (10, 3))
+        self.assertTrue(all(design['units'] == 'mol/kgw'))
+        self.assertTrue(np.allclose(design['Ca'].values[:5] - 0.01, [0, 1e-5, 0, -1e-5, 0]))
+        self.assertTrue(np.allclose(design['pH'].values[5:], [0, 0, 1e-3, 0, -1e-3]))
+
+    def test_jacobian(self):
+        steps = fd_steps(self.df, ['Ca', 'pH'])
+        x = fd_design(self.df, ['Ca', 'pH'], steps).loc[:, ['Ca', 'pH']].values
+        out = np.column_stack([3 * x[:, 0] + x[:, 1] ** 2, np.log10(x[:, 0])])
+
+        J = fd_jacobian(out, steps)
+        self.assertEqual(J.shape, (2, 2, 2))
+        self.assertTrue(np.allclose(J[:, 0], [[3, 16], [3, 0]]))
+        self.assertTrue(np.allclose(J[:, 1, 0], 1 / (np.log(10) * self.df['Ca'].values)))
+
+    def test_nonnegative(self):
+        df = pd.DataFrame({'Ca': [0.01, 0.], 'pH': [8., 0.]})
+        steps = fd_steps(df, ['Ca', 'pH'], abs_step={'Ca': 0.02})
+        backward = fd_backward_steps(df, ['Ca', 'pH'], steps)
+        # concentrations are not stepped below zero, but pH may be
+        self.assertTrue(np.allclose(backward, [[0, 8e-3], [0, 1e-3]]))
+
+        design = fd_design(df, ['Ca', 'pH'], steps, backward)
+        self.assertTrue((design['Ca'] >= 0).all())
+        self.assertEqual(design['pH'].min(), -1e-3)
+
+        x = design.loc[:, ['Ca', 'pH']].values
+        out = np.column_stack([3 * x[:, 0] + x[:, 1] ** 2])
+        J = fd_jacobian(out, steps, backward)
+        # exact for the linear term, forward difference in Ca, central in pH
+        self.assertTrue(np.allclose(J[:, 0], [[3, 16], [3, 0]]))
+
+if __name__ == '__main__':
+    unittest.main()
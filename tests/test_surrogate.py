@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from blazy.phreeqc.surrogate import LinearSurrogate, GPSurrogate
+
+class TestSurrogates(unittest.TestCase):
+
+    def setUp(self):
+        self.x0 = np.array([8.1, 25.])
+        self.std = np.array([0.01, 1.])
+        self.f = lambda X: np.column_stack([2 * X[:, 0] - X[:, 1], np.sin(X[:, 1] / 10)])
+
+    def test_linear(self):
+        J = np.array([[2., -1.], [0., np.cos(2.5) / 10]])
+        center = pd.DataFrame(self.f(self.x0[np.newaxis]))
+        model = LinearSurrogate(center, J, self.x0)
+
+        X = self.x0 + np.random.default_rng(0).normal(size=(50, 2)) * self.std
+        pred = model.predict(X)
+        self.assertEqual(pred.shape, (50, 2))
+        self.assertTrue(np.allclose(pred[:, 0], self.f(X)[:, 0]))
+        self.assertTrue(np.allclose(pred[:, 1], self.f(X)[:, 1], atol=0.05))
+
+    def test_gp(self):
+        rng = np.random.default_rng(0)
+        X = self.x0 + rng.normal(size=(30, 2)) * self.std
+        model = GPSurrogate(X, self.f(X), self.x0, self.std)
+
+        Xt = self.x0 + rng.normal(size=(50, 2)) * self.std
+        self.assertTrue(np.allclose(model.predict(Xt), self.f(Xt), atol=0.02))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import tempfile
+import numpy as np
+import pandas as pd
+
+from blazy.phreeqc.parser import datParser
+from blazy.phreeqc.sweep import grid_points, compose_solutions, GridStore, sweep
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.axes = {'temperature': [5., 25.], 'salinity': [30., 35., 40.], 'pH': [7.8, 8.2]}
+        self.columns = pd.MultiIndex.from_tuples([('general', 'pH'), ('log10(activity)', 'B(OH)4-')])
+
+    def test_grid_points(self):
+        points = grid_points(self.axes, np.arange(12))
+        expected = pd.MultiIndex.from_product(list(self.axes.values())).to_frame(index=False)
+        self.assertTrue(np.array_equal(points.values, expected.values))
+        self.assertEqual(grid_points(self.axes, [7]).iloc[0].tolist(), [25., 30., 8.2])
+
+    def test_compose_solutions(self):
+        sol = compose_solutions(grid_points(self.axes, [0, 5]), base={'B': 0.0004})
+        self.assertAlmostEqual(sol.loc[5, 'Na'], 0.46906 * 40 / 35)
+        self.assertEqual(sol['B'].tolist(), [0.0004, 0.0004])
+        self.assertNotIn('salinity', sol.columns)
+        self.assertEqual(sol['pH'].tolist(), [7.8, 8.2])
+
+    def test_store_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = GridStore(self.axes, path=tmp)
+            self.assertEqual(len(store.todo()), 12)
+
+            out = pd.DataFrame(np.arange(10.).reshape(5, 2), index=[0, 1, 2, 3, 11], columns=self.columns)
+            store.write(out)
+            store.flush()
+            del store
+
+            store = GridStore(self.axes, path=tmp)
+            self.assertEqual(store.todo().tolist(), list(range(4, 11)))
+            self.assertEqual(store.values.shape, (2, 3, 2, 2))
+            self.assertEqual(store.get(('general', 'pH'))[1, 2, 1], 8.)
+            self.assertTrue(np.isnan(store.values[1, 0, 0]).all())
+            self.assertEqual(store.to_frame().loc[(5., 30., 8.2)].tolist(), [2., 3.])
+
+            with self.assertRaises(ValueError):
+                GridStore({'pH': [7.]}, path=tmp)
+
+    def test_empty_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = GridStore(self.axes, path=tmp)
+            store.flush()
+            with self.assertRaises(ValueError):
+                store.to_frame()
+            with self.assertRaises(ValueError):
+                store.get(('general', 'pH'))
+
+    def test_resume_mismatch(self):
+        db = datParser('pitzer', silent=True)
+        with tempfile.TemporaryDirectory() as tmp:
+            store = GridStore(self.axes, path=tmp)
+            store.write(pd.DataFrame(np.zeros((12, 2)), columns=self.columns))
+            store.flush()
+
+            # a completed sweep is returned without running PHREEQC, once its meta is recorded
+            sweep(self.axes, db, base={'B': 0.0004}, path=tmp)
+            self.assertEqual(GridStore(self.axes, path=tmp).meta['base'], {'B': 0.0004})
+            sweep(self.axes, db, base={'B': 0.0004}, path=tmp)
+
+            with self.assertRaises(ValueError):
+                sweep(self.axes, db, base={'B': 0.0005}, path=tmp)
+            with self.assertRaises(ValueError):
+                sweep(self.axes, datParser('phreeqc', silent=True), base={'B': 0.0004}, path=tmp)
+            with self.assertRaises(ValueError):
+                sweep(self.axes, db, base={'B': 0.0004}, path=tmp, targets=['B'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import unittest
+import tempfile
+import numpy as np
+import pandas as pd
+
+from blazy.phreeqc.table import SpeciationTable
+from blazy.phreeqc.sweep import GridStore
+
+class TestSpeciationTable(unittest.TestCase):
+
+    def setUp(self):
+        self.axes = {'temperature': [25., 5., 15.], 'pH': np.linspace(7, 9, 5), 'B': [0.0004]}
+        T, pH = np.meshgrid(self.axes['temperature'], self.axes['pH'], indexing='ij')
+        self.values = np.stack([2 * T + pH, T * pH], axis=-1)[:, :, np.newaxis]
+        self.columns = pd.MultiIndex.from_tuples([('a', 'x'), ('b', 'y')])
+        self.table = SpeciationTable(self.axes, self.values, self.columns)
+
+    def test_interpolate(self):
+        points = pd.DataFrame({'temperature': [10., 20., 12.5], 'pH': [7.25, 8.1, 8.9]}, index=['p', 'q', 'r'])
+        out = self.table.interpolate(points)
+        self.assertEqual(out.index.tolist(), ['p', 'q', 'r'])
+        self.assertTrue(np.allclose(out[('a', 'x')], 2 * points.temperature + points.pH))
+
+        arr = self.table(points.values, outputs=[('b', 'y')], as_array=True)
+        self.assertEqual(arr.shape, (3, 1))
+        self.assertTrue(np.isnan(self.table({'temperature': 30., 'pH': 8.}, as_array=True)).all())
+
+    def test_missing_points(self):
+        values = self.values.copy()
+        values[1, 2] = np.nan
+        table = SpeciationTable(self.axes, values, self.columns)
+        self.assertFalse(table.complete)
+        out = table.interpolate({'temperature': [5.], 'pH': [8.]}, as_array=True)
+        self.assertTrue(np.allclose(out[0, 0], 18.))
+        with self.assertRaises(ValueError):
+            table.interpolate({'temperature': [5.], 'pH': [8.]}, method='cubic')
+
+    def test_empty_grid(self):
+        with self.assertRaises(ValueError):
+            SpeciationTable.from_grid(GridStore(self.axes))
+
+    def test_save_load(self):
+        self.table.errors['linear'] = pd.DataFrame(0., index=self.columns, columns=['max', 'rmse', 'p95'])
+        with tempfile.TemporaryDirectory() as tmp:
+            self.table.save(os.path.join(tmp, 'table.npz'))
+            table = SpeciationTable.load(os.path.join(tmp, 'table.npz'))
+        
+        points = self.table.random_points(20, random_state=0)
+        self.assertTrue(np.allclose(table(points, as_array=True), self.table(points, as_array=True)))
+        self.assertEqual(table.constants, {'B': 0.0004})
+        self.assertIn('linear', table.errors)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import pickle
+import unittest
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from blazy.phreeqc.transport import SharedFrame, imap_shared, start_tracker
+
+def double(shared):
+    df = shared.read(unlink=True)
+    return SharedFrame(df * 2)
+
+def shm_blocks():
+    return {f for f in os.listdir('/dev/shm') if f.startswith('psm_')}
+
+class TestTransport(unittest.TestCase):
+
+    def test_round_trip(self):
+        df = pd.DataFrame({'Na': np.linspace(400, 500, 7), 'pH': 8.1, 'units': ['mmol/kgw'] * 6 + ['mol/kgw'], 'n': np.arange(7)},
+                          index=[f's{i}' for i in range(7)])
+        shared = pickle.loads(pickle.dumps(SharedFrame(df)))
+        out = shared.read()
+        self.assertEqual(list(out.columns), list(df.columns))
+        self.assertTrue(out.index.equals(df.index))
+        self.assertTrue(np.array_equal(out[['Na', 'pH', 'n']].values, df[['Na', 'pH', 'n']].values))
+        self.assertEqual(out['units'].tolist(), df['units'].tolist())
+
+        # the block is freed once read
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=shared.name)
+
+    def test_missing_text(self):
+        df = pd.DataFrame({'pH': [8.1, 8.2, 8.3], 'state': ['i_soln', None, 'react'], 'empty': [None, None, None]})
+        out = SharedFrame(df).read()
+        self.assertEqual(out['state'].iloc[[0, 2]].tolist(), ['i_soln', 'react'])
+        self.assertTrue(pd.isna(out['state'].iloc[1]))
+        self.assertTrue(out['empty'].isna().all())
+
+    def test_multiindex(self):
+        columns = pd.MultiIndex.from_tuples([('general', 'pH'), ('log10(activity)', 'B(OH)4-'), ('general', 'state')])
+        df = pd.DataFrame([[8.1, -4.2, 'i_soln'], [8.2, -4.1, 'i_soln']], columns=columns)
+        df = df.astype({('general', 'pH'): float, ('log10(activity)', 'B(OH)4-'): float})
+
+        shared = SharedFrame(df)
+        self.assertLess(len(pickle.dumps(shared)), len(pickle.dumps(df)))
+        out = pickle.loads(pickle.dumps(shared)).read()
+        self.assertTrue(out.columns.equals(columns))
+        self.assertTrue(np.array_equal(out.iloc[:, :2].values, df.iloc[:, :2].values))
+
+class TestImapShared(unittest.TestCase):
+
+    def setUp(self):
+        start_tracker()
+        self.pool = mp.Pool(2)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def tasks(self, n):
+        self.created = 0
+        for i in range(n):
+            self.created += 1
+            yield (SharedFrame(pd.DataFrame({'x': [float(i)]})),)
+
+    def test_ordered(self):
+        results = imap_shared(self.pool, double, self.tasks(20), window=3)
+        first = next(results).read()
+        # only the tasks in the window have been made
+        self.assertLessEqual(self.created, 3)
+        out = [first] + [r.read() for r in results]
+        self.assertEqual([o['x'].iloc[0] for o in out], [2. * i for i in range(20)])
+
+    @unittest.skipUnless(os.path.isdir('/dev/shm'), 'shared memory blocks are not listed in /dev/shm')
+    def test_close_frees_blocks(self):
+        before = shm_blocks()
+        results = imap_shared(self.pool, double, self.tasks(20), window=4)
+        next(results).read()
+        results.close()
+        self.assertEqual(shm_blocks(), before)
+
+if __name__ == '__main__':
+    unittest.main()